@@ -7,8 +7,9 @@ from typing import Optional, Dict, Any
 from app.schemas.task import TaskCreate, Task, TaskTypeEnum
 from app.crud.crud_task import create_task
 from app.worker.tasks_indexing import document_indexing_task
+from app.worker.tasks_embedding_backfill import embedding_backfill_task
 from app.core.supabase_client import get_supabase_client
-from app.schemas.indexing import IndexingRequest
+from app.schemas.indexing import IndexingRequest, EmbeddingBackfillRequest
 
 router = APIRouter()
 
@@ -51,3 +52,37 @@ async def initiate_indexing(
 
     return db_task
 
+
+@router.post("/initiate-embedding-backfill", response_model=Task, status_code=202)
+async def initiate_embedding_backfill(
+    payload: EmbeddingBackfillRequest,
+    db: Client = Depends(get_supabase_client)
+) -> Task:
+    """
+    Initiates bulk re-embedding of a chatbot's indexed chunks (or one reference's) with the current
+    embedding model, through the OpenAI Batch API. Results arrive within 24 hours; the task reports
+    progress until then.
+    """
+    task_to_create = TaskCreate(
+        user_id=str(payload.user_id),
+        chatbot_id=payload.chatbot_id,
+        reference_id=payload.reference_id,
+        task_type=TaskTypeEnum.EMBEDDING_BACKFILL,
+        input_payload=None
+    )
+
+    db_task = create_task(db=db, task_in=task_to_create)
+
+    if db_task is None:
+        raise HTTPException(
+            status_code=500,
+            detail="Failed to create task record in the database. Please try again."
+        )
+
+    embedding_backfill_task.delay(
+        task_identifier=str(db_task.task_identifier),
+        chatbot_id=str(payload.chatbot_id),
+        reference_id=str(payload.reference_id) if payload.reference_id else None
+    )
+
+    return db_task
@@ -1,6 +1,6 @@
 from pydantic import AnyHttpUrl, field_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
-from typing import Union, Optional # Import Optional for CELERY_BROKER_URL
+from typing import Dict, Union, Optional # Import Optional for CELERY_BROKER_URL
 
 class Settings(BaseSettings):
     # Project Metadata
@@ -14,12 +14,71 @@ class Settings(BaseSettings):
     
     CELERY_BROKER_URL: str # Changed to str as it's a URL string
     CELERY_RESULT_BACKEND_URL: Optional[str] = None # Often same as broker, or a DB
+    WORKER_CONCURRENCY: int = 2 # Celery worker processes per container (same variable start-worker.sh reads)
 
     # OpenAI API Key
     OPENAI_API_KEY: Optional[str] = None
     OPENAI_MODEL_NAME: Optional[str] = None
     OPENAI_EMBEDDING_MODEL: str = "text-embedding-3-small" # Default value
-    OPENAI_EMBEDDING_BATCH_SIZE: int = 2048 # Default from previous hardcoding
+    OPENAI_EMBEDDING_BATCH_SIZE: int = 2048 # Max inputs per embedding request (API limit: 2048)
+    OPENAI_EMBEDDING_MAX_TOKENS_PER_REQUEST: int = 290000 # Max total tokens per embedding request (API limit: 300k, kept with headroom)
+    OPENAI_EMBEDDING_DIMENSIONS: Optional[int] = None # Shortened output size (text-embedding-3 models), e.g. 768; None = full size
+    EMBEDDING_STORAGE_PRECISION: str = "float32" # "float32" (vector column) or "float16" (halfvec column); must match the schema
+    EMBEDDING_COLUMN_DIMENSIONS: Optional[int] = None # Dimensions of document_chunks.embedding if not the OpenAI model's output size (e.g. for the local backend)
+    OPENAI_EMBEDDING_CONCURRENCY: int = 4 # Embedding requests in flight at once per task
+    OPENAI_REQUEST_TIMEOUT_SECONDS: float = 60.0 # Per-request timeout of the shared async client
+    OPENAI_EMBEDDING_HEDGING_ENABLED: bool = False # Duplicate embedding requests that run past the rolling latency percentile
+    OPENAI_EMBEDDING_HEDGE_PERCENTILE: float = 95.0
+    OPENAI_EMBEDDING_HEDGE_MIN_SAMPLES: int = 20 # Latencies needed (per model and process) before hedging starts
+    OPENAI_EMBEDDING_HEDGE_MIN_DELAY_SECONDS: float = 2.0 # Never hedge sooner than this
+    OPENAI_EMBEDDING_HEDGE_MAX_EXTRA_FRACTION: float = 0.05 # Extra tokens spent on hedges, as a fraction of tokens sent
+
+    # OpenAI rate governor (token buckets shared through Redis; permits are taken before every call)
+    # Per-model quotas as JSON, e.g. {"text-embedding-3-small": {"rpm": 3000, "tpm": 1000000}, "whisper-1": {"rpm": 50}}
+    OPENAI_RATE_LIMITS: Dict[str, Dict[str, int]] = {} # Models without an entry are not governed
+    OPENAI_RATE_LIMIT_UTILIZATION: float = 0.9 # Fraction of the quota to spend, leaving headroom for other users of the key
+    OPENAI_RATE_LIMIT_BURST_SECONDS: float = 2.0 # Bucket capacity, in seconds of budget
+    OPENAI_RATE_LIMIT_REDIS_URL: Optional[str] = None # Defaults to CELERY_BROKER_URL
+
+    # Circuit breaker around OpenAI calls (shared through Redis) and requeueing of tasks during outages
+    CIRCUIT_BREAKER_FAILURE_THRESHOLD: int = 5 # Connection errors/timeouts/5xx within the window that open the breaker
+    CIRCUIT_BREAKER_WINDOW_SECONDS: int = 60
+    CIRCUIT_BREAKER_OPEN_SECONDS: int = 60 # Calls fail fast for this long; tasks requeue themselves with this countdown
+    TASK_OUTAGE_MAX_REQUEUES: int = 10 # A task still hitting an open breaker after this many requeues fails
+    TASK_CHECKPOINT_TTL_SECONDS: int = 24 * 60 * 60 # Checkpoints of requeued tasks expire after this long
+    TASK_EMBEDDING_MAX_RETRIES: int = 3 # Retries for chunks whose embeddings failed (counted separately from outage requeues)
+    TASK_EMBEDDING_RETRY_COUNTDOWN_SECONDS: int = 30 # Delay before such a retry
+
+    # Bulk re-embedding backfills through the OpenAI Batch API (see embedding_bulk_service)
+    OPENAI_BATCH_BASE_URL: Optional[str] = None # Base URL of the Batch API client, e.g. a local stand-in server for tests; None = OpenAI
+    EMBEDDING_BULK_MAX_INPUTS_PER_BATCH: int = 50000 # Batch API limit on embedding inputs per batch
+    EMBEDDING_BULK_MAX_FILE_BYTES: int = 190 * 1024 * 1024 # Batch input files are limited to 200 MB
+    EMBEDDING_BULK_POLL_INTERVAL_SECONDS: int = 300 # The backfill task requeues itself this often until its batches finish
+    EMBEDDING_BULK_MAX_POLLS: int = 350 # ~29 hours at the default interval, past the 24h completion window
+
+    # Embedding backend ("openai" or "local"; see embedding_backend_service)
+    # One backend per deployment: all chunks share one embedding column and vector space. Chat
+    # retrieval in the frontend embeds queries with OpenAI, so "local" also requires changing that.
+    EMBEDDING_BACKEND: str = "openai"
+    LOCAL_EMBEDDING_MODEL: str = "sentence-transformers/all-MiniLM-L6-v2" # sentence-transformers model name or path; 384 dimensions, so needs EMBEDDING_COLUMN_DIMENSIONS=384 and a migrated column
+    LOCAL_EMBEDDING_RUNTIME: str = "torch" # "torch" or "onnx" (ONNX Runtime, usually faster on CPU)
+    LOCAL_EMBEDDING_BATCH_SIZE: int = 64 # Texts per inference batch
+    LOCAL_EMBEDDING_THREADS: int = 0 # Inference threads per worker process; 0 = auto (cores / WORKER_CONCURRENCY)
+
+    # Embedding cache settings (embeddings keyed by SHA-256 of model + dimensions + text)
+    EMBEDDING_CACHE_ENABLED: bool = True
+    EMBEDDING_CACHE_PATH: str = "/tmp/syllabi_embedding_cache.sqlite3" # Local SQLite tier, shared by the worker processes of a container
+    EMBEDDING_CACHE_MAX_BYTES: int = 2 * 1024 * 1024 * 1024 # Least recently used vectors are evicted beyond this size
+    EMBEDDING_CACHE_TABLE: Optional[str] = None # Shared Postgres table (e.g. "embedding_cache"), consulted on local misses
+
+    # Cross-task embedding micro-batching (coalesces small embedding calls of concurrent tasks via Redis)
+    EMBEDDING_MICROBATCH_ENABLED: bool = False
+    EMBEDDING_MICROBATCH_REDIS_URL: Optional[str] = None # Defaults to CELERY_BROKER_URL
+    EMBEDDING_MICROBATCH_MAX_INPUTS: int = 256 # Larger calls fill their own requests and bypass the queue
+    EMBEDDING_MICROBATCH_HIGH_PRIORITY_MAX_INPUTS: int = 32 # Calls up to this size use the high-priority lane
+    EMBEDDING_MICROBATCH_MAX_WAIT_MS: int = 250 # Longest a bulk-lane call waits for others to join its batch
+    EMBEDDING_MICROBATCH_HIGH_PRIORITY_MAX_WAIT_MS: int = 50
+    EMBEDDING_MICROBATCH_REPLY_TIMEOUT_SECONDS: float = 120.0 # Then the caller embeds its own texts
     
     # Google OAuth Configuration
     GOOGLE_CLIENT_ID: Optional[str] = None
@@ -29,13 +88,35 @@ class Settings(BaseSettings):
     NOTION_CLIENT_ID: Optional[str] = None
     NOTION_CLIENT_SECRET: Optional[str] = None
 
+    # PDF parsing settings
+    PDF_PARSER_TYPE: str = "pdfplumber" # "pdfplumber" or "pymupdf" (MuPDF, much faster word extraction)
+    PDF_PARSE_PROCESSES: int = 0 # Processes per document for page-parallel parsing; 0 = auto (cores / WORKER_CONCURRENCY), 1 = serial
+    PDF_PARSE_MIN_PAGES_PER_PROCESS: int = 8 # Each extra process must get at least this many pages
+
+    # Parse cache settings (parsed PDF output keyed by file SHA-256 + parser version)
+    PARSE_CACHE_ENABLED: bool = True
+    PARSE_CACHE_DIR: str = "/tmp/syllabi_parse_cache"
+    PARSE_CACHE_MAX_BYTES: int = 1024 * 1024 * 1024 # Least recently used entries are evicted beyond this size
+    PARSE_CACHE_BUCKET: Optional[str] = None # Supabase storage bucket to mirror entries to, shared by all workers
+    PDF_ELEMENT_GRANULARITY: str = "word" # "word", "line" or "block"; coarser elements make chunking and storage cheaper
+
     # Chunking settings
     MIN_TOKENS_PER_CHUNK: int = 30
     MAX_TOKENS_PER_CHUNK: int = 400
     TOKEN_OVERLAP: int = 20
+    TOKENIZER_NUM_THREADS: int = 4 # Threads used by tiktoken's batch encoder
 
     # Database operations
-    DB_INSERT_BATCH_SIZE: int = 250 # Default from previous hardcoding
+    DB_INSERT_BATCH_SIZE: int = 250 # Max rows per insert batch; batches are otherwise cut by payload bytes
+    DB_INSERT_BATCH_BYTES: int = 2 * 1024 * 1024 # Starting payload budget per insert batch, adapted per worker process from latency and errors
+    DB_INSERT_MIN_BATCH_BYTES: int = 64 * 1024
+    DB_INSERT_MAX_BATCH_BYTES: int = 8 * 1024 * 1024
+    DB_INSERT_TARGET_SECONDS: float = 2.0 # Batches slower than this shrink the budget, full batches faster than it grow it
+    DB_INSERT_CONCURRENCY: int = 4 # Insert batches in flight at once per document
+    DB_DELETE_BATCH_SIZE: int = 1000 # Chunks per ranged delete when clearing a reference
+    CHUNK_WRITER: str = "postgrest" # "postgrest" (Supabase REST API) or "copy" (binary COPY over a direct connection; needs DATABASE_URL)
+    DATABASE_URL: Optional[str] = None # Direct Postgres connection string, e.g. postgresql://postgres:<password>@db.<project>.supabase.co:5432/postgres
+    DATABASE_POOL_MAX_SIZE: int = 2 # Direct connections per worker process
 
     # If using service_role key, be mindful of security implications
     # For direct DB connections if needed (usually Supabase client handles this)
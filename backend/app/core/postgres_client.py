@@ -0,0 +1,36 @@
+import os
+import threading
+from typing import Any, Dict, Tuple
+
+from app.core.config import settings
+
+# Direct Postgres connections (DATABASE_URL), used where the Supabase REST API is too slow, e.g.
+# binary COPY of document chunks (CHUNK_WRITER=copy). Pools are created lazily and per process:
+# Celery's prefork pool forks worker processes, and connections inherited across a fork must not
+# be reused. psycopg is only needed when a direct connection is used: pip install "psycopg[binary,pool]"
+_lock = threading.Lock()
+_pools: Dict[Tuple[int, str], Any] = {}
+
+def get_postgres_pool() -> Any:
+    """Returns this process's psycopg_pool.ConnectionPool for settings.DATABASE_URL."""
+    if not settings.DATABASE_URL:
+        raise RuntimeError("DATABASE_URL is not set; a direct Postgres connection is required for CHUNK_WRITER=copy.")
+    key = (os.getpid(), settings.DATABASE_URL)
+    pool = _pools.get(key)
+    if pool is None:
+        with _lock:
+            pool = _pools.get(key)
+            if pool is None:
+                try:
+                    from psycopg_pool import ConnectionPool
+                except ImportError as e:
+                    raise RuntimeError("Direct Postgres connections require psycopg: pip install \"psycopg[binary,pool]\"") from e
+                pool = ConnectionPool(
+                    settings.DATABASE_URL,
+                    min_size=1,
+                    max_size=settings.DATABASE_POOL_MAX_SIZE,
+                    kwargs={"prepare_threshold": None}, # No server-side prepared statements, so transaction-mode poolers (pgbouncer/Supavisor) work
+                    open=True,
+                )
+                _pools[key] = pool
+    return pool
@@ -0,0 +1,28 @@
+import os
+import threading
+from typing import Dict, Optional, Tuple
+
+import redis
+
+from app.core.config import settings
+
+# Clients are created lazily and per process: Celery's prefork pool forks worker processes,
+# and a connection pool inherited across a fork must not be reused.
+_lock = threading.Lock()
+_clients: Dict[Tuple[int, str], redis.Redis] = {}
+
+def get_redis_client(url: Optional[str] = None) -> redis.Redis:
+    """
+    Returns a Redis client for this process. Defaults to the Celery broker URL,
+    which is the Redis instance all workers already share.
+    """
+    url = url or settings.CELERY_BROKER_URL
+    key = (os.getpid(), url)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = redis.Redis.from_url(url)
+                _clients[key] = client
+    return client
@@ -1,14 +1,25 @@
-from typing import List, Tuple, Dict, Any
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 from uuid import UUID
+from concurrent.futures import ThreadPoolExecutor
+import json
 import logging
+import struct
+import threading
+import time
+
+import httpx
+import numpy as np
 
 from supabase import Client # Changed to sync client
+from postgrest.types import CountMethod, ReturnMethod
 # from supabase_py_async import AsyncClient
 
 from app.schemas.chunk import ChunkCreate, MultimediaChunkCreate # Used for type hinting and accessing chunk data
 # We don't directly use the full Chunk schema here as we are creating records.
 
 from app.core.config import settings # Import settings
+from app.core.postgres_client import get_postgres_pool
+from app.services import embedding_profile_service
 
 logger = logging.getLogger(__name__)
 
@@ -16,36 +27,53 @@ logger = logging.getLogger(__name__)
 DOCUMENT_CHUNKS_TABLE_NAME = "document_chunks"
 # DB_INSERT_BATCH_SIZE will be taken from settings
 
+# Chunk writers (settings.CHUNK_WRITER)
+POSTGREST_WRITER = "postgrest"
+COPY_WRITER = "copy"
+CHUNK_WRITERS = (POSTGREST_WRITER, COPY_WRITER)
+
+# Binary COPY stream framing (https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4)
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0) # Signature, flags, header extension length
+COPY_TRAILER = struct.pack(">h", -1)
+COPY_WRITE_BYTES = 1024 * 1024 # Rows are handed to the connection in pieces of about this size
+COPY_CHUNK_COLUMNS = (
+    "reference_id", "user_id", "chatbot_id", "page_number",
+    "chunk_text", "token_count", "embedding", "constituent_elements_data",
+)
+
 def bulk_create_chunks_with_embeddings(
     db: Client, # Changed to sync client
-    chunk_embeddings_data: List[Tuple[ChunkCreate, List[float]]]
-) -> Tuple[List[Dict[str, Any]], str | None]:
+    chunk_embeddings_data: List[Tuple[ChunkCreate, np.ndarray]]
+) -> Tuple[int, str | None]:
     """
     Performs a bulk insert of document chunks with their embeddings into the Supabase table,
-    handling large numbers of chunks by breaking them into smaller batches.
+    handling large numbers of chunks by breaking them into smaller batches (see _insert_records).
 
     Args:
         db: The Supabase sync client instance.
         chunk_embeddings_data: A list of tuples, where each tuple contains:
             - chunk_info (ChunkCreate): The Pydantic model with chunk details.
-            - embedding_vector (List[float]): The embedding vector for the chunk.
+            - embedding_vector (np.ndarray): The float32 embedding vector for the chunk.
 
     Returns:
         A tuple containing:
-        - List[Dict[str, Any]]: The list of ALL successfully inserted data records from Supabase.
+        - int: The number of chunks successfully inserted.
         - str | None: An error message string if any part of the batch operations failed, otherwise None.
     """
     if not chunk_embeddings_data:
-        return [], "No chunk data provided for insertion."
+        return 0, "No chunk data provided for insertion."
+    if settings.CHUNK_WRITER not in CHUNK_WRITERS:
+        raise ValueError(f"Unknown CHUNK_WRITER '{settings.CHUNK_WRITER}'. Use one of {CHUNK_WRITERS}.")
+    if settings.CHUNK_WRITER == COPY_WRITER:
+        return copy_chunks_with_embeddings(chunk_embeddings_data)
 
-    all_inserted_records: List[Dict[str, Any]] = []
-    cumulative_error_messages = []
 
     records_to_prepare = []
     for chunk_info, embedding_vector in chunk_embeddings_data:
-        # Convert constituent_elements (List[ParsedTextElement]) to a list of dicts for JSONB storage
+        # Convert constituent_elements (List[ParsedTextElement]) to a list of dicts for JSONB storage.
+        # exclude_none drops the per-word side arrays on plain word elements.
         constituent_elements_json_serializable = [
-            element.model_dump() for element in chunk_info.constituent_elements
+            element.model_dump(exclude_none=True) for element in chunk_info.constituent_elements
         ]
 
         record = {
@@ -55,52 +83,216 @@ def bulk_create_chunks_with_embeddings(
             "page_number": chunk_info.page_number,
             "chunk_text": chunk_info.chunk_text,
             "token_count": chunk_info.token_count,
-            "embedding": embedding_vector, # pgvector expects a list of floats
+            "embedding": embedding_profile_service.serialize(embedding_vector), # pgvector literal for a vector/halfvec column
             "constituent_elements_data": constituent_elements_json_serializable, # Stored as JSONB
             # "parser_metadata": chunk_info.parser_metadata # Already a dict or None
             # chunk_id and created_at will be auto-generated by the database
         }
         records_to_prepare.append(record)
 
-    total_records_to_insert = len(records_to_prepare)
-    logger.info(f"Preparing to bulk insert {total_records_to_insert} total chunks in batches of {settings.DB_INSERT_BATCH_SIZE}.")
+    logger.info(f"Preparing to bulk insert {len(records_to_prepare)} total chunks in batches of {settings.DB_INSERT_BATCH_SIZE}.")
+    inserted_count, error_messages = _insert_records(db, records_to_prepare, "")
 
-    for i in range(0, total_records_to_insert, settings.DB_INSERT_BATCH_SIZE):
-        batch_to_insert = records_to_prepare[i:i + settings.DB_INSERT_BATCH_SIZE]
-        batch_number = (i // settings.DB_INSERT_BATCH_SIZE) + 1
-        logger.info(f"Attempting to insert batch {batch_number} ({len(batch_to_insert)} chunks) into '{DOCUMENT_CHUNKS_TABLE_NAME}'.")
-        
+    if error_messages:
+        # If any batch failed, the overall operation is considered to have issues.
+        # The caller can check inserted_count against the number of chunks.
+        final_error_message = "One or more batches failed during chunk insertion. Errors: " + "; ".join(error_messages)
+        logger.error(final_error_message)
+        return inserted_count, final_error_message # Count of chunks that *were* inserted, plus errors
+
+    logger.info(f"Successfully inserted all {inserted_count} chunks across all batches.")
+    return inserted_count, None
+
+
+# Adaptive insert batch budget (per process, shared by the documents a worker indexes).
+# Chunk rows differ wildly in size: a PDF chunk with per-word constituent_elements_data can be 100x
+# a transcript chunk, so batches are cut by serialised bytes, not rows.
+_insert_budget_lock = threading.Lock()
+_insert_budget_bytes: Optional[int] = None
+
+# Errors after which the batch is known not to have been written and is worth retrying in halves:
+# request too large (413), statement timeout (57014) and program limits such as an oversized
+# statement (54000). Read timeouts are not retried, as the insert may have committed regardless.
+SPLITTABLE_INSERT_ERROR_CODES = {"413", "57014", "54000"}
+
+
+def _record_size(record: Dict[str, Any]) -> int:
+    """Approximate size of a record in the insert's JSON request body."""
+    return len(json.dumps(record, separators=(",", ":"), ensure_ascii=False).encode("utf-8"))
+
+
+def _get_insert_budget() -> int:
+    global _insert_budget_bytes
+    with _insert_budget_lock:
+        if _insert_budget_bytes is None:
+            _insert_budget_bytes = min(max(settings.DB_INSERT_BATCH_BYTES, settings.DB_INSERT_MIN_BATCH_BYTES), settings.DB_INSERT_MAX_BATCH_BYTES)
+        return _insert_budget_bytes
+
+
+def _adapt_insert_budget(batch_bytes: int, elapsed_seconds: float, failed: bool) -> None:
+    """
+    Adapts the byte budget from a batch's outcome: halves it below a batch that was too large or too
+    slow to be written, shrinks it in proportion to latency over DB_INSERT_TARGET_SECONDS, and grows
+    it by a quarter after a full batch written faster than that.
+    """
+    global _insert_budget_bytes
+    budget = _get_insert_budget()
+    target = settings.DB_INSERT_TARGET_SECONDS
+    if failed:
+        new_budget = min(budget, batch_bytes) // 2
+    elif elapsed_seconds > target:
+        new_budget = int(budget * target / elapsed_seconds)
+    elif batch_bytes >= budget // 2:
+        new_budget = int(budget * 1.25)
+    else:
+        return # A small (e.g. last) batch says little about how large batches can be
+    new_budget = min(max(new_budget, settings.DB_INSERT_MIN_BATCH_BYTES), settings.DB_INSERT_MAX_BATCH_BYTES)
+    with _insert_budget_lock:
+        if new_budget != _insert_budget_bytes:
+            logger.info(f"Insert batch budget {'lowered' if new_budget < (_insert_budget_bytes or 0) else 'raised'} to {new_budget} bytes (batch of {batch_bytes} bytes took {elapsed_seconds:.2f}s{', failed' if failed else ''}).")
+            _insert_budget_bytes = new_budget
+
+
+def _is_splittable_insert_error(error: Exception) -> bool:
+    if isinstance(error, (httpx.WriteTimeout, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        return True # The request never reached the database in full
+    return str(getattr(error, "code", "")) in SPLITTABLE_INSERT_ERROR_CODES
+
+
+def _insert_records(db: Client, records: List[Dict[str, Any]], label: str) -> Tuple[int, List[str]]:
+    """
+    Inserts records in batches cut to the adaptive byte budget (and at most DB_INSERT_BATCH_SIZE
+    rows), with up to DB_INSERT_CONCURRENCY batches in flight. Inserts ask for no representation,
+    only a count, so the rows (embeddings included) are not sent back. A batch that is rejected as
+    too large or too slow is split in half and retried, down to single rows, rather than failing the
+    document. Returns the number of rows inserted and the errors of rows that could not be inserted.
+    """
+    if not records:
+        return 0, []
+    sizes = [_record_size(record) for record in records]
+    max_rows = settings.DB_INSERT_BATCH_SIZE
+    position = 0
+    batch_count = 0
+    position_lock = threading.Lock()
+
+    def next_batch() -> Tuple[str, int, int] | None:
+        nonlocal position, batch_count
+        with position_lock:
+            if position >= len(records):
+                return None
+            budget = _get_insert_budget()
+            start = position
+            batch_bytes = sizes[position]
+            position += 1
+            while position < len(records) and position - start < max_rows and batch_bytes + sizes[position] <= budget:
+                batch_bytes += sizes[position]
+                position += 1
+            batch_count += 1
+            return str(batch_count), start, position
+
+    def insert_batch(batch_name: str, start: int, end: int) -> Tuple[int, List[str]]:
+        batch_to_insert = records[start:end]
+        batch_bytes = sum(sizes[start:end])
+        logger.info(f"Attempting to insert {label}batch {batch_name} ({len(batch_to_insert)} chunks, {batch_bytes} bytes) into '{DOCUMENT_CHUNKS_TABLE_NAME}'.")
+        started = time.monotonic()
         try:
-            response = db.table(DOCUMENT_CHUNKS_TABLE_NAME).insert(batch_to_insert).execute()
-
-            if response.data:
-                logger.info(f"Successfully inserted {len(response.data)} chunk records from batch {batch_number}.")
-                all_inserted_records.extend(response.data)
-            else:
-                error_msg = f"Supabase insert operation for batch {batch_number} returned no data."
-                if hasattr(response, 'error') and response.error:
-                    error_msg = f"Supabase insert error for batch {batch_number}: {response.error.message if response.error else 'Unknown error'}"
-                logger.error(error_msg)
-                cumulative_error_messages.append(error_msg)
-                # Optionally, decide if one batch failure should stop all subsequent batches
-                # For now, we attempt all batches and report cumulative errors.
-                
+            response = db.table(DOCUMENT_CHUNKS_TABLE_NAME).insert(
+                batch_to_insert, count=CountMethod.exact, returning=ReturnMethod.minimal
+            ).execute()
+            _adapt_insert_budget(batch_bytes, time.monotonic() - started, failed=False)
+            # A successful insert is one statement, so the count can only be the whole batch
+            inserted_count = response.count if response.count is not None else len(batch_to_insert)
+            logger.info(f"Successfully inserted {inserted_count} {label}chunk records from batch {batch_name}.")
+            return inserted_count, []
         except Exception as e:
-            logger.error(f"Error during bulk insert of chunks (batch {batch_number}): {e}", exc_info=True)
+            if _is_splittable_insert_error(e):
+                _adapt_insert_budget(batch_bytes, time.monotonic() - started, failed=True)
+                if end - start > 1:
+                    middle = (start + end) // 2
+                    logger.warning(f"Insert of {label}batch {batch_name} ({len(batch_to_insert)} chunks, {batch_bytes} bytes) was too large or too slow ({e}). Retrying it in halves.")
+                    first_count, first_errors = insert_batch(f"{batch_name}.1", start, middle)
+                    second_count, second_errors = insert_batch(f"{batch_name}.2", middle, end)
+                    return first_count + second_count, first_errors + second_errors
+            logger.error(f"Error during bulk insert of {label}chunks (batch {batch_name}): {e}", exc_info=True)
             error_detail = str(e)
             if hasattr(e, 'message') and e.message:
                 error_detail = e.message
-            cumulative_error_messages.append(f"Failed to insert batch {batch_number}: {error_detail}")
-    
-    if cumulative_error_messages:
-        # If any batch failed, the overall operation is considered to have issues.
-        # The caller can check the length of all_inserted_records against total_records_to_insert.
-        final_error_message = "One or more batches failed during chunk insertion. Errors: " + "; ".join(cumulative_error_messages)
-        logger.error(final_error_message)
-        return all_inserted_records, final_error_message # Return records that *were* inserted, plus errors
-    
-    logger.info(f"Successfully inserted all {len(all_inserted_records)} chunks across all batches.")
-    return all_inserted_records, None
+            return 0, [f"Failed to insert {label}batch {batch_name} ({len(batch_to_insert)} chunks): {error_detail}"]
+
+    def insert_batches() -> Tuple[int, List[str]]:
+        # Each worker takes the next batch once its previous one is written, so batches are cut
+        # with the budget as adapted by the batches before them
+        inserted_count, errors = 0, []
+        while (batch := next_batch()) is not None:
+            count, batch_errors = insert_batch(*batch)
+            inserted_count += count
+            errors.extend(batch_errors)
+        return inserted_count, errors
+
+    workers = max(1, settings.DB_INSERT_CONCURRENCY)
+    # The Supabase client's HTTP connection pool is thread-safe
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(insert_batches) for _ in range(workers)]
+        results = [future.result() for future in futures]
+    return sum(count for count, _ in results), [error for _, errors in results for error in errors]
+
+
+def _copy_field(value: bytes) -> bytes:
+    return struct.pack(">i", len(value)) + value
+
+
+def copy_chunks_with_embeddings(
+    chunk_embeddings_data: List[Tuple[ChunkCreate, np.ndarray]]
+) -> Tuple[int, str | None]:
+    """
+    Inserts document chunks with their embeddings through binary COPY over a pooled direct
+    Postgres connection (settings.DATABASE_URL), in one transaction. Rows are streamed in
+    Postgres's binary format, with embeddings in pgvector's binary form, so neither side
+    formats or parses vectors as text and nothing is sent back.
+
+    Args:
+        chunk_embeddings_data: A list of (ChunkCreate, float32 embedding vector) tuples.
+
+    Returns:
+        A tuple containing:
+        - int: The number of chunks inserted (all or none of them).
+        - str | None: An error message string if the copy failed, otherwise None.
+    """
+    copied_count = 0
+    field_count = struct.pack(">h", len(COPY_CHUNK_COLUMNS))
+    logger.info(f"Copying {len(chunk_embeddings_data)} chunks into '{DOCUMENT_CHUNKS_TABLE_NAME}'.")
+    try:
+        with get_postgres_pool().connection() as connection: # Commits on success, rolls back on error
+            with connection.cursor() as cursor:
+                with cursor.copy(f"COPY public.{DOCUMENT_CHUNKS_TABLE_NAME} ({', '.join(COPY_CHUNK_COLUMNS)}) FROM STDIN (FORMAT BINARY)") as copy:
+                    buffer = bytearray(COPY_HEADER)
+                    for chunk_info, embedding_vector in chunk_embeddings_data:
+                        # jsonb binary format: version byte 1, then the JSON text.
+                        # exclude_none drops the per-word side arrays on plain word elements.
+                        constituent_elements_json = "[" + ",".join(
+                            element.model_dump_json(exclude_none=True) for element in chunk_info.constituent_elements
+                        ) + "]"
+                        buffer += field_count
+                        buffer += _copy_field(chunk_info.reference_id.bytes)
+                        buffer += _copy_field(chunk_info.user_id.bytes)
+                        buffer += _copy_field(chunk_info.chatbot_id.bytes)
+                        buffer += _copy_field(struct.pack(">i", chunk_info.page_number))
+                        buffer += _copy_field(chunk_info.chunk_text.encode("utf-8"))
+                        buffer += _copy_field(struct.pack(">i", chunk_info.token_count))
+                        buffer += _copy_field(embedding_profile_service.serialize_binary(embedding_vector))
+                        buffer += _copy_field(b"\x01" + constituent_elements_json.encode("utf-8"))
+                        copied_count += 1
+                        if len(buffer) >= COPY_WRITE_BYTES:
+                            copy.write(buffer)
+                            buffer = bytearray()
+                    buffer += COPY_TRAILER
+                    copy.write(buffer)
+    except Exception as e:
+        logger.error(f"Error during binary copy of chunks: {e}", exc_info=True)
+        return 0, f"Failed to copy chunks: {e}"
+
+    logger.info(f"Successfully copied all {copied_count} chunks.")
+    return copied_count, None
 
 
 # ============================================================================
@@ -109,10 +301,10 @@ def bulk_create_chunks_with_embeddings(
 
 def bulk_create_multimedia_chunks_with_embeddings(
     db: Client,
-    multimedia_chunk_embeddings_data: List[Tuple[Dict[str, Any], List[float]]],
+    multimedia_chunk_embeddings_data: List[Tuple[Dict[str, Any], np.ndarray]],
     user_id: UUID,
     content_type: str
-) -> Tuple[List[Dict[str, Any]], str | None]:
+) -> Tuple[int, str | None]:
     """
     Performs a bulk insert of multimedia chunks with their embeddings into the document_chunks table.
     
@@ -120,20 +312,18 @@ def bulk_create_multimedia_chunks_with_embeddings(
         db: The Supabase sync client instance.
         multimedia_chunk_embeddings_data: List of tuples containing:
             - chunk_data (Dict): Multimedia chunk data from MultimediaChunkingService
-            - embedding_vector (List[float]): The embedding vector for the chunk
+            - embedding_vector (np.ndarray): The float32 embedding vector for the chunk
         user_id: UUID of the user who owns this content
         content_type: Content type from source (VIDEO/AUDIO)
         
     Returns:
         A tuple containing:
-        - List[Dict[str, Any]]: Successfully inserted records from Supabase
+        - int: Number of chunks successfully inserted
         - str | None: Error message if any batch operations failed, otherwise None
     """
     if not multimedia_chunk_embeddings_data:
-        return [], "No multimedia chunk data provided for insertion."
+        return 0, "No multimedia chunk data provided for insertion."
     
-    all_inserted_records: List[Dict[str, Any]] = []
-    cumulative_error_messages = []
     
     # Convert content type to lowercase for database
     db_content_type = content_type.lower() if content_type in ["VIDEO", "AUDIO"] else "audio"
@@ -147,8 +337,8 @@ def bulk_create_multimedia_chunks_with_embeddings(
             "chatbot_id": str(chunk_data.get("chatbot_id")),
             "page_number": 0,  # Not applicable for multimedia, use 0 as default
             "chunk_text": chunk_data.get("text", ""),
-            "token_count": chunk_data.get("word_count", 0),
-            "embedding": embedding_vector,
+            "token_count": chunk_data.get("token_count", chunk_data.get("word_count", 0)),
+            "embedding": embedding_profile_service.serialize(embedding_vector),
             
             # Multimedia-specific fields (new columns)
             "content_type": db_content_type,  # Use the actual content type from source
@@ -173,43 +363,87 @@ def bulk_create_multimedia_chunks_with_embeddings(
         
         records_to_prepare.append(record)
     
-    total_records_to_insert = len(records_to_prepare)
-    batch_size = getattr(settings, 'DB_INSERT_BATCH_SIZE', 50)  # Default to 50 if not set
-    
-    logger.info(f"Preparing to bulk insert {total_records_to_insert} multimedia chunks in batches of {batch_size}.")
-    
-    for i in range(0, total_records_to_insert, batch_size):
-        batch_to_insert = records_to_prepare[i:i + batch_size]
-        batch_number = (i // batch_size) + 1
-        logger.info(f"Attempting to insert multimedia batch {batch_number} ({len(batch_to_insert)} chunks) into '{DOCUMENT_CHUNKS_TABLE_NAME}'.")
-        
+    logger.info(f"Preparing to bulk insert {len(records_to_prepare)} multimedia chunks in batches of {settings.DB_INSERT_BATCH_SIZE}.")
+    inserted_count, error_messages = _insert_records(db, records_to_prepare, "multimedia ")
+
+    if error_messages:
+        final_error_message = "One or more multimedia batches failed during chunk insertion. Errors: " + "; ".join(error_messages)
+        logger.error(final_error_message)
+        return inserted_count, final_error_message
+
+    logger.info(f"Successfully inserted all {inserted_count} multimedia chunks across all batches.")
+    return inserted_count, None
+
+
+def iter_chunk_texts(
+    db: Client,
+    chatbot_id: UUID,
+    reference_id: Optional[UUID] = None,
+    page_size: int = 1000
+) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Yields the chunk_id, chunk_text and token_count of a chatbot's chunks (optionally only one
+    reference's), page by page in chunk_id order. Keyset pagination keeps every page an index
+    range scan, however far into the table it is.
+
+    Args:
+        db: The Supabase sync client instance.
+        chatbot_id: The chatbot whose chunks are read.
+        reference_id: If given, only this reference's chunks are read.
+        page_size: Rows per page (PostgREST may cap it; pages end only when one comes back empty).
+    """
+    last_chunk_id = None
+    while True:
+        query = db.table(DOCUMENT_CHUNKS_TABLE_NAME).select("chunk_id,chunk_text,token_count").eq("chatbot_id", str(chatbot_id))
+        if reference_id is not None:
+            query = query.eq("reference_id", str(reference_id))
+        if last_chunk_id is not None:
+            query = query.gt("chunk_id", last_chunk_id)
+        response = query.order("chunk_id").limit(page_size).execute()
+        if not response.data:
+            return
+        yield response.data
+        last_chunk_id = response.data[-1]["chunk_id"]
+
+
+def update_chunk_embeddings(
+    db: Client,
+    chunk_ids: List[str],
+    embeddings: List[np.ndarray]
+) -> Tuple[int, str | None]:
+    """
+    Replaces the embeddings of existing chunks, in batches of DB_INSERT_BATCH_SIZE, through the
+    update_document_chunk_embeddings function (sql/create_update_document_chunk_embeddings_function.sql).
+    Chunks deleted in the meantime (e.g. by re-indexing) are skipped.
+
+    Returns:
+        A tuple containing:
+        - int: The number of chunks updated.
+        - str | None: An error message string if any batch failed, otherwise None.
+    """
+    updated_count = 0
+    cumulative_error_messages = []
+    for i in range(0, len(chunk_ids), settings.DB_INSERT_BATCH_SIZE):
+        batch_number = (i // settings.DB_INSERT_BATCH_SIZE) + 1
         try:
-            response = db.table(DOCUMENT_CHUNKS_TABLE_NAME).insert(batch_to_insert).execute()
-            
-            if response.data:
-                logger.info(f"Successfully inserted {len(response.data)} multimedia chunk records from batch {batch_number}.")
-                all_inserted_records.extend(response.data)
-            else:
-                error_msg = f"Supabase insert operation for multimedia batch {batch_number} returned no data."
-                if hasattr(response, 'error') and response.error:
-                    error_msg = f"Supabase insert error for multimedia batch {batch_number}: {response.error.message if response.error else 'Unknown error'}"
-                logger.error(error_msg)
-                cumulative_error_messages.append(error_msg)
-                
+            response = db.rpc("update_document_chunk_embeddings", {
+                "chunk_ids": chunk_ids[i:i + settings.DB_INSERT_BATCH_SIZE],
+                "embeddings": [
+                    embedding_profile_service.serialize(embedding_vector)
+                    for embedding_vector in embeddings[i:i + settings.DB_INSERT_BATCH_SIZE]
+                ],
+            }).execute()
+            updated_count += response.data or 0
         except Exception as e:
-            logger.error(f"Error during bulk insert of multimedia chunks (batch {batch_number}): {e}", exc_info=True)
+            logger.error(f"Error updating chunk embeddings (batch {batch_number}): {e}", exc_info=True)
             error_detail = str(e)
             if hasattr(e, 'message') and e.message:
                 error_detail = e.message
-            cumulative_error_messages.append(f"Failed to insert multimedia batch {batch_number}: {error_detail}")
-    
+            cumulative_error_messages.append(f"Failed to update batch {batch_number}: {error_detail}")
+
     if cumulative_error_messages:
-        final_error_message = "One or more multimedia batches failed during chunk insertion. Errors: " + "; ".join(cumulative_error_messages)
-        logger.error(final_error_message)
-        return all_inserted_records, final_error_message
-    
-    logger.info(f"Successfully inserted all {len(all_inserted_records)} multimedia chunks across all batches.")
-    return all_inserted_records, None
+        return updated_count, "One or more batches failed during embedding update. Errors: " + "; ".join(cumulative_error_messages)
+    return updated_count, None
 
 
 def delete_chunks_by_reference_id(
@@ -219,6 +453,10 @@ def delete_chunks_by_reference_id(
     """
     Deletes all document chunks associated with a given reference_id.
 
+    Large references are deleted in slices of DB_DELETE_BATCH_SIZE chunks: each slice is the
+    chunk_id range of the reference's next ids, so every statement stays short (well within the
+    API's statement timeout) and only a count is sent back, not the deleted rows.
+
     Args:
         db: The Supabase sync client instance.
         reference_id: The UUID of the reference whose chunks are to be deleted.
@@ -230,18 +468,35 @@ def delete_chunks_by_reference_id(
     """
     try:
         logger.info(f"Attempting to delete chunks for reference_id: {reference_id} from '{DOCUMENT_CHUNKS_TABLE_NAME}'.")
-        response = db.table(DOCUMENT_CHUNKS_TABLE_NAME).delete().eq("reference_id", str(reference_id)).execute()
-
-        if hasattr(response, 'error') and response.error:
-            error_msg = f"Supabase delete error: {response.error.message if response.error else 'Unknown error'}"
-            logger.error(error_msg)
-            return False, error_msg
-        else:
-            # Log how many were (potentially) deleted. Response.data might be empty if nothing matched.
-            count_deleted = len(response.data) if response.data else 0
-            logger.info(f"Delete operation for reference_id '{reference_id}' completed. Matched and potentially deleted {count_deleted} chunk(s).")
-            return True, None # Success, even if 0 rows were deleted because they didn't exist.
-            
+        count_deleted = 0
+        while True:
+            id_page = (
+                db.table(DOCUMENT_CHUNKS_TABLE_NAME)
+                .select("chunk_id")
+                .eq("reference_id", str(reference_id))
+                .order("chunk_id")
+                .limit(settings.DB_DELETE_BATCH_SIZE)
+                .execute()
+            )
+            if not id_page.data:
+                break
+            response = (
+                db.table(DOCUMENT_CHUNKS_TABLE_NAME)
+                .delete(count=CountMethod.exact, returning=ReturnMethod.minimal)
+                .eq("reference_id", str(reference_id))
+                .gte("chunk_id", id_page.data[0]["chunk_id"])
+                .lte("chunk_id", id_page.data[-1]["chunk_id"])
+                .execute()
+            )
+            if not response.count:
+                # The same ids would come back forever (e.g. rows the key may not delete)
+                error_msg = f"Supabase delete removed no chunks in the range {id_page.data[0]['chunk_id']}..{id_page.data[-1]['chunk_id']}."
+                logger.error(error_msg)
+                return False, error_msg
+            count_deleted += response.count
+        logger.info(f"Delete operation for reference_id '{reference_id}' completed. Deleted {count_deleted} chunk(s).")
+        return True, None # Success, even if 0 rows were deleted because they didn't exist.
+
     except Exception as e:
         logger.error(f"Error deleting chunks for reference_id '{reference_id}': {e}", exc_info=True)
         error_detail = str(e)
@@ -293,13 +548,11 @@ def delete_chunks_by_reference_id(
 
 #     # Test bulk creation
 #     logger.info("Attempting to bulk create chunks...")
-#     inserted_data, insert_error = bulk_create_chunks_with_embeddings(supabase_client, data_to_insert)
+#     inserted_count, insert_error = bulk_create_chunks_with_embeddings(supabase_client, data_to_insert)
 #     if insert_error:
 #         logger.error(f"Bulk create failed: {insert_error}")
 #     else:
-#         logger.info(f"Bulk create successful. Inserted {len(inserted_data)} records.")
-#         # for record in inserted_data:
-#         #     logger.info(f"  Inserted chunk_id: {record.get('chunk_id')}")
+#         logger.info(f"Bulk create successful. Inserted {inserted_count} records.")
 #     
 #     # Optional: Test deletion again to clean up
 #     # await delete_chunks_by_reference_id(supabase_client, sample_ref_id)
@@ -32,6 +32,10 @@ class ParsedTextElement(BaseModel):
     page_width: float = Field(..., description="Total width of the page this element belongs to.")
     page_height: float = Field(..., description="Total height of the page this element belongs to.")
 
+    # Present when several parsed words were coalesced into one line/block element
+    word_offsets: Optional[List[int]] = Field(None, description="Character offset in `text` where each coalesced word starts.")
+    word_boxes: Optional[List[float]] = Field(None, description="Flattened [x0, y0, x1, y1] bounding box of each coalesced word, in the same order as word_offsets.")
+
     # Optional: Add other attributes from parser if needed, e.g., fontname, size
 
 class ParsedPage(BaseModel):
@@ -1,3 +1,4 @@
+from typing import Optional
 from uuid import UUID
 from pydantic import BaseModel
 
@@ -6,3 +7,9 @@ class IndexingRequest(BaseModel):
     user_id: UUID
     chatbot_id: UUID
     reference_id: UUID
+
+class EmbeddingBackfillRequest(BaseModel):
+    """Schema for a bulk re-embedding request (all of a chatbot's chunks, or one reference's)."""
+    user_id: UUID
+    chatbot_id: UUID
+    reference_id: Optional[UUID] = None
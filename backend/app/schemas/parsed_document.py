@@ -0,0 +1,280 @@
+import io
+from array import array
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+from app.schemas.chunk import ParsedPage, ParsedTextElement
+
+# Decimal places kept when float32 coordinates are turned back into Python floats for
+# ParsedTextElement views (float32 is exact to well under 0.001pt on any real page size).
+COORDINATE_DECIMALS = 3
+# Decimal places kept for per-word boxes of coalesced elements
+WORD_BOX_DECIMALS = 2
+
+# Bumped whenever the to_bytes() layout changes
+SERIALIZATION_FORMAT_VERSION = 1
+
+_ARRAY_FIELDS = ("x0", "y0", "x1", "y1", "page_indices", "page_numbers", "page_widths", "page_heights")
+_WORD_ARRAY_FIELDS = ("word_starts", "word_char_offsets", "word_boxes")
+
+
+class ParsedDocument:
+    """
+    Columnar representation of a parsed PDF.
+
+    Instead of one validated ParsedTextElement per word (each repeating its page number and page
+    size), elements are stored as one list of texts plus float32 coordinate arrays and an int32
+    page index per element. Page numbers and sizes are stored once per page. Elements are kept in
+    page order, so the elements of a page are a contiguous range.
+
+    Coalesced documents (see element_coalescing_service) also carry the per-word side arrays:
+    word_starts[i]:word_starts[i + 1] is the range of words of element i inside word_char_offsets
+    (character offset of the word in the element text) and word_boxes (float32 [x0, y0, x1, y1]).
+
+    ParsedTextElement / ParsedPage views are built on demand for callers that still work on the
+    Pydantic schemas. They use model_construct(), skipping validation: every field comes from a
+    typed array and is already a valid int, float or str.
+    """
+
+    __slots__ = (
+        "texts", "x0", "y0", "x1", "y1", "page_indices",
+        "page_numbers", "page_widths", "page_heights", "page_offsets",
+        "word_starts", "word_char_offsets", "word_boxes",
+    )
+
+    def __init__(
+        self,
+        texts: List[str],
+        x0: np.ndarray,
+        y0: np.ndarray,
+        x1: np.ndarray,
+        y1: np.ndarray,
+        page_indices: np.ndarray,
+        page_numbers: np.ndarray,
+        page_widths: np.ndarray,
+        page_heights: np.ndarray,
+        word_starts: Optional[np.ndarray] = None,
+        word_char_offsets: Optional[np.ndarray] = None,
+        word_boxes: Optional[np.ndarray] = None,
+    ):
+        self.texts = texts
+        self.x0 = np.asarray(x0, dtype=np.float32)
+        self.y0 = np.asarray(y0, dtype=np.float32)
+        self.x1 = np.asarray(x1, dtype=np.float32)
+        self.y1 = np.asarray(y1, dtype=np.float32)
+        self.page_indices = np.asarray(page_indices, dtype=np.int32)
+        self.page_numbers = np.asarray(page_numbers, dtype=np.int32)
+        self.page_widths = np.asarray(page_widths, dtype=np.float32)
+        self.page_heights = np.asarray(page_heights, dtype=np.float32)
+        # page_offsets[p]:page_offsets[p + 1] is the element range of page p
+        self.page_offsets = np.searchsorted(self.page_indices, np.arange(len(self.page_numbers) + 1), side="left")
+        self.word_starts = None if word_starts is None else np.asarray(word_starts, dtype=np.int64)
+        self.word_char_offsets = None if word_char_offsets is None else np.asarray(word_char_offsets, dtype=np.int32)
+        self.word_boxes = None if word_boxes is None else np.asarray(word_boxes, dtype=np.float32).reshape(-1, 4)
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    @property
+    def num_pages(self) -> int:
+        return len(self.page_numbers)
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory used by the arrays and texts."""
+        arrays = [self.x0, self.y0, self.x1, self.y1, self.page_indices, self.page_numbers,
+                  self.page_widths, self.page_heights, self.page_offsets,
+                  self.word_starts, self.word_char_offsets, self.word_boxes]
+        return sum(a.nbytes for a in arrays if a is not None) + sum(len(text) for text in self.texts)
+
+    def element_page_numbers(self) -> np.ndarray:
+        """Page number of every element."""
+        return self.page_numbers[self.page_indices]
+
+    def elements(self, start: int = 0, end: Optional[int] = None) -> List[ParsedTextElement]:
+        """Builds ParsedTextElement views for elements [start, end) from the arrays (converted in bulk, not validated)."""
+        end = len(self.texts) if end is None else end
+        if end <= start:
+            return []
+        coords = np.round(
+            np.stack([self.x0[start:end], self.y0[start:end], self.x1[start:end], self.y1[start:end]], axis=1).astype(np.float64),
+            COORDINATE_DECIMALS,
+        ).tolist()
+        page_indices = self.page_indices[start:end]
+        page_numbers = self.page_numbers[page_indices].tolist()
+        page_widths = np.round(self.page_widths[page_indices].astype(np.float64), COORDINATE_DECIMALS).tolist()
+        page_heights = np.round(self.page_heights[page_indices].astype(np.float64), COORDINATE_DECIMALS).tolist()
+
+        word_offsets: List[Optional[List[int]]] = [None] * (end - start)
+        word_boxes: List[Optional[List[float]]] = [None] * (end - start)
+        if self.word_starts is not None:
+            first_word, last_word = int(self.word_starts[start]), int(self.word_starts[end])
+            all_offsets = self.word_char_offsets[first_word:last_word].tolist()
+            all_boxes = np.round(self.word_boxes[first_word:last_word].astype(np.float64), WORD_BOX_DECIMALS).ravel().tolist()
+            bounds = (self.word_starts[start:end + 1] - first_word).tolist()
+            for i in range(end - start):
+                word_offsets[i] = all_offsets[bounds[i]:bounds[i + 1]]
+                word_boxes[i] = all_boxes[4 * bounds[i]:4 * bounds[i + 1]]
+
+        return [
+            ParsedTextElement.model_construct(
+                text=self.texts[start + i],
+                x0=coords[i][0], y0=coords[i][1], x1=coords[i][2], y1=coords[i][3],
+                page_number=page_numbers[i],
+                page_width=page_widths[i],
+                page_height=page_heights[i],
+                word_offsets=word_offsets[i],
+                word_boxes=word_boxes[i],
+            )
+            for i in range(end - start)
+        ]
+
+    def page(self, page_index: int) -> ParsedPage:
+        """Builds a ParsedPage view (with element views) for one page."""
+        start, end = int(self.page_offsets[page_index]), int(self.page_offsets[page_index + 1])
+        return ParsedPage.model_construct(
+            page_number=int(self.page_numbers[page_index]),
+            width=round(float(self.page_widths[page_index]), COORDINATE_DECIMALS),
+            height=round(float(self.page_heights[page_index]), COORDINATE_DECIMALS),
+            elements=self.elements(start, end),
+        )
+
+    def to_parsed_pages(self) -> List[ParsedPage]:
+        """Builds ParsedPage views for every page, for callers that still expect List[ParsedPage]."""
+        return [self.page(page_index) for page_index in range(self.num_pages)]
+
+    @classmethod
+    def from_parsed_pages(cls, parsed_pages: Sequence[ParsedPage]) -> "ParsedDocument":
+        """Converts ParsedPage objects into the columnar form."""
+        builder = ParsedDocumentBuilder()
+        for page in parsed_pages:
+            builder.add_page(page.page_number, page.width, page.height)
+            for element in page.elements:
+                builder.add_element(element.text, element.x0, element.y0, element.x1, element.y1)
+        return builder.build()
+
+    def to_bytes(self) -> bytes:
+        """
+        Serializes the document into a compact binary blob (a compressed NumPy .npz archive).
+        Texts are stored as one UTF-8 buffer plus byte offsets; nothing is pickled.
+        """
+        encoded_texts = [text.encode("utf-8", "surrogatepass") for text in self.texts]
+        text_offsets = np.zeros(len(encoded_texts) + 1, dtype=np.int64)
+        np.cumsum([len(encoded) for encoded in encoded_texts], out=text_offsets[1:])
+        arrays = {name: getattr(self, name) for name in _ARRAY_FIELDS}
+        if self.word_starts is not None:
+            arrays.update({name: getattr(self, name) for name in _WORD_ARRAY_FIELDS})
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer,
+            format_version=np.array([SERIALIZATION_FORMAT_VERSION], dtype=np.int32),
+            text_data=np.frombuffer(b"".join(encoded_texts), dtype=np.uint8),
+            text_offsets=text_offsets,
+            **arrays,
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "ParsedDocument":
+        """
+        Inverse of to_bytes().
+
+        Raises:
+            ValueError: If the blob was written with a different format version or is corrupt.
+        """
+        with np.load(io.BytesIO(data), allow_pickle=False) as archive:
+            if int(archive["format_version"][0]) != SERIALIZATION_FORMAT_VERSION:
+                raise ValueError(f"Unsupported ParsedDocument format version {int(archive['format_version'][0])}.")
+            text_data = archive["text_data"].tobytes()
+            offsets = archive["text_offsets"].tolist()
+            texts = [text_data[offsets[i]:offsets[i + 1]].decode("utf-8", "surrogatepass") for i in range(len(offsets) - 1)]
+            arrays = {name: archive[name] for name in _ARRAY_FIELDS}
+            if "word_starts" in archive.files:
+                arrays.update({name: archive[name] for name in _WORD_ARRAY_FIELDS})
+        return cls(texts=texts, **arrays)
+
+    @classmethod
+    def concatenate(cls, documents: Sequence["ParsedDocument"]) -> "ParsedDocument":
+        """Joins documents covering consecutive page ranges (e.g. parsed in parallel) in order."""
+        if not documents:
+            return ParsedDocumentBuilder().build()
+        if len(documents) == 1:
+            return documents[0]
+        page_counts = np.array([document.num_pages for document in documents], dtype=np.int32)
+        page_shifts = np.concatenate(([0], np.cumsum(page_counts)[:-1])).astype(np.int32)
+        has_words = any(document.word_starts is not None for document in documents)
+        if has_words and not all(document.word_starts is not None for document in documents):
+            raise ValueError("Cannot concatenate coalesced and uncoalesced documents.")
+
+        word_starts = word_char_offsets = word_boxes = None
+        if has_words:
+            word_counts = [int(document.word_starts[-1]) for document in documents]
+            word_shifts = np.concatenate(([0], np.cumsum(word_counts)[:-1]))
+            word_starts = np.concatenate(
+                [document.word_starts[:-1] + shift for document, shift in zip(documents, word_shifts)] + [[sum(word_counts)]]
+            )
+            word_char_offsets = np.concatenate([document.word_char_offsets for document in documents])
+            word_boxes = np.concatenate([document.word_boxes for document in documents])
+
+        return cls(
+            texts=[text for document in documents for text in document.texts],
+            x0=np.concatenate([document.x0 for document in documents]),
+            y0=np.concatenate([document.y0 for document in documents]),
+            x1=np.concatenate([document.x1 for document in documents]),
+            y1=np.concatenate([document.y1 for document in documents]),
+            page_indices=np.concatenate(
+                [document.page_indices + shift for document, shift in zip(documents, page_shifts)]
+            ),
+            page_numbers=np.concatenate([document.page_numbers for document in documents]),
+            page_widths=np.concatenate([document.page_widths for document in documents]),
+            page_heights=np.concatenate([document.page_heights for document in documents]),
+            word_starts=word_starts,
+            word_char_offsets=word_char_offsets,
+            word_boxes=word_boxes,
+        )
+
+
+class ParsedDocumentBuilder:
+    """
+    Accumulates pages and elements into compact typed arrays (no per-element objects)
+    and produces a ParsedDocument. Parsers call add_page() then add_element() for each word.
+    """
+
+    def __init__(self):
+        self.texts: List[str] = []
+        self.x0 = array("f")
+        self.y0 = array("f")
+        self.x1 = array("f")
+        self.y1 = array("f")
+        self.page_indices = array("i")
+        self.page_numbers = array("i")
+        self.page_widths = array("f")
+        self.page_heights = array("f")
+
+    def add_page(self, page_number: int, width: float, height: float) -> None:
+        self.page_numbers.append(page_number)
+        self.page_widths.append(width)
+        self.page_heights.append(height)
+
+    def add_element(self, text: str, x0: float, y0: float, x1: float, y1: float) -> None:
+        """Adds an element to the most recently added page."""
+        self.texts.append(text)
+        self.x0.append(x0)
+        self.y0.append(y0)
+        self.x1.append(x1)
+        self.y1.append(y1)
+        self.page_indices.append(len(self.page_numbers) - 1)
+
+    def build(self) -> ParsedDocument:
+        return ParsedDocument(
+            texts=self.texts,
+            x0=np.frombuffer(self.x0, dtype=np.float32),
+            y0=np.frombuffer(self.y0, dtype=np.float32),
+            x1=np.frombuffer(self.x1, dtype=np.float32),
+            y1=np.frombuffer(self.y1, dtype=np.float32),
+            page_indices=np.frombuffer(self.page_indices, dtype=np.int32),
+            page_numbers=np.frombuffer(self.page_numbers, dtype=np.int32),
+            page_widths=np.frombuffer(self.page_widths, dtype=np.float32),
+            page_heights=np.frombuffer(self.page_heights, dtype=np.float32),
+        )
@@ -26,6 +26,7 @@ class TaskTypeEnum(str, Enum):
     MULTIMEDIA_INDEXING = "MULTIMEDIA_INDEXING"
     GOOGLE_DRIVE_PROCESSING = "GOOGLE_DRIVE_PROCESSING"
     GOOGLE_DRIVE_INDEXING = "GOOGLE_DRIVE_INDEXING"
+    EMBEDDING_BACKFILL = "EMBEDDING_BACKFILL"
     
 
 class TaskBase(BaseModel):
@@ -23,26 +23,164 @@
 # THE CURRENT IMPLEMENTATION STRICTLY ENSURES CHUNKS DO NOT SPAN PDF PAGES.
 
 
-import tiktoken
-from typing import List, Optional, Tuple
+from typing import Iterable, List, Optional, Tuple
 import logging
 from uuid import UUID
 
+import numpy as np
+
 from app.schemas.chunk import ParsedPage, ParsedTextElement, ChunkCreate, BoundingBox # BoundingBox might not be directly used here but good for context
+from app.schemas.parsed_document import ParsedDocument
+from app.services import tokenizer_service
+from app.services.tokenizer_service import count_tokens
 
 logger = logging.getLogger(__name__)
 
 # Default model for token counting, can be made configurable
-DEFAULT_TOKENIZER_MODEL = "cl100k_base"  # Used by text-embedding-ada-002
+DEFAULT_TOKENIZER_MODEL = tokenizer_service.DEFAULT_ENCODING_NAME  # Used by text-embedding-ada-002
+
+# Separator used when joining element texts into chunk text
+CHUNK_TEXT_SEPARATOR = " "
+
+def _count_element_tokens(
+    texts: List[str],
+    model_name: str = DEFAULT_TOKENIZER_MODEL
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Encodes every element text once (in two batch calls) and returns, per element:
+    - its token count on its own (used for the first element of a chunk and for overlap),
+    - its token count when preceded by CHUNK_TEXT_SEPARATOR (used when appended to a chunk).
+    """
+    own_counts = tokenizer_service.count_tokens_batch(texts, model_name)
+    joined_counts = tokenizer_service.count_tokens_batch([CHUNK_TEXT_SEPARATOR + text for text in texts], model_name)
+    return np.asarray(own_counts, dtype=np.int64), np.asarray(joined_counts, dtype=np.int64)
+
+def plan_chunk_boundaries(
+    texts: List[str],
+    page_numbers: np.ndarray,
+    own_counts: np.ndarray,
+    joined_counts: np.ndarray,
+    min_tokens_per_chunk: int,
+    max_tokens_per_chunk: int,
+    token_overlap: int,
+    is_final: bool = True
+) -> List[Tuple[int, int, int]]:
+    """
+    Plans chunk boundaries over a flat sequence of elements from per-element token counts.
+
+    tiktoken splits text into pieces on whitespace before applying BPE, so when an element
+    ends on a non-whitespace character, the tokens of "<a> <b>" are exactly the tokens of "<a>"
+    followed by those of " <b>". The token count of a chunk [s, e) is therefore
+    own[s] + sum(joined[s+1:e]), and with prefix sums of joined counts the end of the chunk
+    starting at *every* element is found with a single searchsorted call, clamped to the end of
+    that element's page. Overlap starts are found the same way from prefix sums of own counts.
+    Walking from element 0 then just follows the precomputed next-start links, which keeps
+    chunking linear in the number of elements.
+
+    Windows containing an element that ends in whitespace (or is empty) break the additivity
+    above; starts whose window contains one are planned by re-encoding the joined text.
+
+    Args:
+        texts: Element texts in document order.
+        page_numbers: Page number of each element.
+        own_counts: Token count of each element text on its own.
+        joined_counts: Token count of each element text preceded by CHUNK_TEXT_SEPARATOR.
+        min_tokens_per_chunk / max_tokens_per_chunk / token_overlap: As in chunk_parsed_pages.
+        is_final: Whether these elements end the document. Streaming callers pass False for every
+                  part but the last, so a short trailing chunk is skipped as it would be mid-document.
+
+    Returns:
+        A list of (start_index, end_index_exclusive, token_count) tuples, one per chunk to create.
+    """
+    total_elements = len(texts)
+    if total_elements == 0:
+        return []
+
+    # End (exclusive) of the page run each element belongs to. A page break is any change of page_number.
+    page_starts = np.flatnonzero(page_numbers[1:] != page_numbers[:-1]) + 1
+    run_ends = np.append(page_starts, total_elements)
+    run_lengths = np.diff(np.concatenate(([0], run_ends)))
+    page_ends = np.repeat(run_ends, run_lengths)
+
+    # joined_prefix[k] = sum(joined_counts[:k]); own_prefix likewise.
+    joined_prefix = np.concatenate(([0], np.cumsum(joined_counts)))
+    own_prefix = np.concatenate(([0], np.cumsum(own_counts)))
+    starts = np.arange(total_elements)
+
+    # Largest end e with own[s] + joined_prefix[e] - joined_prefix[s + 1] <= max_tokens_per_chunk.
+    targets = joined_prefix[starts + 1] + max_tokens_per_chunk - own_counts
+    ends = np.searchsorted(joined_prefix, targets, side="right") - 1
+    ends = np.minimum(ends, page_ends)
+    ends = np.maximum(ends, starts + 1) # An element larger than the limit becomes its own chunk
+    token_counts = own_counts + joined_prefix[ends] - joined_prefix[starts + 1]
+
+    # Starts whose window (including the element that stopped it) follows an element ending in whitespace.
+    unclean_tails = np.fromiter((not text or text[-1].isspace() for text in texts), dtype=bool, count=total_elements)
+    unclean_prefix = np.concatenate(([0], np.cumsum(unclean_tails)))
+    needs_exact = (unclean_prefix[ends] - unclean_prefix[starts]) > 0
+    needs_exact &= own_counts <= max_tokens_per_chunk
 
-def count_tokens(text: str, model_name: str = DEFAULT_TOKENIZER_MODEL) -> int:
-    """Counts tokens in a string using tiktoken for a specific model."""
-    try:
-        encoding = tiktoken.get_encoding(model_name)
-    except Exception:
-        logger.warning(f"Encoding '{model_name}' not found. Falling back to cl100k_base. Install tiktoken model if needed.")
-        encoding = tiktoken.get_encoding("cl100k_base") # Fallback
-    return len(encoding.encode(text))
+    # Overlap: number of trailing elements of [s, e) whose own counts sum to at most token_overlap.
+    if token_overlap > 0:
+        overlap_firsts = np.searchsorted(own_prefix, own_prefix[ends] - token_overlap, side="left")
+        overlap_elements = np.maximum(ends - np.maximum(overlap_firsts, starts), 1)
+        next_starts = np.where(ends - starts > 1, ends - overlap_elements, ends)
+    else:
+        next_starts = ends.copy()
+    next_starts = np.maximum(next_starts, starts + 1) # Always advance to prevent infinite loops
+
+    def plan_exact(start: int) -> Tuple[int, int, int]:
+        """Scalar planning for a start whose window is not token-additive."""
+        end = start + 1
+        token_count = int(own_counts[start])
+        page_end = int(page_ends[start])
+        while end < page_end:
+            potential_token_count = count_tokens(CHUNK_TEXT_SEPARATOR.join(texts[start:end + 1]))
+            if potential_token_count > max_tokens_per_chunk:
+                break
+            token_count = potential_token_count
+            end += 1
+        next_start = end
+        if token_overlap > 0 and end - start > 1:
+            overlap_count = 0
+            for i in range(end - 1, start - 1, -1):
+                overlap_count += int(own_counts[i])
+                if overlap_count > token_overlap:
+                    break
+            else:
+                i = start - 1
+            next_start = end - max(1, end - 1 - i)
+        return end, token_count, max(next_start, start + 1)
+
+    ends_list = ends.tolist()
+    token_counts_list = token_counts.tolist()
+    next_starts_list = next_starts.tolist()
+    needs_exact_list = needs_exact.tolist()
+
+    planned: List[Tuple[int, int, int]] = []
+    start_index = 0
+    while start_index < total_elements:
+        if needs_exact_list[start_index]:
+            end_index, token_count, next_start = plan_exact(start_index)
+        else:
+            end_index = ends_list[start_index]
+            token_count = token_counts_list[start_index]
+            next_start = next_starts_list[start_index]
+
+        if token_count < min_tokens_per_chunk and (end_index < total_elements or not is_final):
+            logger.debug(f"[Chunking] Skipping chunk with {token_count} tokens (below minimum) at start_index={start_index}")
+            start_index = end_index # Skip this chunk and all its elements
+            continue
+
+        if token_count > max_tokens_per_chunk:
+            logger.warning(
+                f"Element '{texts[start_index][:50]}...' on page {page_numbers[start_index]} exceeds max_tokens_per_chunk of {max_tokens_per_chunk}. "
+                f"Storing it as a single chunk. Consider increasing max_tokens or pre-processing large elements."
+            )
+        planned.append((start_index, end_index, token_count))
+        start_index = next_start
+
+    return planned
 
 def chunk_parsed_pages(
     parsed_pages: List[ParsedPage],
@@ -57,6 +195,9 @@ def chunk_parsed_pages(
     Chunks text from parsed pages into manageable pieces based on token limits,
     ensuring chunks do not span pages and include their constituent elements.
 
+    Each element is encoded once up front; chunk boundaries and overlaps are then
+    planned from prefix sums of the per-element token counts (see plan_chunk_boundaries).
+
     Args:
         parsed_pages: List of ParsedPage objects from the parsing service.
         reference_id: UUID of the parent reference.
@@ -69,9 +210,6 @@ def chunk_parsed_pages(
     Returns:
         A list of ChunkCreate objects ready for embedding and database insertion.
     """
-    all_chunks: List[ChunkCreate] = []
-    # token_overlap = 0
-    
     # Flatten all elements from all pages into a single list, keeping page context
     # Each element in ParsedTextElement already has its page_number, page_width, page_height
     all_elements: List[ParsedTextElement] = []
@@ -82,119 +220,133 @@ def chunk_parsed_pages(
         logger.warning(f"No text elements found to chunk for Reference ID: {reference_id}")
         return []
 
-    current_chunk_elements: List[ParsedTextElement] = []
-    current_chunk_text_parts: List[str] = [] # To build current_chunk_text efficiently
-    current_token_count = 0
-    start_index = 0
+    texts = [element.text for element in all_elements]
+    page_numbers = np.fromiter((element.page_number for element in all_elements), dtype=np.int64, count=len(all_elements))
+    own_counts, joined_counts = _count_element_tokens(texts)
 
-    while start_index < len(all_elements):
-        logger.debug(f"[Chunking] Loop start: start_index={start_index}, total_elements={len(all_elements)}")
-        prev_start_index = start_index
-
-        # Reset for the new chunk
-        current_chunk_elements = []
-        current_chunk_text_parts = []
-        current_token_count = 0
-        chunk_page_number = -1 
-        chunk_page_width = -1.0
-        chunk_page_height = -1.0
-        temp_chunk_text_for_overlap_calculation = ""
-        elements_for_current_chunk_iteration: List[ParsedTextElement] = []
-
-        for i in range(start_index, len(all_elements)):
-            element = all_elements[i]
-
-            if not current_chunk_elements: # First element of a potential new chunk
-                chunk_page_number = element.page_number
-                chunk_page_width = element.page_width
-                chunk_page_height = element.page_height
-            elif element.page_number != chunk_page_number: # Page break detected
-                break # Finalize current chunk, new chunk will start on new page
-
-            potential_new_text_parts = current_chunk_text_parts + [element.text]
-            potential_full_text = " ".join(potential_new_text_parts) # Join with space, adjust if elements are lines
-            potential_token_count = count_tokens(potential_full_text)
-
-            if potential_token_count <= max_tokens_per_chunk:
-                current_chunk_text_parts.append(element.text)
-                current_chunk_elements.append(element)
-                current_token_count = potential_token_count
-                elements_for_current_chunk_iteration.append(element)
-            else:
-                # Current element would make chunk too large, so current_chunk_elements is complete
-                # (unless it's empty, meaning the single element itself is too large)
-                if not current_chunk_elements: # Single element is too large
-                    logger.warning(
-                        f"Element '{element.text[:50]}...' on page {element.page_number} exceeds max_tokens_per_chunk of {max_tokens_per_chunk}. "
-                        f"Storing it as a single chunk. Consider increasing max_tokens or pre-processing large elements."
-                    )
-                    current_chunk_text_parts.append(element.text)
-                    current_chunk_elements.append(element)
-                    current_token_count = count_tokens(element.text) # Recount for just this one
-                    elements_for_current_chunk_iteration.append(element)
-                    # This large element forms its own chunk, then we advance past it
-                break # Finalize chunk with elements up to this point (exclusive of current element if it caused overflow)
-        
-        if current_chunk_elements: # If any elements were added to this chunk
-            final_chunk_text = " ".join(current_chunk_text_parts)
-            final_token_count = count_tokens(final_chunk_text)
-            if final_token_count > max_tokens_per_chunk and len(current_chunk_elements) > 1:
-                logger.warning(f"Chunk for page {chunk_page_number} slightly exceeded token limit ({final_token_count}/{max_tokens_per_chunk}) after joining. Consider review.")
-
-            logger.debug(f"[Chunking] Created chunk: page={chunk_page_number}, elements_in_chunk={len(current_chunk_elements)}, start_index={start_index}")
-
-            # --- MINIMUM TOKEN CHECK ---
-            if final_token_count < min_tokens_per_chunk and start_index + len(current_chunk_elements) < len(all_elements):
-                logger.debug(f"[Chunking] Skipping chunk with {final_token_count} tokens (below minimum) at start_index={start_index}")
-                # Skip this chunk and all its elements
-                start_index = prev_start_index + len(current_chunk_elements)
-                continue  # Skip appending this chunk
-
-            # Only append if it passes the minimum token check
-            chunk = ChunkCreate(
-                reference_id=reference_id,
-                user_id=user_id,
-                chatbot_id=chatbot_id,
-                page_number=chunk_page_number,
-                chunk_text=final_chunk_text,
-                token_count=final_token_count,
-                constituent_elements=current_chunk_elements,
-                parser_metadata=None
-            )
-            all_chunks.append(chunk)
-
-            # --- OVERLAP LOGIC ---
-            if token_overlap > 0 and len(current_chunk_elements) > 1:
-                overlap_token_count = 0
-                overlap_elements = 0
-                for elem in reversed(current_chunk_elements):
-                    overlap_token_count += count_tokens(elem.text)
-                    if overlap_token_count > token_overlap:
-                        break
-                    overlap_elements += 1
-                overlap_elements = max(1, overlap_elements)
-                start_index = prev_start_index + len(current_chunk_elements) - overlap_elements
-            else:
-                start_index = prev_start_index + len(current_chunk_elements)
-
-            logger.debug(f"[Chunking] Advancing start_index: prev={prev_start_index}, new={start_index}")
-            if start_index <= prev_start_index:
-                logger.warning(f"[Chunking] start_index did not advance (prev={prev_start_index}, new={start_index}). Forcing increment to prevent infinite loop.")
-                start_index = prev_start_index + 1
-        elif start_index < len(all_elements):  # No elements added, but not at the end
-            problematic_element = all_elements[start_index]
-            logger.warning(
-                f"[Chunking] No elements added to chunk at start_index={start_index}. "
-                f"Skipping element: '{problematic_element.text[:50]}...' (page {problematic_element.page_number}) "
-                f"and advancing by 1 to prevent infinite loop."
-            )
-            start_index += 1  # Always advance by 1 if nothing could be chunked
-        else:  # No elements added and at the end
-            break
+    planned_chunks = plan_chunk_boundaries(
+        texts, page_numbers, own_counts, joined_counts,
+        min_tokens_per_chunk, max_tokens_per_chunk, token_overlap
+    )
+
+    all_chunks: List[ChunkCreate] = []
+    for start_index, end_index, token_count in planned_chunks:
+        all_chunks.append(ChunkCreate(
+            reference_id=reference_id,
+            user_id=user_id,
+            chatbot_id=chatbot_id,
+            page_number=all_elements[start_index].page_number,
+            chunk_text=CHUNK_TEXT_SEPARATOR.join(texts[start_index:end_index]),
+            token_count=token_count,
+            constituent_elements=all_elements[start_index:end_index],
+            parser_metadata=None
+        ))
 
     logger.info(f"Generated {len(all_chunks)} chunks for Reference ID: {reference_id} with max_tokens={max_tokens_per_chunk}, overlap={token_overlap}.")
     return all_chunks
 
+def _chunks_from_document(
+    document: ParsedDocument,
+    reference_id: UUID,
+    user_id: UUID,
+    chatbot_id: UUID,
+    min_tokens_per_chunk: int,
+    max_tokens_per_chunk: int,
+    token_overlap: int,
+    is_final: bool
+) -> List[ChunkCreate]:
+    """Plans and builds the chunks of one ParsedDocument (a whole document or one streamed part)."""
+    texts = document.texts
+    page_numbers = document.element_page_numbers()
+    own_counts, joined_counts = _count_element_tokens(texts)
+
+    planned_chunks = plan_chunk_boundaries(
+        texts, page_numbers, own_counts, joined_counts,
+        min_tokens_per_chunk, max_tokens_per_chunk, token_overlap, is_final
+    )
+
+    element_views = document.elements() if planned_chunks else []
+    chunk_page_numbers = page_numbers.tolist()
+    chunks: List[ChunkCreate] = []
+    for start_index, end_index, token_count in planned_chunks:
+        chunks.append(ChunkCreate(
+            reference_id=reference_id,
+            user_id=user_id,
+            chatbot_id=chatbot_id,
+            page_number=chunk_page_numbers[start_index],
+            chunk_text=CHUNK_TEXT_SEPARATOR.join(texts[start_index:end_index]),
+            token_count=token_count,
+            constituent_elements=element_views[start_index:end_index],
+            parser_metadata=None
+        ))
+    return chunks
+
+def chunk_parsed_document(
+    document: ParsedDocument,
+    reference_id: UUID,
+    user_id: UUID,
+    chatbot_id: UUID,
+    min_tokens_per_chunk: int = 30,
+    max_tokens_per_chunk: int = 400,
+    token_overlap: int = 50
+) -> List[ChunkCreate]:
+    """
+    Same as chunk_parsed_pages, working directly on the columnar ParsedDocument arrays:
+    texts and element page numbers feed plan_chunk_boundaries without building any
+    per-element objects. ParsedTextElement views are created once per element (not once
+    per chunk, so overlapping chunks share them) only after planning.
+
+    Returns:
+        A list of ChunkCreate objects ready for embedding and database insertion.
+    """
+    return chunk_parsed_document_stream(
+        [document], reference_id, user_id, chatbot_id,
+        min_tokens_per_chunk, max_tokens_per_chunk, token_overlap
+    )
+
+def chunk_parsed_document_stream(
+    documents: Iterable[ParsedDocument],
+    reference_id: UUID,
+    user_id: UUID,
+    chatbot_id: UUID,
+    min_tokens_per_chunk: int = 30,
+    max_tokens_per_chunk: int = 400,
+    token_overlap: int = 50
+) -> List[ChunkCreate]:
+    """
+    Chunks a document delivered as consecutive whole-page parts (e.g. from
+    pdf_parsing_service.parse_pdf_iter), consuming one part at a time so the
+    parsed pages never need to be held together. Since chunks never span pages,
+    the result is the same as chunking the concatenated document.
+
+    Returns:
+        A list of ChunkCreate objects ready for embedding and database insertion.
+    """
+    all_chunks: List[ChunkCreate] = []
+    total_pages = 0
+    total_elements = 0
+
+    # One part of lookahead: only the last part may keep a short trailing chunk
+    non_empty_parts = (document for document in documents if len(document) > 0)
+    current = next(non_empty_parts, None)
+    while current is not None:
+        following = next(non_empty_parts, None)
+        all_chunks.extend(_chunks_from_document(
+            current, reference_id, user_id, chatbot_id,
+            min_tokens_per_chunk, max_tokens_per_chunk, token_overlap,
+            is_final=following is None
+        ))
+        total_pages += current.num_pages
+        total_elements += len(current)
+        current = following
+
+    if total_elements == 0:
+        logger.warning(f"No text elements found to chunk for Reference ID: {reference_id}")
+        return []
+
+    logger.info(f"Generated {len(all_chunks)} chunks from {total_elements} elements on {total_pages} pages with text for Reference ID: {reference_id} with max_tokens={max_tokens_per_chunk}, overlap={token_overlap}.")
+    return all_chunks
+
 # Example Usage (for testing this module directly)
 # if __name__ == '__main__':
 #     logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -0,0 +1,104 @@
+# CIRCUIT BREAKER FOR UPSTREAM APIS
+#
+# During an upstream outage, every call used to sleep through its retries (holding a Celery slot)
+# and the task then failed, throwing away its parsing and chunking work. Calls now go through a
+# circuit breaker shared by all workers through Redis:
+#
+# - Closed: calls proceed. Connection errors, timeouts and 5xx responses are counted over a
+#   CIRCUIT_BREAKER_WINDOW_SECONDS window; CIRCUIT_BREAKER_FAILURE_THRESHOLD of them trip it.
+# - Open (for CIRCUIT_BREAKER_OPEN_SECONDS): check() raises CircuitOpenError straight away, with the
+#   remaining open time as retry_after. Tasks checkpoint their work and requeue themselves with a
+#   Celery countdown instead of sleeping.
+# - Half-open: once the open period ends, calls proceed again, but for one more window a single
+#   failure re-opens the breaker. A success closes it fully.
+# - If Redis is unavailable the breaker stays closed (callers keep their own retry handling).
+
+import logging
+
+import openai
+import redis
+
+from app.core.config import settings
+from app.core.redis_client import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "syllabi:circuit"
+OPENAI_CIRCUIT = "openai"
+
+# KEYS[1]: failure counter. ARGV[1]: window in seconds. Counting and starting the window happen in
+# one step, so a worker dying in between cannot leave a counter that never expires (a counter
+# without a TTL, e.g. from an older version, gets one on its next failure).
+# Returns the failure count.
+_INCR_FAILURES_SCRIPT = """
+local failures = redis.call('INCR', KEYS[1])
+if redis.call('TTL', KEYS[1]) < 0 then
+    redis.call('EXPIRE', KEYS[1], tonumber(ARGV[1]))
+end
+return failures
+"""
+
+_incr_failures_script = None
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream API whose circuit breaker is open."""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"Circuit breaker '{name}' is open; retry in {retry_after:.0f}s.")
+        self.name = name
+        self.retry_after = retry_after
+
+
+def _key(name: str, part: str) -> str:
+    return f"{KEY_PREFIX}:{name}:{part}"
+
+
+def is_breaker_failure(error: Exception) -> bool:
+    """True for errors that indicate an upstream outage (as opposed to a bad request or rate limit)."""
+    if isinstance(error, openai.APIConnectionError): # Includes APITimeoutError
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+def check(name: str = OPENAI_CIRCUIT) -> None:
+    """Raises CircuitOpenError if the breaker is open."""
+    try:
+        remaining_ms = get_redis_client().pttl(_key(name, "open"))
+    except redis.RedisError as e:
+        logger.warning(f"Circuit breaker '{name}' unavailable ({e}); treating it as closed.")
+        return
+    if remaining_ms > 0:
+        raise CircuitOpenError(name, remaining_ms / 1000)
+
+
+def record_success(name: str = OPENAI_CIRCUIT) -> None:
+    """Closes the breaker fully (clears the failure count and the half-open state)."""
+    try:
+        get_redis_client().delete(_key(name, "failures"), _key(name, "half_open"))
+    except redis.RedisError as e:
+        logger.warning(f"Could not record success on circuit breaker '{name}': {e}")
+
+
+def record_failure(name: str = OPENAI_CIRCUIT) -> bool:
+    """Counts an outage failure. Returns True if this failure tripped the breaker open."""
+    try:
+        global _incr_failures_script
+        client = get_redis_client()
+        if _incr_failures_script is None or _incr_failures_script.registered_client is not client:
+            _incr_failures_script = client.register_script(_INCR_FAILURES_SCRIPT)
+        failures_key = _key(name, "failures")
+        failures = int(_incr_failures_script(keys=[failures_key], args=[settings.CIRCUIT_BREAKER_WINDOW_SECONDS]))
+        if failures < settings.CIRCUIT_BREAKER_FAILURE_THRESHOLD and not client.exists(_key(name, "half_open")):
+            return False
+
+        pipeline = client.pipeline(transaction=True)
+        pipeline.set(_key(name, "open"), "1", ex=settings.CIRCUIT_BREAKER_OPEN_SECONDS)
+        pipeline.set(_key(name, "half_open"), "1", ex=settings.CIRCUIT_BREAKER_OPEN_SECONDS + settings.CIRCUIT_BREAKER_WINDOW_SECONDS)
+        pipeline.delete(failures_key)
+        pipeline.execute()
+        logger.error(f"Circuit breaker '{name}' opened for {settings.CIRCUIT_BREAKER_OPEN_SECONDS}s after repeated upstream failures.")
+        return True
+    except redis.RedisError as e:
+        logger.warning(f"Could not record failure on circuit breaker '{name}': {e}")
+        return False
@@ -8,12 +8,15 @@ from openai import AsyncOpenAI, OpenAIError # Import OpenAIError for better exce
 from app.schemas.llm_extraction import ExtractedMetadata
 from app.core.config import settings
 from app.schemas.reference import ItemTypeEnum
+from app.services import tokenizer_service
 
 logger = logging.getLogger(__name__)
 
 # Max characters to send to LLM in one go (approx ~25k-30k tokens for GPT-4o, well within 128k token limit)
 # This can be adjusted based on testing and cost considerations.
 LLM_MAX_TEXT_SNIPPET_CHARS = 100000 
+# Token cap applied after the character cap, so dense text (tables, non-Latin scripts) stays bounded too.
+LLM_MAX_TEXT_SNIPPET_TOKENS = 30000
 
 class CitationExtractionService:
     def __init__(self):
@@ -106,7 +109,10 @@ class CitationExtractionService:
             "Do not set `needs_more_context` to True solely for missing minor/optional fields if the core information is reasonably covered."
         )
         
-        user_prompt_content = f"Please extract metadata from the following text document snippet:\n\n---\n{text_snippet[:LLM_MAX_TEXT_SNIPPET_CHARS]}"
+        bounded_snippet = tokenizer_service.truncate_to_tokens(
+            text_snippet[:LLM_MAX_TEXT_SNIPPET_CHARS], LLM_MAX_TEXT_SNIPPET_TOKENS, self.llm_model_name
+        )
+        user_prompt_content = f"Please extract metadata from the following text document snippet:\n\n---\n{bounded_snippet}"
 
         try:
             response = await self.client.beta.chat.completions.parse(
@@ -0,0 +1,181 @@
+# ELEMENT COALESCING
+#
+# pdfplumber emits one ParsedTextElement per word, so a long PDF turns into hundreds of thousands
+# of tiny elements that every later stage (chunking, model_dump, JSONB storage) has to handle.
+# This optional stage merges consecutive words into line elements, and optionally lines into block
+# elements, using the word boxes the parser already returned.
+#
+# - Merged element text is the word texts joined with a single space, so chunk text built from
+#   lines is the same text that would be built from the words they contain.
+# - Each merged element keeps where its words start (word_offsets) and their boxes (word_boxes,
+#   flattened [x0, y0, x1, y1]) so highlights can still be drawn per word.
+# - Chunk boundaries fall on line/block boundaries instead of word boundaries.
+# - Grouping walks plain coordinate lists; the merge itself (bounding boxes, word side arrays)
+#   is done with NumPy on the columnar ParsedDocument, so no per-element objects are built.
+
+import logging
+from typing import List
+
+import numpy as np
+
+from app.schemas.chunk import ParsedPage
+from app.schemas.parsed_document import ParsedDocument
+
+logger = logging.getLogger(__name__)
+
+GRANULARITY_WORD = "word"
+GRANULARITY_LINE = "line"
+GRANULARITY_BLOCK = "block"
+SUPPORTED_GRANULARITIES = (GRANULARITY_WORD, GRANULARITY_LINE, GRANULARITY_BLOCK)
+
+WORD_SEPARATOR = " "
+
+# Line merging: words must overlap vertically by this fraction of the smaller height...
+LINE_MIN_VERTICAL_OVERLAP = 0.5
+# ...must not step back to the left by more than this many points...
+LINE_MAX_BACKTRACK = 1.0
+# ...and must not be further right than this many line heights (column/table gaps).
+LINE_MAX_GAP_IN_LINE_HEIGHTS = 3.0
+
+# Block merging: vertical gap between lines, in line heights of the previous line.
+BLOCK_MAX_GAP_IN_LINE_HEIGHTS = 0.8
+# Lines whose heights differ by more than this ratio (e.g. heading vs body) start a new block.
+BLOCK_MAX_HEIGHT_RATIO = 1.3
+# Upper bound on block text length, so blocks stay well below chunk token limits.
+BLOCK_MAX_CHARS = 600
+
+
+def _continues_line(line_y0: float, line_y1: float, last_x1: float, x0: float, y0: float, y1: float) -> bool:
+    line_height = line_y1 - line_y0
+    word_height = y1 - y0
+    overlap = min(line_y1, y1) - max(line_y0, y0)
+    if overlap < LINE_MIN_VERTICAL_OVERLAP * min(line_height, word_height):
+        return False
+    gap = x0 - last_x1
+    return -LINE_MAX_BACKTRACK <= gap <= LINE_MAX_GAP_IN_LINE_HEIGHTS * max(line_height, word_height)
+
+
+def _continues_block(block_x0: float, block_x1: float, block_chars: int,
+                     previous_y0: float, previous_y1: float,
+                     x0: float, y0: float, x1: float, y1: float, text_length: int) -> bool:
+    previous_height = previous_y1 - previous_y0
+    line_height = y1 - y0
+    if previous_height <= 0 or line_height <= 0:
+        return False
+    if max(previous_height, line_height) / min(previous_height, line_height) > BLOCK_MAX_HEIGHT_RATIO:
+        return False
+    vertical_gap = y0 - previous_y1
+    if vertical_gap < -0.5 * previous_height or vertical_gap > BLOCK_MAX_GAP_IN_LINE_HEIGHTS * previous_height:
+        return False
+    if min(block_x1, x1) <= max(block_x0, x0): # No horizontal overlap
+        return False
+    return block_chars + len(WORD_SEPARATOR) + text_length <= BLOCK_MAX_CHARS
+
+
+def _line_group_starts(document: ParsedDocument) -> List[int]:
+    """Returns the index of the first word of every line."""
+    x0s, y0s, x1s, y1s = (document.x0.tolist(), document.y0.tolist(), document.x1.tolist(), document.y1.tolist())
+    page_indices = document.page_indices.tolist()
+    group_starts: List[int] = []
+    line_y0 = line_y1 = last_x1 = 0.0
+    for i in range(len(document)):
+        if group_starts and page_indices[i] == page_indices[i - 1] and \
+                _continues_line(line_y0, line_y1, last_x1, x0s[i], y0s[i], y1s[i]):
+            line_y0, line_y1, last_x1 = min(line_y0, y0s[i]), max(line_y1, y1s[i]), x1s[i]
+            continue
+        group_starts.append(i)
+        line_y0, line_y1, last_x1 = y0s[i], y1s[i], x1s[i]
+    return group_starts
+
+
+def _block_group_starts(document: ParsedDocument) -> List[int]:
+    """Returns the index of the first line of every block."""
+    x0s, y0s, x1s, y1s = (document.x0.tolist(), document.y0.tolist(), document.x1.tolist(), document.y1.tolist())
+    page_indices = document.page_indices.tolist()
+    texts = document.texts
+    group_starts: List[int] = []
+    block_x0 = block_x1 = 0.0
+    block_chars = 0
+    for i in range(len(document)):
+        if group_starts and page_indices[i] == page_indices[i - 1] and \
+                _continues_block(block_x0, block_x1, block_chars, y0s[i - 1], y1s[i - 1],
+                                 x0s[i], y0s[i], x1s[i], y1s[i], len(texts[i])):
+            block_x0, block_x1 = min(block_x0, x0s[i]), max(block_x1, x1s[i])
+            block_chars += len(WORD_SEPARATOR) + len(texts[i])
+            continue
+        group_starts.append(i)
+        block_x0, block_x1, block_chars = x0s[i], x1s[i], len(texts[i])
+    return group_starts
+
+
+def _merge_groups(document: ParsedDocument, group_starts: List[int]) -> ParsedDocument:
+    """
+    Merges each run of consecutive elements [group_starts[g], group_starts[g + 1]) into one element.
+    Word offsets of the merged elements are shifted by where each element lands in the joined text.
+    """
+    num_elements = len(document)
+    starts = np.asarray(group_starts, dtype=np.int64)
+    bounds = np.append(starts, num_elements)
+
+    texts = [WORD_SEPARATOR.join(document.texts[a:b]) for a, b in zip(bounds[:-1].tolist(), bounds[1:].tolist())]
+
+    if document.word_starts is None: # Every element is a single word starting at offset 0
+        word_starts = np.arange(num_elements + 1, dtype=np.int64)
+        word_char_offsets = np.zeros(num_elements, dtype=np.int32)
+        word_boxes = np.stack([document.x0, document.y0, document.x1, document.y1], axis=1)
+    else:
+        word_starts, word_char_offsets, word_boxes = document.word_starts, document.word_char_offsets, document.word_boxes
+
+    # Character position of each element inside its merged text
+    text_lengths = np.fromiter((len(text) for text in document.texts), dtype=np.int64, count=num_elements)
+    positions = np.concatenate(([0], np.cumsum(text_lengths + len(WORD_SEPARATOR))))
+    group_of_element = np.repeat(np.arange(len(starts)), np.diff(bounds))
+    element_shift = positions[:-1] - positions[starts][group_of_element]
+    word_char_offsets = word_char_offsets + np.repeat(element_shift, np.diff(word_starts)).astype(np.int32)
+
+    return ParsedDocument(
+        texts=texts,
+        x0=np.minimum.reduceat(document.x0, starts),
+        y0=np.minimum.reduceat(document.y0, starts),
+        x1=np.maximum.reduceat(document.x1, starts),
+        y1=np.maximum.reduceat(document.y1, starts),
+        page_indices=document.page_indices[starts],
+        page_numbers=document.page_numbers,
+        page_widths=document.page_widths,
+        page_heights=document.page_heights,
+        word_starts=word_starts[bounds],
+        word_char_offsets=word_char_offsets,
+        word_boxes=word_boxes,
+    )
+
+
+def coalesce_document(document: ParsedDocument, granularity: str = GRANULARITY_LINE) -> ParsedDocument:
+    """
+    Merges word elements of each page into line (or block) elements.
+
+    Args:
+        document: Columnar document as returned by pdf_parsing_service (one element per word).
+        granularity: "word" (no-op), "line", or "block".
+
+    Returns:
+        A new ParsedDocument with coalesced elements.
+    """
+    if granularity == GRANULARITY_WORD or len(document) == 0:
+        return document
+    if granularity not in SUPPORTED_GRANULARITIES:
+        logger.error(f"Unsupported element granularity: {granularity}. Leaving elements as words.")
+        return document
+
+    coalesced = _merge_groups(document, _line_group_starts(document))
+    if granularity == GRANULARITY_BLOCK:
+        coalesced = _merge_groups(coalesced, _block_group_starts(coalesced))
+
+    logger.debug(f"Coalesced {len(document)} word elements into {len(coalesced)} {granularity} elements across {document.num_pages} pages.")
+    return coalesced
+
+
+def coalesce_parsed_pages(parsed_pages: List[ParsedPage], granularity: str = GRANULARITY_LINE) -> List[ParsedPage]:
+    """Same as coalesce_document, for callers that work on List[ParsedPage]."""
+    if granularity == GRANULARITY_WORD:
+        return parsed_pages
+    return coalesce_document(ParsedDocument.from_parsed_pages(parsed_pages), granularity).to_parsed_pages()
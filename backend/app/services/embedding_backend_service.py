@@ -0,0 +1,152 @@
+# EMBEDDING BACKENDS
+#
+# Both embedding services used to be hard-wired to OpenAI, so every chunk paid a network round trip
+# and nothing could be indexed without API access. Embeddings now come from a backend:
+#
+# - "openai": the existing path (embedding_service / MultimediaEmbeddingService), with request
+#   packing, rate governor, circuit breaker and micro-batching.
+# - "local": a sentence-transformers model (LOCAL_EMBEDDING_MODEL) run on CPU in this worker process,
+#   with the PyTorch or ONNX Runtime runtime (LOCAL_EMBEDDING_RUNTIME). The model is loaded once per
+#   process and texts are encoded in batches of LOCAL_EMBEDDING_BATCH_SIZE on
+#   LOCAL_EMBEDDING_THREADS threads, so throughput depends on our own cores instead of API latency
+#   and quota. Vectors are L2-normalised like OpenAI's.
+#
+# The backend is EMBEDDING_BACKEND, for the whole deployment. Caveats:
+# - document_chunks.embedding has one fixed dimension, and chunks of all chatbots are searched in
+#   the same vector space, so backends cannot be mixed per chatbot.
+# - The local model must output the column's dimensions (embedding_profile_service.column_dimensions;
+#   set EMBEDDING_COLUMN_DIMENSIONS after migrating the column). Loading a model that does not fails
+#   before anything is embedded.
+# - Chat retrieval in the frontend (frontend/src/app/api/chat/) embeds queries with OpenAI's
+#   text-embedding-3-small. Chunks embedded locally can only be retrieved once query embedding
+#   there uses the same model as LOCAL_EMBEDDING_MODEL.
+# - The embedding cache and checkpoints key local embeddings under "local:<model>", so they never
+#   mix with OpenAI ones.
+#
+# sentence-transformers (and onnxruntime for the ONNX runtime) are only needed when the local
+# backend is used: pip install "sentence-transformers[onnx]".
+
+import logging
+import os
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.core.config import settings
+from app.services import embedding_profile_service
+
+logger = logging.getLogger(__name__)
+
+OPENAI_BACKEND = "openai"
+LOCAL_BACKEND = "local"
+BACKENDS = (OPENAI_BACKEND, LOCAL_BACKEND)
+RUNTIMES = ("torch", "onnx")
+
+_lock = threading.Lock()
+_local_backends: Dict[Tuple[int, str, str], "LocalEmbeddingBackend"] = {}
+
+
+class EmbeddingBackend(ABC):
+    """Interface of an embedding backend: embeds texts into float32 vectors."""
+
+    name: str = ""
+    dimensions: Optional[int] = None # Requested output dimensions, if not the model's default (part of cache keys)
+
+    @property
+    @abstractmethod
+    def cache_model(self) -> str:
+        """Identifies the model in embedding cache and checkpoint keys."""
+
+    @abstractmethod
+    def embed(self, texts: List[str], token_counts: List[int]) -> List[Optional[np.ndarray]]:
+        """Returns one float32 embedding per text, in order; None for texts that failed."""
+
+
+def resolve_backend() -> str:
+    """Returns the backend to embed content with (settings.EMBEDDING_BACKEND)."""
+    backend = settings.EMBEDDING_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown embedding backend '{backend}'. Use one of {BACKENDS}.")
+    return backend
+
+
+def get_local_thread_count() -> int:
+    """
+    Threads for local inference (settings.LOCAL_EMBEDDING_THREADS). 0 means auto: the CPU cores
+    available to this container shared between the WORKER_CONCURRENCY Celery worker processes.
+    """
+    if settings.LOCAL_EMBEDDING_THREADS > 0:
+        return settings.LOCAL_EMBEDDING_THREADS
+    available_cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    return max(1, available_cores // max(1, settings.WORKER_CONCURRENCY))
+
+
+class LocalEmbeddingBackend(EmbeddingBackend):
+    """A sentence-transformers model run on CPU in this process."""
+
+    name = LOCAL_BACKEND
+
+    def __init__(self, model_name: str, runtime: str):
+        if runtime not in RUNTIMES:
+            raise ValueError(f"Unknown LOCAL_EMBEDDING_RUNTIME '{runtime}'. Use one of {RUNTIMES}.")
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise RuntimeError(
+                "The local embedding backend requires sentence-transformers: pip install \"sentence-transformers[onnx]\""
+            ) from e
+
+        threads = get_local_thread_count()
+        model_kwargs = {}
+        if runtime == "onnx":
+            import onnxruntime
+            session_options = onnxruntime.SessionOptions()
+            session_options.intra_op_num_threads = threads
+            model_kwargs = {"provider": "CPUExecutionProvider", "session_options": session_options}
+        else:
+            import torch
+            torch.set_num_threads(threads)
+
+        logger.info(f"Loading local embedding model '{model_name}' ({runtime} runtime, {threads} threads).")
+        self.model_name = model_name
+        self.model = SentenceTransformer(model_name, device="cpu", backend=runtime, model_kwargs=model_kwargs or None)
+        model_dimensions = self.model.get_sentence_embedding_dimension()
+        column_dimensions = embedding_profile_service.column_dimensions()
+        if column_dimensions is not None and model_dimensions != column_dimensions:
+            raise ValueError(
+                f"Local embedding model '{model_name}' outputs {model_dimensions} dimensions, but the embedding column is "
+                f"{embedding_profile_service.column_type()}. Migrate the column to {model_dimensions} dimensions "
+                f"(sql/migrate_document_chunks_embedding_profile.sql) and set EMBEDDING_COLUMN_DIMENSIONS={model_dimensions}."
+            )
+        logger.info(f"Local embedding model '{model_name}' loaded ({model_dimensions} dimensions).")
+        logger.warning("Chat retrieval in the frontend embeds queries with OpenAI; chunks embedded locally are only found once it uses the same model.")
+
+    @property
+    def cache_model(self) -> str:
+        return f"{LOCAL_BACKEND}:{self.model_name}"
+
+    def embed(self, texts: List[str], token_counts: List[int]) -> List[Optional[np.ndarray]]:
+        # Texts beyond the model's max_seq_length are truncated by the model
+        embeddings = list(self.model.encode(
+            texts,
+            batch_size=settings.LOCAL_EMBEDDING_BATCH_SIZE,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False,
+        ).astype(np.float32, copy=False))
+        return embeddings
+
+
+def get_local_backend() -> LocalEmbeddingBackend:
+    """Returns this process's local backend, loading the model on first use."""
+    key = (os.getpid(), settings.LOCAL_EMBEDDING_MODEL, settings.LOCAL_EMBEDDING_RUNTIME)
+    backend = _local_backends.get(key)
+    if backend is None:
+        with _lock:
+            backend = _local_backends.get(key)
+            if backend is None:
+                backend = LocalEmbeddingBackend(settings.LOCAL_EMBEDDING_MODEL, settings.LOCAL_EMBEDDING_RUNTIME)
+                _local_backends[key] = backend
+    return backend
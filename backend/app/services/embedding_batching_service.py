@@ -0,0 +1,137 @@
+# EMBEDDING BATCH PACKING
+#
+# Shared by embedding_service (document chunks) and MultimediaEmbeddingService.
+#
+# The embeddings endpoint limits both the number of inputs per request and the total tokens per
+# request, and each input has its own token limit. Cutting batches by item count alone produced
+# requests that were rejected for size (and retried for nothing) on long chunks, and needlessly
+# many small requests elsewhere. Instead:
+#
+# - Inputs above the per-input limit are split into token-limited pieces; the piece embeddings are
+#   recombined into one vector per input (token-weighted mean, re-normalised), so no text is lost.
+# - Consecutive inputs are packed greedily until either the token or the item cap would be
+#   exceeded. For contiguous, order-preserving batches, greedy filling gives the fewest requests.
+# - Responses are requested base64-encoded and decoded straight into a float32 matrix per request,
+#   so embeddings travel as row views of NumPy arrays instead of lists of Python floats.
+
+import base64
+import logging
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.core.config import settings
+from app.services import tokenizer_service
+
+logger = logging.getLogger(__name__)
+
+OPENAI_EMBEDDING_MAX_INPUT_TOKENS = 8191 # Per-input limit of the OpenAI embedding models
+
+
+def split_oversized_inputs(
+    texts: Sequence[str],
+    token_counts: Sequence[int],
+    model_name: str,
+    max_input_tokens: int = OPENAI_EMBEDDING_MAX_INPUT_TOKENS
+) -> Tuple[List[str], List[int], List[int]]:
+    """
+    Splits every text above max_input_tokens into consecutive pieces of at most max_input_tokens.
+
+    Args:
+        texts: Input texts.
+        token_counts: Token count of each text (already known from chunking or counted in batch).
+        model_name: Model/encoding used to split oversized texts.
+        max_input_tokens: Per-input token limit.
+
+    Returns:
+        (pieces, piece_token_counts, owners) where owners[i] is the index in `texts` that
+        piece i came from. Texts within the limit map to exactly one piece (themselves).
+    """
+    pieces: List[str] = []
+    piece_token_counts: List[int] = []
+    owners: List[int] = []
+    for index, (text, token_count) in enumerate(zip(texts, token_counts)):
+        if token_count <= max_input_tokens:
+            pieces.append(text)
+            piece_token_counts.append(token_count)
+            owners.append(index)
+            continue
+        tokens = tokenizer_service.encode_batch([text], model_name)[0]
+        encoding = tokenizer_service.get_encoding(model_name)
+        num_pieces = -(-len(tokens) // max_input_tokens)
+        logger.warning(f"Embedding input {index} has {len(tokens)} tokens, above the per-input limit of {max_input_tokens}. Splitting it into {num_pieces} pieces.")
+        for start in range(0, len(tokens), max_input_tokens):
+            piece_tokens = tokens[start:start + max_input_tokens]
+            pieces.append(encoding.decode(piece_tokens))
+            piece_token_counts.append(len(piece_tokens))
+            owners.append(index)
+    return pieces, piece_token_counts, owners
+
+
+def pack_batches(
+    token_counts: Sequence[int],
+    max_tokens_per_request: Optional[int] = None,
+    max_items_per_request: Optional[int] = None
+) -> List[Tuple[int, int]]:
+    """
+    Packs consecutive inputs into request batches under both caps.
+
+    Args:
+        token_counts: Token count of each input (each assumed within the per-input limit).
+        max_tokens_per_request: Defaults to settings.OPENAI_EMBEDDING_MAX_TOKENS_PER_REQUEST.
+        max_items_per_request: Defaults to settings.OPENAI_EMBEDDING_BATCH_SIZE.
+
+    Returns:
+        A list of (start, end_exclusive) index ranges, one per request.
+    """
+    max_tokens = max_tokens_per_request or settings.OPENAI_EMBEDDING_MAX_TOKENS_PER_REQUEST
+    max_items = max_items_per_request or settings.OPENAI_EMBEDDING_BATCH_SIZE
+    batches: List[Tuple[int, int]] = []
+    start = 0
+    batch_tokens = 0
+    for index, token_count in enumerate(token_counts):
+        if index > start and (index - start >= max_items or batch_tokens + token_count > max_tokens):
+            batches.append((start, index))
+            start, batch_tokens = index, 0
+        batch_tokens += token_count
+    if start < len(token_counts):
+        batches.append((start, len(token_counts)))
+    return batches
+
+
+def decode_embeddings(encoded: Sequence[str]) -> np.ndarray:
+    """
+    Decodes the base64 embeddings of one response (encoding_format="base64") into a float32
+    matrix with one row per input, without going through Python floats.
+    """
+    return np.frombuffer(b"".join(base64.b64decode(value) for value in encoded), dtype=np.float32).reshape(len(encoded), -1)
+
+
+def combine_split_embeddings(
+    piece_embeddings: Sequence[Optional[np.ndarray]],
+    piece_token_counts: Sequence[int],
+    owners: Sequence[int],
+    num_inputs: int
+) -> List[Optional[np.ndarray]]:
+    """
+    Maps piece embeddings back to one embedding per original input. Inputs that were split get
+    the token-weighted mean of their pieces, re-normalised to unit length like the API's vectors.
+    An input is None if any of its pieces is None (e.g. its batch failed).
+    """
+    embeddings: List[Optional[np.ndarray]] = [None] * num_inputs
+    split_pieces: dict = {}
+    for piece_index, owner in enumerate(owners):
+        if piece_index + 1 < len(owners) and owners[piece_index + 1] == owner or owner in split_pieces:
+            split_pieces.setdefault(owner, []).append(piece_index)
+        else:
+            embeddings[owner] = piece_embeddings[piece_index]
+
+    for owner, piece_indices in split_pieces.items():
+        if any(piece_embeddings[i] is None for i in piece_indices):
+            continue
+        vectors = np.asarray([piece_embeddings[i] for i in piece_indices], dtype=np.float64)
+        weights = np.asarray([max(piece_token_counts[i], 1) for i in piece_indices], dtype=np.float64)
+        combined = weights @ vectors / weights.sum()
+        norm = np.linalg.norm(combined)
+        embeddings[owner] = (combined / norm if norm > 0 else combined).astype(np.float32)
+    return embeddings
@@ -0,0 +1,174 @@
+# BULK EMBEDDING (BATCH API)
+#
+# Re-embedding a chatbot's existing chunks (e.g. after a model or profile change) used to mean
+# re-indexing every document through the synchronous embeddings endpoint: full price, and
+# competing with live ingestion for the same rate limits. Backfills go through OpenAI's Batch API
+# instead, which is billed at a discount, has its own quota and completes within 24 hours:
+#
+# - BatchFileWriter streams chunks into JSONL files of /v1/embeddings requests, packed like
+#   synchronous requests (embedding_batching_service) and rolled over at the Batch API's per-batch
+#   limits (EMBEDDING_BULK_MAX_INPUTS_PER_BATCH inputs, EMBEDDING_BULK_MAX_FILE_BYTES).
+# - submit_batch() uploads a file and creates the batch; get_batch() polls it and cancel_batch()
+#   cancels it.
+# - iter_batch_results() streams the output (and error) file line by line, yielding each
+#   request's embeddings as a float32 matrix, so results never have to fit in memory at once.
+#
+# Each file comes with a manifest mapping the requests' custom_ids to chunk ids, which the caller
+# keeps until the batch has completed (see tasks_embedding_backfill). OPENAI_BATCH_BASE_URL points
+# the client at a local stand-in server for tests (OpenAIBatchServer in tests/conftest.py).
+
+import json
+import logging
+import os
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import openai
+
+from app.core.config import settings
+from app.services import embedding_batching_service
+from app.services import embedding_profile_service
+
+logger = logging.getLogger(__name__)
+
+EMBEDDINGS_ENDPOINT = "/v1/embeddings"
+COMPLETION_WINDOW = "24h"
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def _get_client() -> openai.OpenAI:
+    return openai.OpenAI(
+        api_key=settings.OPENAI_API_KEY,
+        base_url=settings.OPENAI_BATCH_BASE_URL,
+        timeout=settings.OPENAI_REQUEST_TIMEOUT_SECONDS,
+    )
+
+
+class BatchFileWriter:
+    """
+    Writes chunks as embedding requests into batch input files under `directory`, starting a new
+    file whenever the next request would exceed a per-batch limit.
+    """
+
+    def __init__(self, directory: str, model: str):
+        self.directory = directory
+        self.model = model
+        self.request_options = embedding_profile_service.request_options(model)
+        self.files: List[Dict[str, Any]] = [] # {"path", "inputs", "requests": {custom_id: {"chunk_ids", ["piece_tokens"]}}}
+        self._handle = None
+        self._bytes = 0
+        self._request_count = 0
+
+    def add_chunks(self, chunk_ids: Sequence[str], texts: Sequence[str], token_counts: Sequence[int]) -> None:
+        """Adds chunks, packed into as few requests as the request caps allow."""
+        limit = embedding_batching_service.OPENAI_EMBEDDING_MAX_INPUT_TOKENS
+        regular = [index for index, token_count in enumerate(token_counts) if token_count <= limit]
+        regular_tokens = [token_counts[index] for index in regular]
+        for start, end in embedding_batching_service.pack_batches(regular_tokens):
+            indices = regular[start:end]
+            self._add_request([chunk_ids[i] for i in indices], [texts[i] for i in indices])
+
+        # Oversized chunks get a request of their own pieces, recombined in embeddings_for_request()
+        for index in (index for index, token_count in enumerate(token_counts) if token_count > limit):
+            pieces, piece_tokens, _ = embedding_batching_service.split_oversized_inputs(
+                [texts[index]], [token_counts[index]], self.model, limit
+            )
+            self._add_request([chunk_ids[index]], pieces, piece_tokens)
+
+    def _add_request(self, chunk_ids: List[str], inputs: List[str], piece_tokens: Optional[List[int]] = None) -> None:
+        custom_id = f"request-{self._request_count}"
+        self._request_count += 1
+        line = json.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": EMBEDDINGS_ENDPOINT,
+            "body": {"model": self.model, "input": inputs, "encoding_format": "base64", **self.request_options},
+        }, separators=(",", ":")).encode("utf-8") + b"\n"
+
+        current = self.files[-1] if self._handle is not None else None
+        if current is None or (
+            current["inputs"] + len(inputs) > settings.EMBEDDING_BULK_MAX_INPUTS_PER_BATCH
+            or self._bytes + len(line) > settings.EMBEDDING_BULK_MAX_FILE_BYTES
+        ):
+            current = self._start_file()
+        self._handle.write(line)
+        self._bytes += len(line)
+        current["inputs"] += len(inputs)
+        current["requests"][custom_id] = {"chunk_ids": chunk_ids}
+        if piece_tokens is not None:
+            current["requests"][custom_id]["piece_tokens"] = piece_tokens
+
+    def _start_file(self) -> Dict[str, Any]:
+        self.close()
+        path = os.path.join(self.directory, f"embedding_batch_{len(self.files)}.jsonl")
+        self._handle = open(path, "wb")
+        self._bytes = 0
+        self.files.append({"path": path, "inputs": 0, "requests": {}})
+        return self.files[-1]
+
+    def close(self) -> None:
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+
+def submit_batch(path: str, metadata: Optional[Dict[str, str]] = None) -> str:
+    """Uploads a batch input file and creates its batch. Returns the batch id."""
+    client = _get_client()
+    with open(path, "rb") as f:
+        input_file = client.files.create(file=f, purpose="batch")
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint=EMBEDDINGS_ENDPOINT,
+        completion_window=COMPLETION_WINDOW,
+        metadata=metadata,
+    )
+    logger.info(f"Submitted embedding batch {batch.id} ({os.path.getsize(path)} bytes, input file {input_file.id}).")
+    return batch.id
+
+
+def get_batch(batch_id: str) -> Any:
+    """Returns the batch (status, request_counts, output_file_id, error_file_id)."""
+    return _get_client().batches.retrieve(batch_id)
+
+
+def cancel_batch(batch_id: str) -> None:
+    """Cancels a batch; requests it has already completed are still billed."""
+    _get_client().batches.cancel(batch_id)
+    logger.info(f"Cancelled embedding batch {batch_id}.")
+
+
+def iter_batch_results(batch: Any) -> Iterator[Tuple[str, Optional[np.ndarray], int]]:
+    """
+    Streams the results of a finished batch as (custom_id, embeddings, prompt_tokens), one per
+    request. embeddings is a float32 matrix with one row per input, or None if the request failed.
+    Requests without any result line (e.g. in an expired batch) are not yielded.
+    """
+    client = _get_client()
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        with client.files.with_streaming_response.content(file_id) as response:
+            for line in response.iter_lines():
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                custom_id = result["custom_id"]
+                response_data = result.get("response") or {}
+                if response_data.get("status_code") != 200:
+                    error = result.get("error") or (response_data.get("body") or {}).get("error")
+                    logger.warning(f"Batch {batch.id} request {custom_id} failed: {error}")
+                    yield custom_id, None, 0
+                    continue
+                body = response_data["body"]
+                data = sorted(body["data"], key=lambda item: item["index"])
+                embeddings = embedding_batching_service.decode_embeddings([item["embedding"] for item in data])
+                yield custom_id, embeddings, body.get("usage", {}).get("prompt_tokens", 0)
+
+
+def embeddings_for_request(request: Dict[str, Any], embeddings: np.ndarray) -> List[np.ndarray]:
+    """Maps a request's embeddings (from iter_batch_results) to one vector per chunk id in its manifest entry."""
+    piece_tokens = request.get("piece_tokens")
+    if piece_tokens is None:
+        return list(embeddings)
+    return embedding_batching_service.combine_split_embeddings(list(embeddings), piece_tokens, [0] * len(piece_tokens), 1)
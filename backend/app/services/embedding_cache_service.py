@@ -0,0 +1,259 @@
+# EMBEDDING CACHE
+#
+# Re-indexing an unchanged or lightly edited document used to re-embed every chunk, and boilerplate
+# repeated across a chatbot's documents (licence pages, syllabus headers) was embedded again for each
+# document. Embeddings are deterministic for a given model, so they are cached by content:
+#
+# - Key: SHA-256 of (model, dimensions, text). The text is the exact string sent to the API.
+# - Local tier: a SQLite file at EMBEDDING_CACHE_PATH, shared by the worker processes of a container.
+#   Vectors are stored as float32 bytes, which is lossless (the API returns float32 values), and
+#   read back as float32 arrays without conversion.
+#   Hits refresh last_used; writes evict least recently used rows beyond EMBEDDING_CACHE_MAX_BYTES.
+# - Shared tier: if EMBEDDING_CACHE_TABLE is set, that Postgres table (see
+#   sql/create_embedding_cache_table.sql) is consulted on local misses, so all workers benefit.
+# - Identical texts within one call are embedded once.
+# - Cache failures are logged and treated as misses; they never fail indexing.
+#
+# Counters for this process are exposed through get_cache_stats()/reset_cache_stats(), so tasks can
+# report the hit rate in their result_payload.
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from app.core.config import settings
+from app.core.supabase_client import get_supabase_client
+
+logger = logging.getLogger(__name__)
+
+SQLITE_MAX_PARAMETERS = 500 # Keys per SELECT ... IN (...) against the local tier
+SHARED_LOOKUP_BATCH_SIZE = 100 # Keys per request against the shared table (keeps URLs short)
+
+_lock = threading.Lock()
+_connection: Optional[sqlite3.Connection] = None
+_connection_pid: Optional[int] = None
+
+_stats_lock = threading.Lock()
+_stats: Dict[str, int] = {
+    "lookups": 0,
+    "local_hits": 0,
+    "shared_hits": 0,
+    "misses": 0,
+    "duplicates": 0,
+    "stored": 0,
+}
+
+
+def _record(**increments: int) -> None:
+    with _stats_lock:
+        for key, value in increments.items():
+            _stats[key] += value
+
+
+def get_cache_stats() -> Dict[str, Any]:
+    """Returns a snapshot of the embedding cache counters for this process."""
+    with _stats_lock:
+        stats: Dict[str, Any] = dict(_stats)
+    hits = stats["local_hits"] + stats["shared_hits"]
+    stats["hit_rate"] = round(hits / stats["lookups"], 4) if stats["lookups"] else 0.0
+    return stats
+
+
+def reset_cache_stats() -> None:
+    """Resets the counters, e.g. at the start of a task."""
+    with _stats_lock:
+        for key in _stats:
+            _stats[key] = 0
+
+
+def make_cache_key(model: str, text: str, dimensions: Optional[int] = None) -> str:
+    """Returns the content-addressed cache key of an embedding input."""
+    sha256 = hashlib.sha256()
+    for part in (model, str(dimensions or ""), text):
+        sha256.update(part.encode("utf-8"))
+        sha256.update(b"\0")
+    return sha256.hexdigest()
+
+
+def _get_connection() -> sqlite3.Connection:
+    """Returns this process's connection to the local tier (re-opened after a fork)."""
+    global _connection, _connection_pid
+    if _connection is None or _connection_pid != os.getpid():
+        directory = os.path.dirname(settings.EMBEDDING_CACHE_PATH)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = sqlite3.connect(settings.EMBEDDING_CACHE_PATH, timeout=30, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL") # Readers do not block the writing worker
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "cache_key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used_idx ON embeddings (last_used)")
+        _connection, _connection_pid = connection, os.getpid()
+    return _connection
+
+
+def _read_local(keys: Sequence[str]) -> Dict[str, np.ndarray]:
+    found: Dict[str, np.ndarray] = {}
+    with _lock:
+        connection = _get_connection()
+        for start in range(0, len(keys), SQLITE_MAX_PARAMETERS):
+            key_slice = list(keys[start:start + SQLITE_MAX_PARAMETERS])
+            placeholders = ",".join("?" * len(key_slice))
+            rows = connection.execute(
+                f"SELECT cache_key, vector FROM embeddings WHERE cache_key IN ({placeholders})", key_slice
+            ).fetchall()
+            for key, vector in rows:
+                found[key] = np.frombuffer(vector, dtype=np.float32)
+        if found:
+            # Mark as recently used
+            now = time.time()
+            connection.executemany("UPDATE embeddings SET last_used = ? WHERE cache_key = ?", [(now, key) for key in found])
+    return found
+
+
+def _evict_local(connection: sqlite3.Connection) -> None:
+    """Deletes least recently used rows until the stored vectors fit in EMBEDDING_CACHE_MAX_BYTES."""
+    total_bytes, row_count = connection.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0), COUNT(*) FROM embeddings").fetchone()
+    if total_bytes <= settings.EMBEDDING_CACHE_MAX_BYTES or not row_count:
+        return
+    average_row_bytes = total_bytes / row_count
+    rows_to_delete = int((total_bytes - settings.EMBEDDING_CACHE_MAX_BYTES) / average_row_bytes) + 1
+    connection.execute(
+        "DELETE FROM embeddings WHERE cache_key IN (SELECT cache_key FROM embeddings ORDER BY last_used LIMIT ?)",
+        (rows_to_delete,)
+    )
+    logger.debug(f"Evicted {rows_to_delete} embedding cache rows.")
+
+
+def _write_local(entries: Dict[str, np.ndarray]) -> None:
+    now = time.time()
+    rows = [(key, np.asarray(vector, dtype=np.float32).tobytes(), now) for key, vector in entries.items()]
+    with _lock:
+        connection = _get_connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany("INSERT OR REPLACE INTO embeddings (cache_key, vector, last_used) VALUES (?, ?, ?)", rows)
+            _evict_local(connection)
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+
+def _read_shared(keys: Sequence[str]) -> Dict[str, np.ndarray]:
+    if not settings.EMBEDDING_CACHE_TABLE:
+        return {}
+    found: Dict[str, np.ndarray] = {}
+    table = get_supabase_client().table(settings.EMBEDDING_CACHE_TABLE)
+    for start in range(0, len(keys), SHARED_LOOKUP_BATCH_SIZE):
+        response = table.select("cache_key, embedding").in_("cache_key", list(keys[start:start + SHARED_LOOKUP_BATCH_SIZE])).execute()
+        for row in response.data or []:
+            found[row["cache_key"]] = np.asarray(row["embedding"], dtype=np.float32)
+    return found
+
+
+def _write_shared(entries: Dict[str, np.ndarray], model: str) -> None:
+    if not settings.EMBEDDING_CACHE_TABLE:
+        return
+    rows = [
+        {"cache_key": key, "model": model, "embedding": np.asarray(vector, dtype=np.float32).tolist()}
+        for key, vector in entries.items()
+    ]
+    table = get_supabase_client().table(settings.EMBEDDING_CACHE_TABLE)
+    for start in range(0, len(rows), SHARED_LOOKUP_BATCH_SIZE):
+        table.upsert(rows[start:start + SHARED_LOOKUP_BATCH_SIZE], on_conflict="cache_key").execute()
+
+
+def lookup(keys: Sequence[str]) -> Dict[str, np.ndarray]:
+    """Returns the cached embeddings (float32 arrays) found for the given keys (local tier first, then shared)."""
+    if not settings.EMBEDDING_CACHE_ENABLED or not keys:
+        return {}
+    found: Dict[str, np.ndarray] = {}
+    try:
+        found.update(_read_local(keys))
+    except Exception as e:
+        logger.warning(f"Could not read the local embedding cache: {e}")
+    local_hits = len(found)
+
+    missing = [key for key in keys if key not in found]
+    if missing and settings.EMBEDDING_CACHE_TABLE:
+        try:
+            shared = _read_shared(missing)
+        except Exception as e:
+            logger.warning(f"Could not read the shared embedding cache table '{settings.EMBEDDING_CACHE_TABLE}': {e}")
+            shared = {}
+        if shared:
+            found.update(shared)
+            try:
+                _write_local(shared) # Keep shared hits locally for the next lookup
+            except Exception as e:
+                logger.warning(f"Could not store shared embedding cache hits locally: {e}")
+    _record(lookups=len(keys), local_hits=local_hits, shared_hits=len(found) - local_hits, misses=len(keys) - len(found))
+    return found
+
+
+def store(entries: Dict[str, np.ndarray], model: str) -> None:
+    """Stores new embeddings in the local tier and, if configured, the shared table."""
+    if not settings.EMBEDDING_CACHE_ENABLED or not entries:
+        return
+    try:
+        _write_local(entries)
+    except Exception as e:
+        logger.warning(f"Could not store {len(entries)} embeddings in the local embedding cache: {e}")
+    try:
+        _write_shared(entries, model)
+    except Exception as e:
+        logger.warning(f"Could not store {len(entries)} embeddings in the shared embedding cache table: {e}")
+    _record(stored=len(entries))
+
+
+def embed_with_cache(
+    texts: Sequence[str],
+    model: str,
+    embed_missing: Callable[[List[int]], List[Optional[np.ndarray]]],
+    dimensions: Optional[int] = None
+) -> List[Optional[np.ndarray]]:
+    """
+    Returns one embedding per text, only calling embed_missing for texts that are not cached.
+
+    Args:
+        texts: The exact strings that would be sent to the embedding API.
+        model / dimensions: Embedding model and output dimensions (part of the cache key).
+        embed_missing: Called once with the indices (into texts) of the distinct uncached texts;
+                       returns their embeddings in the same order (None for failures).
+
+    Returns:
+        Embeddings in input order; None where embed_missing failed. Failures are not cached.
+    """
+    if not settings.EMBEDDING_CACHE_ENABLED:
+        return embed_missing(list(range(len(texts))))
+
+    keys = [make_cache_key(model, text, dimensions) for text in texts]
+    first_index_by_key: Dict[str, int] = {}
+    for index, key in enumerate(keys):
+        first_index_by_key.setdefault(key, index)
+    unique_keys = list(first_index_by_key)
+    _record(duplicates=len(keys) - len(unique_keys))
+
+    found = lookup(unique_keys)
+    missing_indices = [first_index_by_key[key] for key in unique_keys if key not in found]
+    logger.info(f"Embedding cache: {len(texts)} inputs, {len(unique_keys)} distinct, {len(found)} cached, {len(missing_indices)} to embed.")
+
+    if missing_indices:
+        new_embeddings = embed_missing(missing_indices)
+        new_entries = {
+            keys[index]: embedding
+            for index, embedding in zip(missing_indices, new_embeddings)
+            if embedding is not None
+        }
+        store(new_entries, model)
+        found.update(new_entries)
+    return [found.get(key) for key in keys]
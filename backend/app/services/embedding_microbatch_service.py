@@ -0,0 +1,293 @@
+# CROSS-TASK EMBEDDING MICRO-BATCHING
+#
+# Many small uploads (one-page handouts, short audio clips) each sent their own tiny embedding
+# request, so the request-per-minute limit was hit long before the token limit. When
+# EMBEDDING_MICROBATCH_ENABLED is set, small embedding calls from concurrent tasks (in any worker
+# process or container sharing the Redis instance) are coalesced into full requests:
+#
+# - A caller pushes its texts onto a Redis queue (one queue per model and lane) and waits for its
+#   vectors on a private reply list.
+# - When the oldest waiter's deadline passes, or the queued work already fills a request, a waiter
+#   takes the flush lock, pops queued calls up to the request caps (token and item caps, as in
+#   embedding_batching_service), embeds them in one go and pushes each caller's vectors back.
+#   There is no separate batching process: whichever waiter gets the lock does the work. The lock
+#   is renewed while the flush runs (rate-limit waits and API retries have no fixed bound) and is
+#   only released by its owner, so it never expires under a live flush or frees another's lock.
+# - The "high" lane is always drained first and has a shorter deadline, so small interactive jobs
+#   are not stuck behind bulk backfills. Calls up to EMBEDDING_MICROBATCH_HIGH_PRIORITY_MAX_INPUTS
+#   texts use it by default.
+# - Calls larger than EMBEDDING_MICROBATCH_MAX_INPUTS fill their own requests and bypass the queue.
+# - If Redis is unavailable, or no reply arrives within EMBEDDING_MICROBATCH_REPLY_TIMEOUT_SECONDS,
+#   the caller embeds its own texts directly. A queued call is removed atomically (LREM) before
+#   doing so, so it is never embedded twice.
+#
+# Locally this works against any Redis (e.g. the one in docker-compose.yml).
+
+import base64
+import json
+import logging
+import threading
+import time
+import uuid
+from typing import Callable, List, Optional, Sequence
+
+import numpy as np
+import redis
+
+from app.core.config import settings
+from app.core.redis_client import get_redis_client
+from app.services import circuit_breaker_service
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "syllabi:embedding_microbatch"
+HIGH_PRIORITY = "high"
+BULK_PRIORITY = "bulk"
+LANES = (HIGH_PRIORITY, BULK_PRIORITY) # Drained in this order
+POLL_INTERVAL_SECONDS = 0.02
+FLUSH_LOCK_TTL_MS = 30_000 # Renewed while flushing; only runs out if the flusher died
+FLUSH_LOCK_RENEW_SECONDS = 10.0
+REPLY_TTL_SECONDS = 300
+
+EmbedFunction = Callable[[List[str], List[int]], List[Optional[np.ndarray]]]
+
+# KEYS[1]: flush lock. ARGV[1]: owner. Deletes the lock only if the caller still owns it.
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# KEYS[1]: flush lock. ARGV: owner, TTL in milliseconds. Returns 0 if the lock is no longer owned.
+_RENEW_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], tonumber(ARGV[2]))
+end
+return 0
+"""
+
+_scripts = {}
+
+
+def _get_redis() -> redis.Redis:
+    return get_redis_client(settings.EMBEDDING_MICROBATCH_REDIS_URL)
+
+
+def _key(*parts: str) -> str:
+    return ":".join((KEY_PREFIX,) + parts)
+
+
+def _script(client: redis.Redis, source: str):
+    script = _scripts.get(source)
+    if script is None or script.registered_client is not client:
+        script = _scripts[source] = client.register_script(source)
+    return script
+
+
+def _encode_vectors(vectors: Sequence[Optional[np.ndarray]]) -> List[Optional[str]]:
+    # float32 bytes (lossless for API vectors) are far smaller than JSON floats
+    return [
+        base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode("ascii") if vector is not None else None
+        for vector in vectors
+    ]
+
+
+def _decode_reply(reply: bytes) -> List[Optional[np.ndarray]]:
+    data = json.loads(reply)
+    if "circuit_open" in data:
+        raise circuit_breaker_service.CircuitOpenError(data["circuit_open"]["name"], data["circuit_open"]["retry_after"])
+    return _decode_vectors(data["embeddings"])
+
+
+def _decode_vectors(encoded: Sequence[Optional[str]]) -> List[Optional[np.ndarray]]:
+    return [
+        np.frombuffer(base64.b64decode(value), dtype=np.float32) if value is not None else None
+        for value in encoded
+    ]
+
+
+def _flush(client: redis.Redis, model: str, embed_function: EmbedFunction) -> int:
+    """
+    Pops queued calls (high lane first) up to one request's token and item caps, embeds them
+    together and replies to each caller. Must be called with the flush lock held.
+    Returns the number of calls served.
+    """
+    max_items = settings.OPENAI_EMBEDDING_BATCH_SIZE
+    max_tokens = settings.OPENAI_EMBEDDING_MAX_TOKENS_PER_REQUEST
+    pending_key = _key("pending", model)
+    requests = []
+    items = tokens = 0
+    full = False
+    for lane in LANES:
+        queue_key = _key("queue", model, lane)
+        while not full:
+            payload = client.lpop(queue_key)
+            if payload is None:
+                break
+            request = json.loads(payload)
+            request_items, request_tokens = len(request["texts"]), sum(request["token_counts"])
+            if requests and (items + request_items > max_items or tokens + request_tokens > max_tokens):
+                client.lpush(queue_key, payload) # Back to the front; it goes in the next request
+                full = True
+                break
+            client.hincrby(pending_key, "items", -request_items)
+            client.hincrby(pending_key, "tokens", -request_tokens)
+            requests.append(request)
+            items += request_items
+            tokens += request_tokens
+    if not requests:
+        return 0
+
+    texts = [text for request in requests for text in request["texts"]]
+    token_counts = [count for request in requests for count in request["token_counts"]]
+    logger.info(f"Micro-batch flush: {len(requests)} calls, {len(texts)} texts, {tokens} tokens (model: {model}).")
+    circuit_open = None
+    try:
+        embeddings = embed_function(texts, token_counts)
+    except circuit_breaker_service.CircuitOpenError as e:
+        # Every caller gets the error, so each task can checkpoint and requeue itself
+        circuit_open = {"name": e.name, "retry_after": e.retry_after}
+        embeddings = [None] * len(texts)
+    except Exception as e:
+        logger.error(f"Micro-batch embedding failed: {e}", exc_info=True)
+        embeddings = [None] * len(texts)
+
+    pipeline = client.pipeline(transaction=False)
+    start = 0
+    for request in requests:
+        end = start + len(request["texts"])
+        reply_key = _key("reply", request["id"])
+        if circuit_open is not None:
+            reply = {"circuit_open": circuit_open}
+        else:
+            reply = {"embeddings": _encode_vectors(embeddings[start:end])}
+        pipeline.rpush(reply_key, json.dumps(reply))
+        pipeline.expire(reply_key, REPLY_TTL_SECONDS)
+        start = end
+    pipeline.execute()
+    return len(requests)
+
+
+def _renew_lock(client: redis.Redis, lock_key: str, owner: str, stop: threading.Event) -> None:
+    """Runs in a thread during a flush: keeps the flush lock from expiring until stop is set."""
+    while not stop.wait(FLUSH_LOCK_RENEW_SECONDS):
+        try:
+            if not _script(client, _RENEW_LOCK_SCRIPT)(keys=[lock_key], args=[owner, FLUSH_LOCK_TTL_MS]):
+                logger.warning(f"Micro-batch flush lock {lock_key} expired during a flush.")
+                return
+        except redis.RedisError as e:
+            logger.warning(f"Could not renew micro-batch flush lock {lock_key}: {e}")
+
+
+def _try_flush(client: redis.Redis, model: str, embed_function: EmbedFunction, owner: str) -> None:
+    lock_key = _key("lock", model)
+    if not client.set(lock_key, owner, nx=True, px=FLUSH_LOCK_TTL_MS):
+        return # Another caller is flushing
+    stop_renewing = threading.Event()
+    renewer = threading.Thread(target=_renew_lock, args=(client, lock_key, owner, stop_renewing), name="microbatch-lock-renewal", daemon=True)
+    renewer.start()
+    try:
+        _flush(client, model, embed_function)
+    finally:
+        stop_renewing.set()
+        renewer.join()
+        try:
+            _script(client, _RELEASE_LOCK_SCRIPT)(keys=[lock_key], args=[owner])
+        except redis.RedisError as e:
+            # The replies are already sent; the lock just expires
+            logger.warning(f"Could not release micro-batch flush lock {lock_key}: {e}")
+
+
+def _queued_work_fills_request(client: redis.Redis, model: str) -> bool:
+    items, tokens = client.hmget(_key("pending", model), "items", "tokens")
+    return (
+        int(items or 0) >= settings.OPENAI_EMBEDDING_BATCH_SIZE
+        or int(tokens or 0) >= settings.OPENAI_EMBEDDING_MAX_TOKENS_PER_REQUEST
+    )
+
+
+def _embed_via_queue(
+    client: redis.Redis,
+    texts: List[str],
+    token_counts: List[int],
+    model: str,
+    embed_function: EmbedFunction,
+    lane: str
+) -> List[Optional[np.ndarray]]:
+    request_id = uuid.uuid4().hex
+    queue_key = _key("queue", model, lane)
+    reply_key = _key("reply", request_id)
+    pending_key = _key("pending", model)
+    payload = json.dumps({"id": request_id, "texts": texts, "token_counts": token_counts})
+
+    pipeline = client.pipeline(transaction=True)
+    pipeline.rpush(queue_key, payload)
+    pipeline.hincrby(pending_key, "items", len(texts))
+    pipeline.hincrby(pending_key, "tokens", sum(token_counts))
+    pipeline.execute()
+
+    max_wait_ms = settings.EMBEDDING_MICROBATCH_HIGH_PRIORITY_MAX_WAIT_MS if lane == HIGH_PRIORITY else settings.EMBEDDING_MICROBATCH_MAX_WAIT_MS
+    deadline = time.monotonic() + max_wait_ms / 1000
+    give_up_at = time.monotonic() + settings.EMBEDDING_MICROBATCH_REPLY_TIMEOUT_SECONDS
+    while True:
+        now = time.monotonic()
+        if now >= deadline or _queued_work_fills_request(client, model):
+            _try_flush(client, model, embed_function, owner=request_id)
+            wait_seconds = POLL_INTERVAL_SECONDS
+        else:
+            wait_seconds = max(deadline - now, POLL_INTERVAL_SECONDS)
+
+        reply = client.blpop([reply_key], timeout=wait_seconds)
+        if reply is not None:
+            client.delete(reply_key)
+            return _decode_reply(reply[1])
+
+        if time.monotonic() >= give_up_at:
+            if client.lrem(queue_key, 1, payload):
+                client.hincrby(pending_key, "items", -len(texts))
+                client.hincrby(pending_key, "tokens", -sum(token_counts))
+                logger.warning(f"No micro-batch reply after {settings.EMBEDDING_MICROBATCH_REPLY_TIMEOUT_SECONDS}s. Embedding {len(texts)} texts directly.")
+                return embed_function(texts, token_counts)
+            # Already taken by a flusher; give it one more timeout period to reply
+            reply = client.blpop([reply_key], timeout=settings.EMBEDDING_MICROBATCH_REPLY_TIMEOUT_SECONDS)
+            if reply is not None:
+                client.delete(reply_key)
+                return _decode_reply(reply[1])
+            logger.warning(f"Micro-batch flusher did not reply for {len(texts)} texts. Embedding them directly.")
+            return embed_function(texts, token_counts)
+
+
+def embed(
+    texts: List[str],
+    token_counts: List[int],
+    model: str,
+    embed_function: EmbedFunction,
+    priority: Optional[str] = None
+) -> List[Optional[np.ndarray]]:
+    """
+    Embeds texts, coalescing small calls with those of concurrent tasks when micro-batching is
+    enabled. Otherwise (or for large calls, or if Redis fails) calls embed_function directly.
+
+    Args:
+        texts / token_counts: Texts to embed and their token counts.
+        model: Embedding model; only calls for the same model are coalesced.
+        embed_function: Embeds a list of texts (with token counts) through the API; used for the
+                        whole coalesced batch when this caller is the one that flushes.
+        priority: HIGH_PRIORITY or BULK_PRIORITY lane; chosen from the call size if None.
+
+    Returns:
+        One embedding (float32 array) per text, in order; None for failures.
+    """
+    if not settings.EMBEDDING_MICROBATCH_ENABLED or not texts or len(texts) > settings.EMBEDDING_MICROBATCH_MAX_INPUTS:
+        return embed_function(texts, token_counts)
+
+    lane = priority or (HIGH_PRIORITY if len(texts) <= settings.EMBEDDING_MICROBATCH_HIGH_PRIORITY_MAX_INPUTS else BULK_PRIORITY)
+    if lane not in LANES:
+        raise ValueError(f"Unknown micro-batch priority '{priority}'. Use one of {LANES}.")
+    try:
+        client = _get_redis()
+        return _embed_via_queue(client, texts, token_counts, model, embed_function, lane)
+    except redis.RedisError as e:
+        logger.warning(f"Embedding micro-batcher unavailable ({e}). Embedding {len(texts)} texts directly.")
+        return embed_function(texts, token_counts)
@@ -0,0 +1,113 @@
+# EMBEDDING PROFILE
+#
+# document_chunks.embedding used to be a fixed VECTOR(1536) written as JSON float lists, so every
+# chunk cost ~6 KB of table and HNSW index memory and ~30 KB of PostgREST payload. The profile
+# (output dimensions and storage precision) is now configurable and applied end to end:
+#
+# - OPENAI_EMBEDDING_DIMENSIONS is sent as the API's `dimensions` parameter (text-embedding-3
+#   models only). The API returns shortened, re-normalised vectors, so cosine search (the <=>
+#   operator of the search functions, served by the migration's cosine-ops HNSW index) keeps working.
+# - EMBEDDING_STORAGE_PRECISION picks the pgvector column type: "float32" -> vector(n),
+#   "float16" -> halfvec(n). Vectors are sent as pgvector text literals with only the significant
+#   digits that type keeps, instead of full-precision JSON floats.
+# - The database column must match the profile; see sql/migrate_document_chunks_embedding_profile.sql.
+#   768 dimensions in float16 store 4x less than 1536 in float32.
+# - Direct binary COPY (CHUNK_WRITER=copy) sends vectors in pgvector's binary form instead, which
+#   the server stores without parsing any text.
+
+import logging
+import struct
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+FLOAT32 = "float32"
+FLOAT16 = "float16"
+# Precision -> (pgvector type, significant digits kept when serialising)
+STORAGE_TYPES = {
+    FLOAT32: ("vector", 7),
+    FLOAT16: ("halfvec", 4),
+}
+# Precision -> big-endian element type of the pgvector binary format
+BINARY_DTYPES = {
+    FLOAT32: ">f4",
+    FLOAT16: ">f2",
+}
+# Models accepting the `dimensions` parameter, with their full output size
+SHORTENABLE_MODELS = {
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+}
+DEFAULT_DIMENSIONS = {**SHORTENABLE_MODELS, "text-embedding-ada-002": 1536}
+
+
+def get_dimensions(model: str) -> Optional[int]:
+    """
+    Returns the dimensions to request from the API for this model, or None for the model's
+    full output. Raises ValueError if dimensions are configured for a model that cannot shorten.
+    """
+    dimensions = settings.OPENAI_EMBEDDING_DIMENSIONS
+    if dimensions is None:
+        return None
+    full_dimensions = SHORTENABLE_MODELS.get(model)
+    if full_dimensions is None:
+        raise ValueError(f"OPENAI_EMBEDDING_DIMENSIONS is set, but model '{model}' does not support the dimensions parameter.")
+    if not 0 < dimensions <= full_dimensions:
+        raise ValueError(f"OPENAI_EMBEDDING_DIMENSIONS must be between 1 and {full_dimensions} for model '{model}', got {dimensions}.")
+    return None if dimensions == full_dimensions else dimensions
+
+
+def request_options(model: str) -> Dict[str, Any]:
+    """Extra keyword arguments for embeddings.create() under the current profile."""
+    dimensions = get_dimensions(model)
+    return {"dimensions": dimensions} if dimensions is not None else {}
+
+
+def _storage_type() -> Tuple[str, int]:
+    precision = settings.EMBEDDING_STORAGE_PRECISION
+    if precision not in STORAGE_TYPES:
+        raise ValueError(f"Unknown EMBEDDING_STORAGE_PRECISION '{precision}'. Use one of {list(STORAGE_TYPES)}.")
+    return STORAGE_TYPES[precision]
+
+
+def column_dimensions(model: Optional[str] = None) -> Optional[int]:
+    """
+    Dimensions of the document_chunks.embedding column: EMBEDDING_COLUMN_DIMENSIONS, else the
+    OpenAI model's output size (OPENAI_EMBEDDING_DIMENSIONS or its full size). None if unknown.
+    """
+    if settings.EMBEDDING_COLUMN_DIMENSIONS is not None:
+        return settings.EMBEDDING_COLUMN_DIMENSIONS
+    model = model or settings.OPENAI_EMBEDDING_MODEL
+    return get_dimensions(model) or DEFAULT_DIMENSIONS.get(model)
+
+
+def column_type(model: Optional[str] = None) -> str:
+    """The pgvector column type matching the profile, e.g. 'halfvec(768)'."""
+    dimensions = column_dimensions(model)
+    type_name, _ = _storage_type()
+    return f"{type_name}({dimensions})" if dimensions else type_name
+
+
+def serialize(vector: Sequence[float]) -> str:
+    """
+    Formats a vector as a pgvector text literal ('[0.01234,-0.5,...]'), accepted by vector and
+    halfvec columns alike, keeping only the digits the storage precision can hold.
+    """
+    _, digits = _storage_type()
+    format_spec = f"%.{digits}g"
+    values = vector.tolist() if isinstance(vector, np.ndarray) else vector # Python floats format much faster than NumPy scalars
+    return "[" + ",".join([format_spec % value for value in values]) + "]"
+
+
+def serialize_binary(vector: Sequence[float]) -> bytes:
+    """
+    Formats a vector in pgvector's binary form for the storage precision (vector or halfvec):
+    int16 dimensions, int16 unused, then big-endian float32 or float16 elements.
+    """
+    _storage_type() # Validates the precision
+    values = np.asarray(vector, dtype=BINARY_DTYPES[settings.EMBEDDING_STORAGE_PRECISION])
+    return struct.pack(">hh", len(values), 0) + values.tobytes()
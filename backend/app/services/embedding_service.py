@@ -1,10 +1,23 @@
 import openai
-from typing import List, Tuple
+from typing import List, Optional, Tuple
+from uuid import UUID
+import asyncio
 import logging
-import time
+
+import numpy as np
 
 from app.schemas.chunk import ChunkCreate
 from app.core.config import settings # To get OPENAI_API_KEY
+from app.services import circuit_breaker_service
+from app.services import embedding_backend_service
+from app.services import embedding_batching_service
+from app.services import embedding_cache_service
+from app.services import embedding_microbatch_service
+from app.services import embedding_profile_service
+from app.services import openai_client_service
+from app.services import openai_rate_limit_service
+from app.services import request_hedging_service
+from app.services import task_checkpoint_service
 
 logger = logging.getLogger(__name__)
 
@@ -20,97 +33,268 @@ else:
 OPENAI_MAX_RETRIES = 3
 OPENAI_RETRY_DELAY_SECONDS = 5 # Initial delay, can be exponential
 
+async def _request_embeddings(client, batch_texts: List[str], embedding_model: str):
+    return await client.embeddings.create(
+        input=batch_texts,
+        model=embedding_model,
+        encoding_format="base64",
+        **embedding_profile_service.request_options(embedding_model)
+    )
+
+async def _hedge_request(client, batch_texts: List[str], embedding_model: str, batch_token_count: int):
+    """A duplicate of a slow embedding request (see request_hedging_service); it takes its own rate permit."""
+    await openai_rate_limit_service.acquire_async(embedding_model, batch_token_count)
+    return await _request_embeddings(client, batch_texts, embedding_model)
+
+async def _embed_batch(
+    batch_index: int,
+    batch_texts: List[str],
+    embedding_model: str,
+    batch_token_count: int
+) -> Optional[np.ndarray]:
+    """
+    Requests embeddings for one batch on the shared async client, retrying transient errors.
+    Returns a float32 matrix (one row per text), or None if the batch still fails after
+    OPENAI_MAX_RETRIES attempts.
+
+    Raises circuit_breaker_service.CircuitOpenError instead of sleeping through retries
+    once repeated upstream failures (from any worker) have opened the OpenAI circuit breaker.
+    Requests running past the rolling latency deadline may be hedged (request_hedging_service).
+    """
+    client = openai_client_service.get_async_client()
+    logger.info(f"Requesting embeddings for batch {batch_index} of {len(batch_texts)} texts, ~{batch_token_count} tokens (model: {embedding_model})...")
+
+    for attempt in range(OPENAI_MAX_RETRIES):
+        await asyncio.to_thread(circuit_breaker_service.check)
+        try:
+            await openai_rate_limit_service.acquire_async(embedding_model, batch_token_count)
+            response = await request_hedging_service.run_hedged(
+                embedding_model,
+                lambda: _request_embeddings(client, batch_texts, embedding_model),
+                batch_token_count,
+                make_hedge=lambda: _hedge_request(client, batch_texts, embedding_model, batch_token_count)
+            )
+            
+            embeddings = embedding_batching_service.decode_embeddings([item.embedding for item in response.data])
+            
+            if len(embeddings) == len(batch_texts):
+                logger.info(f"Successfully received {len(embeddings)} embeddings for batch {batch_index}.")
+                await asyncio.to_thread(circuit_breaker_service.record_success)
+                return embeddings
+            logger.error(
+                f"Mismatch in number of embeddings received ({len(embeddings)}) "
+                f"and texts sent ({len(batch_texts)}) for batch {batch_index}."
+            )
+            if attempt == OPENAI_MAX_RETRIES - 1:
+                logger.error(f"Failed to get consistent embeddings for batch after {OPENAI_MAX_RETRIES} retries.")
+        
+        except openai.APIConnectionError as e:
+            logger.warning(f"OpenAI API connection error: {e}. Attempt {attempt + 1} of {OPENAI_MAX_RETRIES}.")
+            await asyncio.to_thread(circuit_breaker_service.record_failure)
+            if attempt < OPENAI_MAX_RETRIES - 1:
+                await asyncio.to_thread(circuit_breaker_service.check) # Fail fast rather than sleep through an outage
+                await asyncio.sleep(OPENAI_RETRY_DELAY_SECONDS * (attempt + 1)) # Exponential backoff
+            else:
+                logger.error(f"Failed to connect to OpenAI API after {OPENAI_MAX_RETRIES} attempts.")
+        except openai.RateLimitError as e:
+            logger.warning(f"OpenAI API rate limit exceeded: {e}. Attempt {attempt + 1} of {OPENAI_MAX_RETRIES}.")
+            if attempt < OPENAI_MAX_RETRIES - 1:
+                if openai_rate_limit_service.is_governed(embedding_model):
+                    # Slow down every worker through the shared governor; the next permit waits for budget
+                    await asyncio.to_thread(openai_rate_limit_service.report_rate_limited, embedding_model)
+                else:
+                    await asyncio.sleep(OPENAI_RETRY_DELAY_SECONDS * (attempt + 1) * 2) # Longer delay for rate limits
+            else:
+                logger.error(f"OpenAI API rate limit still exceeded after {OPENAI_MAX_RETRIES} attempts.")
+        except openai.APIStatusError as e: # Covers 5xx errors, etc.
+            logger.error(f"OpenAI API status error: {e.status_code} - {e.response}. Attempt {attempt + 1} of {OPENAI_MAX_RETRIES}.")
+            if circuit_breaker_service.is_breaker_failure(e):
+                await asyncio.to_thread(circuit_breaker_service.record_failure)
+            if attempt < OPENAI_MAX_RETRIES - 1:
+                await asyncio.to_thread(circuit_breaker_service.check) # Fail fast rather than sleep through an outage
+                await asyncio.sleep(OPENAI_RETRY_DELAY_SECONDS * (attempt + 1))
+            else:
+                logger.error(f"OpenAI API status error persisted after {OPENAI_MAX_RETRIES} attempts.")    
+        except Exception as e:
+            logger.error(f"An unexpected error occurred while fetching embeddings: {e}. Attempt {attempt + 1} of {OPENAI_MAX_RETRIES}.", exc_info=True)
+            if attempt < OPENAI_MAX_RETRIES - 1:
+                await asyncio.sleep(OPENAI_RETRY_DELAY_SECONDS)
+            else:
+                logger.error(f"Unexpected error persisted after {OPENAI_MAX_RETRIES} attempts.")
+    # If the failures opened the breaker, let the caller requeue instead of failing the batch
+    await asyncio.to_thread(circuit_breaker_service.check)
+    return None
+
+def _embed_texts(texts: List[str], token_counts: List[int], embedding_model: str) -> List[Optional[np.ndarray]]:
+    """
+    Embeds texts through the API: splits oversized inputs, packs requests up to the token and
+    item caps, and sends them with bounded concurrency. Returns one embedding per text, in
+    order (float32 row views of the per-request matrices); None for texts whose batch failed
+    after retries.
+    """
+    input_texts, input_token_counts, owners = embedding_batching_service.split_oversized_inputs(
+        texts, token_counts, embedding_model
+    )
+    batches = embedding_batching_service.pack_batches(input_token_counts)
+    logger.info(f"Packed {len(input_texts)} embedding inputs ({sum(input_token_counts)} tokens) into {len(batches)} requests.")
+
+    async def embed_batch(batch_index: int, batch: Tuple[int, int]) -> Optional[np.ndarray]:
+        start, end = batch
+        return await _embed_batch(batch_index, input_texts[start:end], embedding_model, sum(input_token_counts[start:end]))
+
+    batch_embeddings = openai_client_service.run_async(
+        openai_client_service.map_bounded(embed_batch, batches, settings.OPENAI_EMBEDDING_CONCURRENCY)
+    )
+
+    input_embeddings: List[Optional[np.ndarray]] = []
+    for (start, end), embeddings in zip(batches, batch_embeddings):
+        # Inputs of batches that failed after retries stay None; logged in _embed_batch
+        input_embeddings.extend(list(embeddings) if embeddings is not None else [None] * (end - start))
+    return embedding_batching_service.combine_split_embeddings(
+        input_embeddings, input_token_counts, owners, len(texts)
+    )
+
+class OpenAIEmbeddingBackend(embedding_backend_service.EmbeddingBackend):
+    """
+    The OpenAI embedding backend: calls are coalesced across tasks (embedding_microbatch_service),
+    packed into requests and sent concurrently by _embed_texts.
+    """
+
+    name = embedding_backend_service.OPENAI_BACKEND
+
+    def __init__(self, model: str, priority: Optional[str] = None):
+        self.model = model
+        self.priority = priority
+        self.dimensions = embedding_profile_service.get_dimensions(model)
+
+    @property
+    def cache_model(self) -> str:
+        return self.model
+
+    def embed(self, texts: List[str], token_counts: List[int]) -> List[Optional[np.ndarray]]:
+        def embed_direct(batch_texts: List[str], batch_token_counts: List[int]) -> List[Optional[np.ndarray]]:
+            return _embed_texts(batch_texts, batch_token_counts, self.model)
+
+        return embedding_microbatch_service.embed(texts, token_counts, self.model, embed_direct, self.priority)
+
+def _token_slices(token_counts: List[int], max_tokens: int) -> List[Tuple[int, int]]:
+    """Consecutive [start, end) ranges of about max_tokens tokens each (at least one item each)."""
+    slices, start, tokens = [], 0, 0
+    for i, token_count in enumerate(token_counts):
+        if i > start and tokens + token_count > max_tokens:
+            slices.append((start, i))
+            start, tokens = i, 0
+        tokens += token_count
+    if start < len(token_counts):
+        slices.append((start, len(token_counts)))
+    return slices
+
+def get_embedding_backend(
+    backend: str,
+    embedding_model: Optional[str] = None,
+    priority: Optional[str] = None
+) -> embedding_backend_service.EmbeddingBackend:
+    """Returns the embedding backend named `backend` ("openai" or "local")."""
+    if backend == embedding_backend_service.LOCAL_BACKEND:
+        return embedding_backend_service.get_local_backend()
+    if backend == embedding_backend_service.OPENAI_BACKEND:
+        return OpenAIEmbeddingBackend(embedding_model or settings.OPENAI_EMBEDDING_MODEL, priority)
+    raise ValueError(f"Unknown embedding backend '{backend}'. Use one of {embedding_backend_service.BACKENDS}.")
+
 def generate_embeddings_for_chunks(
     chunks_data: List[ChunkCreate],
-    embedding_model: str = None # Allow override, default to settings
-) -> List[Tuple[ChunkCreate, List[float]]]:
+    embedding_model: str = None, # Allow override, default to settings
+    priority: Optional[str] = None,
+    task_id: Optional[UUID] = None,
+    backend: Optional[str] = None
+) -> List[Tuple[ChunkCreate, np.ndarray]]:
     """
-    Generates embeddings for a list of ChunkCreate objects using the OpenAI API.
+    Generates embeddings for a list of ChunkCreate objects using the chatbot's embedding backend
+    (see embedding_backend_service): the OpenAI API by default, or a local CPU model.
+
+    With the OpenAI backend, requests are packed up to settings.OPENAI_EMBEDDING_MAX_TOKENS_PER_REQUEST tokens and
+    settings.OPENAI_EMBEDDING_BATCH_SIZE inputs (see embedding_batching_service), and sent through
+    the process-wide async client (kept-alive connections), with up to
+    settings.OPENAI_EMBEDDING_CONCURRENCY requests in flight at once. Results are reassembled
+    in input order. Chunks above the per-input token limit are embedded in pieces and combined.
+    Texts already in the embedding cache (see embedding_cache_service) are not sent again, and
+    small calls may be coalesced with those of concurrent tasks (see embedding_microbatch_service).
+    The output dimensions follow the embedding profile (see embedding_profile_service).
+    With a task_id, chunks are embedded in slices of about one round of concurrent requests,
+    and each slice is checkpointed for the task as it returns (see task_checkpoint_service), so
+    a retry of the task only requests the chunks still missing.
 
     Args:
         chunks_data: A list of ChunkCreate objects, each containing chunk_text.
         embedding_model: The name of the OpenAI embedding model to use. 
                          If None, uses settings.OPENAI_EMBEDDING_MODEL.
+        priority: Micro-batching lane ("high" or "bulk"); chosen from the call size if None.
+        task_id: Task whose embedding checkpoint is read and extended; no checkpointing if None.
+        backend: "openai" or "local"; settings.EMBEDDING_BACKEND if None.
 
     Returns:
         A list of tuples, where each tuple is (ChunkCreate_object, embedding_vector).
+        The vectors are float32 row views of one contiguous matrix; they are only converted
+        for the database in crud_chunk.
+        Chunks of batches that failed after all retries are left out.
         Returns an empty list if no API key is configured or if input is empty.
+
+    Raises:
+        circuit_breaker_service.CircuitOpenError: If the OpenAI circuit breaker is open.
     """
-    actual_embedding_model = embedding_model if embedding_model else settings.OPENAI_EMBEDDING_MODEL
+    if not chunks_data:
+        return []
 
-    if not openai.api_key:
+    backend = backend or embedding_backend_service.resolve_backend()
+    if backend == embedding_backend_service.OPENAI_BACKEND and not openai.api_key:
         logger.error("OpenAI API key is not configured. Cannot generate embeddings.")
         return []
-    
-    if not chunks_data:
-        return []
+    embedding_backend = get_embedding_backend(backend, embedding_model, priority)
+    cache_model, dimensions = embedding_backend.cache_model, embedding_backend.dimensions
 
-    results: List[Tuple[ChunkCreate, List[float]]] = []
-    texts_to_embed = [chunk.chunk_text for chunk in chunks_data]
+    texts = [chunk.chunk_text for chunk in chunks_data]
+    token_counts = [chunk.token_count for chunk in chunks_data]
+    chunk_embeddings: List[Optional[np.ndarray]] = [None] * len(chunks_data)
+    if task_id is not None:
+        checkpoint_keys = [embedding_cache_service.make_cache_key(cache_model, text, dimensions) for text in texts]
+        checkpointed = task_checkpoint_service.load_embeddings(task_id, list(dict.fromkeys(checkpoint_keys)))
+        chunk_embeddings = [checkpointed.get(key) for key in checkpoint_keys]
+        if checkpointed:
+            restored = sum(embedding is not None for embedding in chunk_embeddings)
+            logger.info(f"[Task ID: {task_id}] Restored {restored}/{len(chunks_data)} embeddings from checkpoint.")
 
-    for i in range(0, len(texts_to_embed), settings.OPENAI_EMBEDDING_BATCH_SIZE):
-        batch_texts = texts_to_embed[i:i + settings.OPENAI_EMBEDDING_BATCH_SIZE]
-        original_chunks_in_batch = chunks_data[i:i + settings.OPENAI_EMBEDDING_BATCH_SIZE]
-        
-        logger.info(f"Requesting embeddings for batch of {len(batch_texts)} texts (model: {actual_embedding_model})...")
-        
-        for attempt in range(OPENAI_MAX_RETRIES):
-            try:
-                # Ensure client is initialized (if not done globally)
-                # For openai >v1.0.0, client initialization is different
-                client = openai.OpenAI(api_key=settings.OPENAI_API_KEY)
-                response = client.embeddings.create(
-                    input=batch_texts,
-                    model=actual_embedding_model
-                )
-                
-                embeddings = [item.embedding for item in response.data]
-                
-                if len(embeddings) == len(original_chunks_in_batch):
-                    for original_chunk, embedding_vector in zip(original_chunks_in_batch, embeddings):
-                        results.append((original_chunk, embedding_vector))
-                    logger.info(f"Successfully received {len(embeddings)} embeddings for the batch.")
-                    break  # Success, exit retry loop for this batch
-                else:
-                    logger.error(
-                        f"Mismatch in number of embeddings received ({len(embeddings)}) "
-                        f"and texts sent ({len(original_chunks_in_batch)}) for batch starting at index {i}."
-                    )
-                    # Decide if this error warrants a retry or should fail the batch
-                    if attempt == OPENAI_MAX_RETRIES - 1:
-                        logger.error(f"Failed to get consistent embeddings for batch after {OPENAI_MAX_RETRIES} retries.")
-                        # Optionally, you could append None or raise an exception for chunks in this failed batch
-                    # else: continue to next retry
-            
-            except openai.APIConnectionError as e:
-                logger.warning(f"OpenAI API connection error: {e}. Attempt {attempt + 1} of {OPENAI_MAX_RETRIES}.")
-                if attempt < OPENAI_MAX_RETRIES - 1:
-                    time.sleep(OPENAI_RETRY_DELAY_SECONDS * (attempt + 1)) # Exponential backoff
-                else:
-                    logger.error(f"Failed to connect to OpenAI API after {OPENAI_MAX_RETRIES} attempts.")
-                    # Propagate error or handle: here we just log and this batch will be skipped from results
-            except openai.RateLimitError as e:
-                logger.warning(f"OpenAI API rate limit exceeded: {e}. Attempt {attempt + 1} of {OPENAI_MAX_RETRIES}.")
-                if attempt < OPENAI_MAX_RETRIES - 1:
-                    time.sleep(OPENAI_RETRY_DELAY_SECONDS * (attempt + 1) * 2) # Longer delay for rate limits
-                else:
-                    logger.error(f"OpenAI API rate limit still exceeded after {OPENAI_MAX_RETRIES} attempts.")
-            except openai.APIStatusError as e: # Covers 5xx errors, etc.
-                logger.error(f"OpenAI API status error: {e.status_code} - {e.response}. Attempt {attempt + 1} of {OPENAI_MAX_RETRIES}.")
-                if attempt < OPENAI_MAX_RETRIES - 1:
-                    time.sleep(OPENAI_RETRY_DELAY_SECONDS * (attempt + 1))
-                else:
-                    logger.error(f"OpenAI API status error persisted after {OPENAI_MAX_RETRIES} attempts.")    
-            except Exception as e:
-                logger.error(f"An unexpected error occurred while fetching embeddings: {e}. Attempt {attempt + 1} of {OPENAI_MAX_RETRIES}.", exc_info=True)
-                if attempt < OPENAI_MAX_RETRIES - 1:
-                    time.sleep(OPENAI_RETRY_DELAY_SECONDS)
-                else:
-                    logger.error(f"Unexpected error persisted after {OPENAI_MAX_RETRIES} attempts.")
-            else: # No exception in try block for this attempt
-                if len(embeddings) == len(original_chunks_in_batch):
-                    break # Successful and embeddings match count
-                # If mismatch but no exception, it was logged, try next attempt or fail if last attempt
+    remaining = [i for i, embedding in enumerate(chunk_embeddings) if embedding is None]
+    remaining_texts = [texts[i] for i in remaining]
+
+    def embed_missing(indices: List[int]) -> List[Optional[np.ndarray]]:
+        missing_texts = [remaining_texts[i] for i in indices]
+        missing_token_counts = [token_counts[remaining[i]] for i in indices]
+        if task_id is None:
+            return embedding_backend.embed(missing_texts, missing_token_counts)
+        # The task checkpoints its own slice once the backend returns it. Requests themselves may
+        # be micro-batch flushes that also embed other tasks' texts, in whichever task flushed them.
+        slice_tokens = settings.OPENAI_EMBEDDING_MAX_TOKENS_PER_REQUEST * max(1, settings.OPENAI_EMBEDDING_CONCURRENCY)
+        embeddings: List[Optional[np.ndarray]] = []
+        for start, end in _token_slices(missing_token_counts, slice_tokens):
+            slice_embeddings = embedding_backend.embed(missing_texts[start:end], missing_token_counts[start:end])
+            task_checkpoint_service.save_embeddings(task_id, {
+                embedding_cache_service.make_cache_key(cache_model, text, dimensions): embedding
+                for text, embedding in zip(missing_texts[start:end], slice_embeddings) if embedding is not None
+            })
+            embeddings.extend(slice_embeddings)
+        return embeddings
+
+    if remaining:
+        remaining_embeddings = embedding_cache_service.embed_with_cache(remaining_texts, cache_model, embed_missing, dimensions)
+        for i, embedding in zip(remaining, remaining_embeddings):
+            chunk_embeddings[i] = embedding
+
+    embedded = [i for i, embedding in enumerate(chunk_embeddings) if embedding is not None]
+    results: List[Tuple[ChunkCreate, np.ndarray]] = []
+    if embedded:
+        # One contiguous float32 matrix; each chunk gets a (zero-copy) row view of it
+        matrix = np.stack([chunk_embeddings[i] for i in embedded]).astype(np.float32, copy=False)
+        results = [(chunks_data[i], row) for i, row in zip(embedded, matrix)]
 
     if len(results) != len(chunks_data):
         logger.warning(f"Could not generate embeddings for all chunks. Expected {len(chunks_data)}, got {len(results)}.")
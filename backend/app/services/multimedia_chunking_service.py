@@ -3,6 +3,9 @@ import math
 from typing import List, Dict, Any, Optional
 from uuid import UUID
 
+from app.core.config import settings
+from app.services.tokenizer_service import count_tokens_batch
+
 logger = logging.getLogger(__name__)
 
 class MultimediaChunkingService:
@@ -91,9 +94,18 @@ class MultimediaChunkingService:
             # Move to next chunk with overlap
             current_start += (chunk_duration - overlap_duration)
         
+        self._attach_token_counts(chunks)
         logger.info(f"[Task ID: {task_uuid}] Created {len(chunks)} time-based chunks")
         return chunks
     
+    def _attach_token_counts(self, chunks: List[Dict[str, Any]]) -> None:
+        """Counts tokens for all chunk texts in one batch call and stores them on the chunks."""
+        token_counts = count_tokens_batch(
+            [chunk["text"] for chunk in chunks], settings.OPENAI_EMBEDDING_MODEL
+        )
+        for chunk, token_count in zip(chunks, token_counts):
+            chunk["token_count"] = token_count
+    
     def _create_chunk_from_timerange(
         self,
         task_uuid: UUID,
@@ -236,7 +248,7 @@ class MultimediaChunkingService:
         if not full_transcript.strip():
             return []
         
-        return [{
+        chunks = [{
             "chunk_id": 0,
             "reference_id": str(reference_id),
             "chatbot_id": str(chatbot_id),
@@ -255,6 +267,8 @@ class MultimediaChunkingService:
             "segments": [],
             "words": []
         }]
+        self._attach_token_counts(chunks)
+        return chunks
     
     def optimize_chunk_boundaries(
         self,
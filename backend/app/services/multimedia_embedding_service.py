@@ -1,11 +1,20 @@
 import logging
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, Optional, Tuple
 from uuid import UUID
 import time
+import numpy as np
 import openai
 from openai import OpenAI
 
 from app.core.config import settings
+from app.services import circuit_breaker_service
+from app.services import embedding_backend_service
+from app.services import embedding_batching_service
+from app.services import embedding_cache_service
+from app.services import embedding_microbatch_service
+from app.services import embedding_profile_service
+from app.services import openai_rate_limit_service
+from app.services import tokenizer_service
 
 logger = logging.getLogger(__name__)
 
@@ -17,7 +26,6 @@ class MultimediaEmbeddingService:
     
     # Embedding configuration
     DEFAULT_EMBEDDING_MODEL = "text-embedding-3-small"  # Cost-effective for multimedia
-    BATCH_SIZE = 100  # Process chunks in batches
     MAX_RETRIES = 3
     RETRY_DELAY_SECONDS = 2
     
@@ -34,76 +42,131 @@ class MultimediaEmbeddingService:
         self,
         task_uuid: UUID,
         chunks: List[Dict[str, Any]],
-        embedding_model: str = None
+        embedding_model: str = None,
+        priority: Optional[str] = None,
+        backend: Optional[str] = None
     ) -> List[Dict[str, Any]]:
         """
         Generate embeddings for multimedia chunks with their metadata.
         
+        Embeddings come from the chatbot's embedding backend (see embedding_backend_service).
+        Texts already in the embedding cache are not embedded again. With the OpenAI backend, the
+        rest are sent in requests packed up to the token and item caps by
+        embedding_batching_service, and small calls may be coalesced with those of concurrent
+        tasks (embedding_microbatch_service).
+        
         Args:
             task_uuid: Task identifier for logging
             chunks: List of chunk dictionaries from multimedia chunking service
             embedding_model: OpenAI embedding model to use
+            priority: Micro-batching lane ("high" or "bulk"); chosen from the call size if None
+            backend: "openai" or "local"; settings.EMBEDDING_BACKEND if None
             
         Returns:
-            List of chunk dictionaries with embeddings added
+            List of chunk dictionaries with embeddings added (float32 row views of one matrix)
         """
-        if not self.client:
-            logger.error(f"[Task ID: {task_uuid}] OpenAI client not initialized")
-            return []
-        
         if not chunks:
             logger.warning(f"[Task ID: {task_uuid}] No chunks provided for embedding")
             return []
         
-        model = embedding_model or self.DEFAULT_EMBEDDING_MODEL
-        logger.info(f"[Task ID: {task_uuid}] Generating embeddings for {len(chunks)} chunks using {model}")
+        backend = backend or embedding_backend_service.resolve_backend()
+        if backend == embedding_backend_service.OPENAI_BACKEND and not self.client:
+            logger.error(f"[Task ID: {task_uuid}] OpenAI client not initialized")
+            return []
         
-        chunks_with_embeddings = []
+        # Create enhanced text for embedding that includes context
+        texts = [self._create_enhanced_text_for_embedding(chunk) for chunk in chunks]
         
-        # Process chunks in batches
-        for i in range(0, len(chunks), self.BATCH_SIZE):
-            batch_chunks = chunks[i:i + self.BATCH_SIZE]
-            batch_start = i + 1
-            batch_end = min(i + self.BATCH_SIZE, len(chunks))
+        if backend == embedding_backend_service.LOCAL_BACKEND:
+            local_backend = embedding_backend_service.get_local_backend()
+            model, cache_model, dimensions = local_backend.model_name, local_backend.cache_model, None
             
-            logger.info(f"[Task ID: {task_uuid}] Processing batch {batch_start}-{batch_end} of {len(chunks)}")
-            
-            # Extract texts for embedding
-            batch_texts = []
-            for chunk in batch_chunks:
-                # Create enhanced text for embedding that includes context
-                enhanced_text = self._create_enhanced_text_for_embedding(chunk)
-                batch_texts.append(enhanced_text)
+            def embed_missing(indices: List[int]) -> List[Optional[np.ndarray]]:
+                missing_texts = [texts[i] for i in indices]
+                return local_backend.embed(missing_texts, [0] * len(missing_texts))
+        else:
+            model = cache_model = embedding_model or self.DEFAULT_EMBEDDING_MODEL
+            dimensions = embedding_profile_service.get_dimensions(model)
             
-            # Generate embeddings for this batch
-            batch_embeddings = self._generate_batch_embeddings(
-                task_uuid, batch_texts, model
-            )
+            def embed_direct(batch_texts: List[str], batch_token_counts: List[int]) -> List[Optional[np.ndarray]]:
+                return self._embed_texts(task_uuid, batch_texts, batch_token_counts, model)
             
-            if batch_embeddings and len(batch_embeddings) == len(batch_chunks):
-                # Add embeddings to chunks
-                for chunk, embedding in zip(batch_chunks, batch_embeddings):
-                    chunk_with_embedding = chunk.copy()
-                    chunk_with_embedding["embedding"] = embedding
-                    chunk_with_embedding["embedding_model"] = model
-                    chunk_with_embedding["embedding_dimensions"] = len(embedding)
-                    chunks_with_embeddings.append(chunk_with_embedding)
-                
-                logger.info(f"[Task ID: {task_uuid}] Successfully embedded batch {batch_start}-{batch_end}")
+            def embed_missing(indices: List[int]) -> List[Optional[np.ndarray]]:
+                missing_texts = [texts[i] for i in indices]
+                # Token counts are taken on the enhanced text (the chunk's own token_count does not
+                # include the context prefix)
+                token_counts = tokenizer_service.count_tokens_batch(missing_texts, model)
+                try:
+                    return embedding_microbatch_service.embed(missing_texts, token_counts, model, embed_direct, priority)
+                except circuit_breaker_service.CircuitOpenError as e:
+                    logger.error(f"[Task ID: {task_uuid}] Embedding skipped: {e}")
+                    return [None] * len(missing_texts)
+        
+        logger.info(f"[Task ID: {task_uuid}] Generating embeddings for {len(chunks)} chunks using {model} ({backend} backend)")
+        chunk_embeddings = embedding_cache_service.embed_with_cache(texts, cache_model, embed_missing, dimensions)
+        
+        # Successful embeddings go into one contiguous float32 matrix; chunks get row views of it
+        embedded = [i for i, embedding in enumerate(chunk_embeddings) if embedding is not None]
+        if embedded:
+            matrix = np.stack([chunk_embeddings[i] for i in embedded]).astype(np.float32, copy=False)
+            for i, row in zip(embedded, matrix):
+                chunk_embeddings[i] = row
+        
+        chunks_with_embeddings = []
+        for chunk, embedding in zip(chunks, chunk_embeddings):
+            chunk_with_embedding = chunk.copy() # Shallow: the embedding row itself is never copied
+            if embedding is not None:
+                chunk_with_embedding["embedding"] = embedding
+                chunk_with_embedding["embedding_model"] = model
+                chunk_with_embedding["embedding_dimensions"] = len(embedding)
             else:
-                logger.error(f"[Task ID: {task_uuid}] Failed to embed batch {batch_start}-{batch_end}")
                 # Add chunks without embeddings (for debugging)
-                for chunk in batch_chunks:
-                    chunk_with_embedding = chunk.copy()
-                    chunk_with_embedding["embedding"] = None
-                    chunk_with_embedding["embedding_error"] = "Failed to generate embedding"
-                    chunks_with_embeddings.append(chunk_with_embedding)
+                chunk_with_embedding["embedding"] = None
+                chunk_with_embedding["embedding_error"] = "Failed to generate embedding"
+            chunks_with_embeddings.append(chunk_with_embedding)
         
         successful_embeddings = sum(1 for chunk in chunks_with_embeddings if chunk.get("embedding") is not None)
         logger.info(f"[Task ID: {task_uuid}] Embedding complete: {successful_embeddings}/{len(chunks)} successful")
         
         return chunks_with_embeddings
     
+    def _embed_texts(
+        self,
+        task_uuid: UUID,
+        texts: List[str],
+        token_counts: List[int],
+        model: str
+    ) -> List[Optional[np.ndarray]]:
+        """
+        Embed texts in requests packed up to the token and item caps. Returns one embedding
+        per text (None where the batch failed).
+        """
+        input_texts, input_token_counts, owners = embedding_batching_service.split_oversized_inputs(
+            texts, token_counts, model
+        )
+        batches = embedding_batching_service.pack_batches(input_token_counts)
+        logger.info(f"[Task ID: {task_uuid}] Packed {len(input_texts)} embedding inputs ({sum(input_token_counts)} tokens) into {len(batches)} requests")
+        
+        input_embeddings = []
+        for batch_number, (start, end) in enumerate(batches, start=1):
+            logger.info(f"[Task ID: {task_uuid}] Processing batch {batch_number}/{len(batches)} ({end - start} inputs, {sum(input_token_counts[start:end])} tokens)")
+            
+            # Generate embeddings for this batch
+            batch_embeddings = self._generate_batch_embeddings(
+                task_uuid, input_texts[start:end], model, sum(input_token_counts[start:end])
+            )
+            
+            if batch_embeddings is not None and len(batch_embeddings) == end - start:
+                input_embeddings.extend(list(batch_embeddings))
+                logger.info(f"[Task ID: {task_uuid}] Successfully embedded batch {batch_number}/{len(batches)}")
+            else:
+                logger.error(f"[Task ID: {task_uuid}] Failed to embed batch {batch_number}/{len(batches)}")
+                input_embeddings.extend([None] * (end - start))
+        
+        return embedding_batching_service.combine_split_embeddings(
+            input_embeddings, input_token_counts, owners, len(texts)
+        )
+    
     def _create_enhanced_text_for_embedding(self, chunk: Dict[str, Any]) -> str:
         """
         Create enhanced text for embedding that includes temporal and contextual information.
@@ -141,26 +204,40 @@ class MultimediaEmbeddingService:
         self,
         task_uuid: UUID,
         texts: List[str],
-        model: str
-    ) -> List[List[float]]:
-        """Generate embeddings for a batch of texts with retry logic."""
+        model: str,
+        token_count: int = 0
+    ) -> Optional[np.ndarray]:
+        """
+        Generate embeddings for a batch of texts with retry logic (rate-governed by token_count).
+        Returns a float32 matrix with one row per text, or None on failure.
+        """
         
         for attempt in range(self.MAX_RETRIES):
+            try:
+                circuit_breaker_service.check()
+            except circuit_breaker_service.CircuitOpenError as e:
+                # Fail the batch fast instead of sleeping through an upstream outage
+                logger.error(f"[Task ID: {task_uuid}] Skipping embedding attempt: {e}")
+                return None
             try:
                 logger.debug(f"[Task ID: {task_uuid}] Embedding attempt {attempt + 1} for {len(texts)} texts")
                 
+                openai_rate_limit_service.acquire(model, token_count)
                 start_time = time.time()
                 response = self.client.embeddings.create(
                     input=texts,
-                    model=model
+                    model=model,
+                    encoding_format="base64",
+                    **embedding_profile_service.request_options(model)
                 )
                 api_duration = time.time() - start_time
                 
-                embeddings = [item.embedding for item in response.data]
+                embeddings = embedding_batching_service.decode_embeddings([item.embedding for item in response.data])
                 
                 logger.debug(f"[Task ID: {task_uuid}] Embedding API call completed in {api_duration:.2f}s")
                 
                 if len(embeddings) == len(texts):
+                    circuit_breaker_service.record_success()
                     return embeddings
                 else:
                     logger.warning(f"[Task ID: {task_uuid}] Embedding count mismatch: "
@@ -168,16 +245,23 @@ class MultimediaEmbeddingService:
                     
             except openai.APIConnectionError as e:
                 logger.warning(f"[Task ID: {task_uuid}] OpenAI connection error (attempt {attempt + 1}): {e}")
+                circuit_breaker_service.record_failure()
                 if attempt < self.MAX_RETRIES - 1:
                     time.sleep(self.RETRY_DELAY_SECONDS * (attempt + 1))
                     
             except openai.RateLimitError as e:
                 logger.warning(f"[Task ID: {task_uuid}] Rate limit error (attempt {attempt + 1}): {e}")
                 if attempt < self.MAX_RETRIES - 1:
-                    time.sleep(self.RETRY_DELAY_SECONDS * (attempt + 1) * 2)
+                    if openai_rate_limit_service.is_governed(model):
+                        # Slow down every worker through the shared governor; the next permit waits for budget
+                        openai_rate_limit_service.report_rate_limited(model)
+                    else:
+                        time.sleep(self.RETRY_DELAY_SECONDS * (attempt + 1) * 2)
                     
             except openai.APIStatusError as e:
                 logger.error(f"[Task ID: {task_uuid}] OpenAI API error (attempt {attempt + 1}): {e}")
+                if circuit_breaker_service.is_breaker_failure(e):
+                    circuit_breaker_service.record_failure()
                 if attempt < self.MAX_RETRIES - 1:
                     time.sleep(self.RETRY_DELAY_SECONDS * (attempt + 1))
                     
@@ -187,7 +271,7 @@ class MultimediaEmbeddingService:
                     time.sleep(self.RETRY_DELAY_SECONDS)
         
         logger.error(f"[Task ID: {task_uuid}] Failed to generate embeddings after {self.MAX_RETRIES} attempts")
-        return []
+        return None
     
     def get_embedding_stats(self, chunks_with_embeddings: List[Dict[str, Any]]) -> Dict[str, Any]:
         """Get statistics about the generated embeddings."""
@@ -198,7 +282,7 @@ class MultimediaEmbeddingService:
         # Get embedding dimensions (should be consistent)
         embedding_dims = None
         for chunk in chunks_with_embeddings:
-            if chunk.get("embedding"):
+            if chunk.get("embedding") is not None:
                 embedding_dims = len(chunk["embedding"])
                 break
         
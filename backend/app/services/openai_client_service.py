@@ -0,0 +1,104 @@
+# SHARED ASYNC OPENAI CLIENT
+#
+# Celery tasks are synchronous, and creating an openai.OpenAI client per request (or per retry)
+# means a fresh connection pool and TLS handshake every time. This module keeps one
+# openai.AsyncOpenAI client per worker process, living on a dedicated background event loop, so
+# its keep-alive connections are reused by every task the process runs:
+#
+# - Synchronous code submits coroutines with run_async(); they run on the background loop.
+# - The httpx connection pool of an async client is bound to the loop it was created on, which
+#   is why the loop is long-lived instead of a new asyncio.run() per call.
+# - Celery's prefork pool forks worker processes, so the loop and client are created lazily and
+#   re-created if the process id changes.
+# - The client does not retry on its own (max_retries=0). Callers own the whole retry policy:
+#   embedding_service._embed_batch makes up to OPENAI_MAX_RETRIES attempts, and every attempt goes
+#   through the circuit breaker and the shared rate governor. SDK retries inside an attempt would
+#   multiply the attempts (the per-request clients used before made 3 x 3 requests) and hide 429s
+#   and 5xx errors from the governor and the breaker.
+
+import asyncio
+import logging
+import os
+import threading
+from typing import Any, Awaitable, Callable, Coroutine, List, Optional, Sequence, TypeVar
+
+import openai
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+_lock = threading.Lock()
+_owner_pid: Optional[int] = None
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_thread: Optional[threading.Thread] = None
+_client: Optional[openai.AsyncOpenAI] = None
+
+
+def _ensure_loop() -> asyncio.AbstractEventLoop:
+    global _owner_pid, _loop, _loop_thread, _client
+    if _loop is not None and _owner_pid == os.getpid():
+        return _loop
+    with _lock:
+        if _loop is None or _owner_pid != os.getpid():
+            # After a fork the parent's loop thread does not exist in this process; start over.
+            _loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(target=_loop.run_forever, name="openai-client-loop", daemon=True)
+            _loop_thread.start()
+            _client = None
+            _owner_pid = os.getpid()
+    return _loop
+
+
+def get_async_client() -> openai.AsyncOpenAI:
+    """
+    Returns the process-wide AsyncOpenAI client. Only use it from coroutines running
+    through run_async(), i.e. on the shared background loop.
+    """
+    global _client
+    _ensure_loop()
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = openai.AsyncOpenAI(
+                    api_key=settings.OPENAI_API_KEY,
+                    max_retries=0, # Retried by callers, through the circuit breaker and rate governor (see above)
+                    timeout=settings.OPENAI_REQUEST_TIMEOUT_SECONDS,
+                )
+    return _client
+
+
+def run_async(coroutine: Coroutine[Any, Any, T]) -> T:
+    """Runs a coroutine on the shared background loop and blocks until it finishes."""
+    loop = _ensure_loop()
+    return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+
+async def map_bounded(
+    function: Callable[[int, T], Awaitable[R]],
+    items: Sequence[T],
+    concurrency: int
+) -> List[R]:
+    """
+    Awaits function(index, item) for every item with at most `concurrency` calls in flight,
+    returning the results in input order. If any call raises, the calls still running or
+    waiting are cancelled (and awaited) before the exception propagates.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def run(index: int, item: T) -> R:
+        async with semaphore:
+            return await function(index, item)
+
+    tasks = [asyncio.ensure_future(run(index, item)) for index, item in enumerate(items)]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
@@ -0,0 +1,151 @@
+# OPENAI RATE GOVERNOR
+#
+# Reacting to RateLimitError with in-worker back-off made throughput oscillate: every worker
+# bursts, all get throttled together, and all sleep while holding Celery slots. Instead, every
+# OpenAI call first takes a permit from a token bucket shared through Redis (the Celery broker):
+#
+# - One bucket pair per model: requests per minute and tokens per minute, from OPENAI_RATE_LIMITS
+#   (models without an entry are not governed).
+# - Buckets refill continuously at OPENAI_RATE_LIMIT_UTILIZATION of the quota and hold at most
+#   OPENAI_RATE_LIMIT_BURST_SECONDS worth of budget, so load is spread evenly just under quota
+#   instead of arriving in bursts.
+# - A call larger than the bucket (e.g. a 290k-token embedding request) is let through once the
+#   bucket is full and leaves it in debt, so the average rate still holds.
+# - Refill and take happen atomically in a Lua script using Redis server time, so all workers in
+#   all containers see one consistent budget.
+# - A RateLimitError despite the governor (e.g. another service sharing the API key) empties the
+#   model's buckets, slowing every worker down rather than only the one that was throttled.
+# - If Redis is unavailable, permits are granted immediately (the callers' retry handling remains).
+
+import asyncio
+import logging
+import time
+from typing import Optional, Tuple
+
+import redis
+
+from app.core.config import settings
+from app.core.redis_client import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "syllabi:openai_rate"
+BUCKET_TTL_SECONDS = 3600
+
+# KEYS[1]: bucket hash. ARGV: request rate/capacity/cost, token rate/capacity/cost, drain flag.
+# Returns the seconds to wait before retrying (as a string); "0" means the permit was granted.
+_ACQUIRE_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local request_rate, request_capacity, request_cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local token_rate, token_capacity, token_cost = tonumber(ARGV[4]), tonumber(ARGV[5]), tonumber(ARGV[6])
+local state = redis.call('HMGET', KEYS[1], 'requests', 'tokens', 'updated_at')
+local requests = tonumber(state[1]) or request_capacity
+local tokens = tonumber(state[2]) or token_capacity
+local elapsed = math.max(0, now - (tonumber(state[3]) or now))
+requests = math.min(request_capacity, requests + elapsed * request_rate)
+tokens = math.min(token_capacity, tokens + elapsed * token_rate)
+
+local wait = 0
+if ARGV[7] == '1' then
+    requests = math.min(requests, 0)
+    tokens = math.min(tokens, 0)
+else
+    if request_rate > 0 and requests < math.min(request_cost, request_capacity) then
+        wait = math.max(wait, (math.min(request_cost, request_capacity) - requests) / request_rate)
+    end
+    if token_rate > 0 and tokens < math.min(token_cost, token_capacity) then
+        wait = math.max(wait, (math.min(token_cost, token_capacity) - tokens) / token_rate)
+    end
+    if wait == 0 then
+        requests = requests - request_cost
+        tokens = tokens - token_cost
+    end
+end
+redis.call('HSET', KEYS[1], 'requests', requests, 'tokens', tokens, 'updated_at', now)
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[8]))
+return tostring(wait)
+"""
+
+_script = None
+
+
+def _get_limits(model: str) -> Optional[Tuple[float, float]]:
+    """Returns (requests_per_minute, tokens_per_minute) for a governed model, else None."""
+    limits = settings.OPENAI_RATE_LIMITS.get(model)
+    if not limits:
+        return None
+    return float(limits.get("rpm", 0)), float(limits.get("tpm", 0))
+
+
+def is_governed(model: str) -> bool:
+    """True if permits are enforced for this model (it has an OPENAI_RATE_LIMITS entry)."""
+    return _get_limits(model) is not None
+
+
+def _run_script(model: str, tokens: int, drain: bool = False) -> float:
+    global _script
+    limits = _get_limits(model)
+    if limits is None:
+        return 0.0
+    client = get_redis_client(settings.OPENAI_RATE_LIMIT_REDIS_URL)
+    if _script is None or _script.registered_client is not client:
+        _script = client.register_script(_ACQUIRE_SCRIPT)
+    request_rate, token_rate = (limit * settings.OPENAI_RATE_LIMIT_UTILIZATION / 60 for limit in limits)
+    burst = settings.OPENAI_RATE_LIMIT_BURST_SECONDS
+    wait = _script(
+        keys=[f"{KEY_PREFIX}:{model}"],
+        args=[
+            request_rate, max(request_rate * burst, 1), 1,
+            token_rate, max(token_rate * burst, 1), tokens,
+            "1" if drain else "0", BUCKET_TTL_SECONDS,
+        ],
+    )
+    return float(wait)
+
+
+def try_acquire(model: str, tokens: int = 0) -> float:
+    """
+    Takes a permit for one request of `tokens` tokens if the budget allows.
+    Returns 0.0 if granted, otherwise the seconds to wait before trying again.
+    """
+    try:
+        return _run_script(model, tokens)
+    except redis.RedisError as e:
+        logger.warning(f"OpenAI rate governor unavailable ({e}). Granting permit for {model} without limiting.")
+        return 0.0
+
+
+def acquire(model: str, tokens: int = 0) -> float:
+    """Blocks until a permit is granted. Returns the total seconds waited."""
+    waited = 0.0
+    while True:
+        wait = try_acquire(model, tokens)
+        if wait <= 0:
+            if waited:
+                logger.debug(f"Rate governor held a {model} request ({tokens} tokens) for {waited:.2f}s.")
+            return waited
+        time.sleep(wait)
+        waited += wait
+
+
+async def acquire_async(model: str, tokens: int = 0) -> float:
+    """Same as acquire(), for coroutines: waits without blocking the event loop."""
+    waited = 0.0
+    while True:
+        wait = await asyncio.to_thread(try_acquire, model, tokens)
+        if wait <= 0:
+            if waited:
+                logger.debug(f"Rate governor held a {model} request ({tokens} tokens) for {waited:.2f}s.")
+            return waited
+        await asyncio.sleep(wait)
+        waited += wait
+
+
+def report_rate_limited(model: str) -> None:
+    """Empties the model's buckets after a RateLimitError, so all workers slow down."""
+    try:
+        _run_script(model, 0, drain=True)
+        logger.info(f"Rate governor buckets for {model} drained after a rate limit response.")
+    except redis.RedisError as e:
+        logger.warning(f"Could not drain rate governor buckets for {model}: {e}")
@@ -0,0 +1,314 @@
+# PARSE CACHE
+#
+# Parsing is the most expensive CPU stage of indexing, and re-indexing a reference (e.g. after
+# changing chunk settings) used to re-parse a file that had not changed. Parsed output is cached
+# under the SHA-256 of the file bytes plus the parser backend and version:
+#
+# - An entry is a sequence of frames in PARSE_CACHE_DIR, each a ParsedDocument.to_bytes() blob
+#   (compressed .npz, no pickle) for a run of consecutive pages, prefixed with its length and CRC-32.
+# - On a miss, parts are appended to a temporary file as they are parsed (about FRAME_TARGET_BYTES
+#   of parsed pages per frame) and the file is renamed into place once parsing finishes, so a cold
+#   parse never holds the whole document. Hits are validated, then streamed frame by frame.
+# - Reads refresh an entry's mtime; writes evict least recently used entries beyond PARSE_CACHE_MAX_BYTES.
+# - If PARSE_CACHE_BUCKET is set, entries are also mirrored to that Supabase storage bucket, so a
+#   worker that has not seen the file yet can still skip parsing.
+# - The raw parser output is cached (before coalescing/chunking), so changes to element granularity
+#   or chunk settings still hit the cache.
+# - Cache failures are logged and treated as misses; they never fail indexing.
+
+import hashlib
+import logging
+import os
+import struct
+import tempfile
+import zlib
+from typing import Iterator, List, Optional, Tuple
+
+from app.core.config import settings
+from app.core.supabase_client import get_supabase_client
+from app.schemas.parsed_document import ParsedDocument
+from app.services import pdf_parsing_service
+
+logger = logging.getLogger(__name__)
+
+CACHE_FILE_SUFFIX = ".parse"
+LEGACY_CACHE_FILE_SUFFIXES = (".npz",) # Whole-document entries of the previous format; only aged out by eviction
+ENTRY_MAGIC = b"SYLLABI-PARSE\x00\x00\x01"
+FRAME_HEADER = struct.Struct(">QI") # Blob length, CRC-32 of the blob
+FRAME_TARGET_BYTES = 8 * 1024 * 1024 # Parsed pages (ParsedDocument.nbytes) buffered per frame on a miss
+HASH_READ_BLOCK_SIZE = 1024 * 1024
+
+
+def compute_file_hash(file_path: str) -> str:
+    """Returns the hex SHA-256 of a file, read in blocks."""
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_READ_BLOCK_SIZE), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def _cache_key(file_hash: str, parser_type: str) -> str:
+    return f"{file_hash}-{pdf_parsing_service.get_parser_version(parser_type)}"
+
+
+def _local_path(key: str) -> str:
+    return os.path.join(settings.PARSE_CACHE_DIR, key + CACHE_FILE_SUFFIX)
+
+
+def _remove_local(key: str) -> None:
+    try:
+        os.remove(_local_path(key))
+    except OSError:
+        pass
+
+
+def _read_frame_index(path: str) -> List[Tuple[int, int]]:
+    """
+    Checks an entry's header and every frame's length and CRC-32, reading one frame at a time.
+    Returns the (offset, length) of each frame's blob.
+
+    Raises:
+        ValueError: If the entry is truncated or corrupt.
+    """
+    frames = []
+    with open(path, "rb") as f:
+        if f.read(len(ENTRY_MAGIC)) != ENTRY_MAGIC:
+            raise ValueError("not a parse cache entry")
+        while True:
+            header = f.read(FRAME_HEADER.size)
+            if not header:
+                break
+            if len(header) != FRAME_HEADER.size:
+                raise ValueError("truncated frame header")
+            length, crc = FRAME_HEADER.unpack(header)
+            offset = f.tell()
+            blob = f.read(length)
+            if len(blob) != length or zlib.crc32(blob) != crc:
+                raise ValueError(f"corrupt frame at offset {offset}")
+            frames.append((offset, length))
+    if not frames:
+        raise ValueError("entry has no frames")
+    return frames
+
+
+def _iter_frames(path: str, frames: List[Tuple[int, int]]) -> Iterator[ParsedDocument]:
+    with open(path, "rb") as f:
+        for offset, length in frames:
+            f.seek(offset)
+            yield ParsedDocument.from_bytes(f.read(length))
+
+
+def _evict_local() -> None:
+    """Deletes least recently used entries until the cache fits in PARSE_CACHE_MAX_BYTES."""
+    entries = []
+    with os.scandir(settings.PARSE_CACHE_DIR) as it:
+        for entry in it:
+            if entry.name.endswith((CACHE_FILE_SUFFIX,) + LEGACY_CACHE_FILE_SUFFIXES):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_bytes <= settings.PARSE_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+            total_bytes -= size
+            logger.debug(f"Evicted parse cache entry {os.path.basename(path)} ({size} bytes).")
+        except FileNotFoundError:
+            pass # Evicted by another worker process
+
+
+class _EntryWriter:
+    """
+    Appends parsed parts to a temporary file in PARSE_CACHE_DIR, grouped into frames of about
+    FRAME_TARGET_BYTES of parsed pages. commit() renames the file into place, so concurrent
+    readers never see a partial entry.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        os.makedirs(settings.PARSE_CACHE_DIR, exist_ok=True)
+        fd, self.temp_path = tempfile.mkstemp(dir=settings.PARSE_CACHE_DIR, suffix=".tmp")
+        self._file = os.fdopen(fd, "wb")
+        self._file.write(ENTRY_MAGIC)
+        self._pending: List[ParsedDocument] = []
+        self._pending_bytes = 0
+
+    def add(self, part: ParsedDocument) -> None:
+        self._pending.append(part)
+        self._pending_bytes += part.nbytes
+        if self._pending_bytes >= FRAME_TARGET_BYTES:
+            self._flush()
+
+    def _flush(self) -> None:
+        if not self._pending:
+            return
+        blob = ParsedDocument.concatenate(self._pending).to_bytes()
+        self._file.write(FRAME_HEADER.pack(len(blob), zlib.crc32(blob)))
+        self._file.write(blob)
+        self._pending = []
+        self._pending_bytes = 0
+
+    def commit(self) -> str:
+        """Writes the last frame and moves the entry into place. Returns its path."""
+        self._flush()
+        self._file.close()
+        path = _local_path(self.key)
+        os.replace(self.temp_path, path)
+        return path
+
+    def discard(self) -> None:
+        self._pending = []
+        self._file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+def _download_bucket(key: str) -> bool:
+    """Copies an entry from the bucket mirror to the local cache. Returns False if it is not there."""
+    if not settings.PARSE_CACHE_BUCKET:
+        return False
+    try:
+        data = get_supabase_client().storage.from_(settings.PARSE_CACHE_BUCKET).download(path=key + CACHE_FILE_SUFFIX)
+    except Exception as e:
+        # A missing object is reported as an exception by the storage client
+        logger.debug(f"Parse cache entry {key} not found in bucket '{settings.PARSE_CACHE_BUCKET}': {e}")
+        return False
+    if not data:
+        return False
+    os.makedirs(settings.PARSE_CACHE_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=settings.PARSE_CACHE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, _local_path(key))
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    _evict_local()
+    return True
+
+
+def _upload_bucket(key: str, path: str) -> None:
+    if not settings.PARSE_CACHE_BUCKET:
+        return
+    get_supabase_client().storage.from_(settings.PARSE_CACHE_BUCKET).upload(
+        path=key + CACHE_FILE_SUFFIX,
+        file=path,
+        file_options={"content-type": "application/octet-stream", "upsert": "true"}
+    )
+
+
+def _open_cached_entry(file_hash: str, parser_type: str) -> Optional[Iterator[ParsedDocument]]:
+    """
+    Finds a valid cached entry (local disk first, then the bucket mirror) and returns an iterator
+    over its parts, or None on a miss. Unreadable entries are deleted and reported as misses.
+    """
+    key = _cache_key(file_hash, parser_type)
+    path = _local_path(key)
+    source = "local"
+    try:
+        if os.path.exists(path):
+            os.utime(path) # Mark as recently used
+        else:
+            source = "bucket"
+            if not _download_bucket(key):
+                logger.info(f"Parse cache miss for {key}.")
+                return None
+    except Exception as e:
+        logger.warning(f"Could not read parse cache entry {key}: {e}")
+        return None
+
+    try:
+        frames = _read_frame_index(path)
+        parts = _iter_frames(path, frames)
+        # Decode the first frame before anything is yielded, so a format change is still a miss
+        first_part = next(parts)
+    except Exception as e:
+        logger.warning(f"Discarding unreadable parse cache entry {key}: {e}")
+        _remove_local(key)
+        return None
+    logger.info(f"Parse cache hit ({source}) for {key}: {len(frames)} frames, {os.path.getsize(path)} bytes.")
+
+    def iter_parts() -> Iterator[ParsedDocument]:
+        yield first_part
+        yield from parts
+    return iter_parts()
+
+
+def open_cached_parse(file_hash: str, parser_type: str) -> Optional[Iterator[ParsedDocument]]:
+    """Streams the cached parse of a file (e.g. to rebuild checkpointed chunks), or returns None if it is not cached."""
+    if not settings.PARSE_CACHE_ENABLED:
+        return None
+    return _open_cached_entry(file_hash, pdf_parsing_service.resolve_parser_type(parser_type))
+
+
+def parse_pdf_iter_cached(
+    file_path: str,
+    parser_type: str = "pdfplumber",
+    processes: int = 1,
+    file_hash: Optional[str] = None
+) -> Iterator[ParsedDocument]:
+    """
+    Same as pdf_parsing_service.parse_pdf_iter, but streams the cached parse (in frames of
+    consecutive pages) when this file was already parsed with the same parser version. On a miss,
+    parts are yielded as they are parsed and appended to the cache entry at the same time; the
+    entry only becomes visible once parsing has finished.
+
+    Args:
+        file_path: The local path to the PDF file.
+        parser_type / processes: As in pdf_parsing_service.parse_pdf_iter.
+        file_hash: SHA-256 of the file if already known (computed from file_path otherwise).
+    """
+    if not settings.PARSE_CACHE_ENABLED:
+        yield from pdf_parsing_service.parse_pdf_iter(file_path, parser_type, processes)
+        return
+
+    parser_type = pdf_parsing_service.resolve_parser_type(parser_type)
+    file_hash = file_hash or compute_file_hash(file_path)
+    cached_parts = _open_cached_entry(file_hash, parser_type)
+    if cached_parts is not None:
+        yield from cached_parts
+        return
+
+    key = _cache_key(file_hash, parser_type)
+    writer = None
+    try:
+        writer = _EntryWriter(key)
+    except Exception as e:
+        logger.warning(f"Could not create parse cache entry {key}: {e}")
+
+    try:
+        for part in pdf_parsing_service.parse_pdf_iter(file_path, parser_type, processes):
+            if writer is not None:
+                try:
+                    writer.add(part)
+                except Exception as e:
+                    logger.warning(f"Could not write parse cache entry {key}: {e}")
+                    writer.discard()
+                    writer = None
+            yield part
+    except BaseException:
+        # Parsing failed or the consumer stopped early (GeneratorExit): the entry would be incomplete
+        if writer is not None:
+            writer.discard()
+        raise
+
+    if writer is None:
+        return
+    try:
+        path = writer.commit()
+        size = os.path.getsize(path)
+        _evict_local()
+    except Exception as e:
+        logger.warning(f"Could not store parse cache entry {key}: {e}")
+        writer.discard()
+        return
+    try:
+        _upload_bucket(key, path)
+    except Exception as e:
+        logger.warning(f"Stored parse cache entry {key} locally, but could not mirror it to bucket '{settings.PARSE_CACHE_BUCKET}': {e}")
+        return
+    logger.info(f"Stored parse cache entry {key} ({size} bytes).")
@@ -1,38 +1,44 @@
+import fitz  # PyMuPDF
 import pdfplumber
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple, Callable, Iterator
 import logging
+import multiprocessing
+import os
 
-from app.schemas.chunk import ParsedPage, ParsedTextElement
+from app.core.config import settings
+from app.schemas.chunk import ParsedPage
+from app.schemas.parsed_document import ParsedDocument, ParsedDocumentBuilder
 
 logger = logging.getLogger(__name__)
 
-def parse_pdf_with_pdfplumber(file_path: str) -> List[ParsedPage]:
+# Bump when word extraction options change, so cached parse output (parse_cache_service) is invalidated
+PARSE_OUTPUT_VERSION = 1
+
+def iter_pages_with_pdfplumber(file_path: str, page_range: Optional[Tuple[int, int]] = None) -> Iterator[ParsedDocument]:
     """
     Parses a PDF file using pdfplumber to extract text elements with their
-    bounding boxes from each page.
+    bounding boxes, yielding one single-page ParsedDocument per page.
+    pdfplumber caches every layout object (chars, rects, ...) on its Page objects for as long
+    as the PDF stays open, so each page's cache is released as soon as its words are extracted.
 
     Args:
         file_path: The local path to the PDF file.
+        page_range: Optional 0-based [first, last) range of pages to parse (all pages if None).
 
-    Returns:
-        A list of ParsedPage objects, each containing details of a page
-        and its extracted text elements.
+    Yields:
+        A ParsedDocument holding one page and its extracted text elements.
         
     Raises:
         FileNotFoundError: If the PDF file does not exist at the given path.
         pdfplumber.exceptions.PDFSyntaxError: If the PDF is malformed or password-protected.
         Exception: For other potential errors during PDF processing.
     """
-    parsed_pages_data: List[ParsedPage] = []
-
     try:
-        with pdfplumber.open(file_path) as pdf:
-            for i, page_obj in enumerate(pdf.pages):
-                current_page_number = i + 1
-                current_page_width = float(page_obj.width)
-                current_page_height = float(page_obj.height)
-                
-                extracted_elements: List[ParsedTextElement] = []
+        page_numbers = list(range(page_range[0] + 1, page_range[1] + 1)) if page_range else None
+        with pdfplumber.open(file_path, pages=page_numbers) as pdf:
+            for page_obj in pdf.pages:
+                builder = ParsedDocumentBuilder()
+                builder.add_page(page_obj.page_number, float(page_obj.width), float(page_obj.height))
 
                 # Extract words with their bounding boxes and other attributes
                 # x_tolerance and y_tolerance can be adjusted based on document structure
@@ -48,30 +54,12 @@ def parse_pdf_with_pdfplumber(file_path: str) -> List[ParsedPage]:
                 for word in words:
                     # pdfplumber's coordinates are typically from the top-left.
                     # 'x0', 'top', 'x1', 'bottom' are keys for word bounding boxes.
-                    # 'text' is the word itself.
-                    element = ParsedTextElement(
-                        text=word['text'],
-                        x0=float(word['x0']),
-                        y0=float(word['top']), # pdfplumber uses 'top' for y0
-                        x1=float(word['x1']),
-                        y1=float(word['bottom']), # pdfplumber uses 'bottom' for y1
-                        # Populate page context for each element
-                        page_number=current_page_number,
-                        page_width=current_page_width,
-                        page_height=current_page_height
-                        # fontname=word.get('fontname'), # Example of accessing extra_attrs
-                        # size=word.get('size')
-                    )
-                    extracted_elements.append(element)
-                
-                # ParsedPage now contains elements that are fully context-aware
-                parsed_page_schema_obj = ParsedPage(
-                    page_number=current_page_number,
-                    width=current_page_width,
-                    height=current_page_height,
-                    elements=extracted_elements
-                )
-                parsed_pages_data.append(parsed_page_schema_obj)
+                    # Elements go straight into the columnar arrays; page context is stored once per page.
+                    builder.add_element(word['text'], word['x0'], word['top'], word['x1'], word['bottom'])
+
+                del words
+                page_obj.close() # Drop this page's cached layout objects
+                yield builder.build()
                 
             logger.info(f"Successfully parsed {len(pdf.pages)} pages from '{file_path}' using pdfplumber.")
 
@@ -84,33 +72,241 @@ def parse_pdf_with_pdfplumber(file_path: str) -> List[ParsedPage]:
     except Exception as e:
         logger.error(f"An unexpected error occurred while parsing PDF '{file_path}' with pdfplumber: {e}", exc_info=True)
         raise
-        
-    return parsed_pages_data
 
-# Placeholder for the main service function that could switch between parsers
-def parse_pdf(file_path: str, parser_type: str = "pdfplumber") -> List[ParsedPage]:
+def iter_pages_with_pymupdf(file_path: str, page_range: Optional[Tuple[int, int]] = None) -> Iterator[ParsedDocument]:
     """
-    Main PDF parsing function. Currently defaults to pdfplumber.
-    Can be extended to support other parsers like pypdfium2.
+    Parses a PDF file using PyMuPDF (MuPDF) to extract words with their bounding boxes,
+    yielding one single-page ParsedDocument per page.
+    Produces the same output as iter_pages_with_pdfplumber: MuPDF page coordinates are
+    already top-left based (y grows downwards), matching pdfplumber's x0/top/x1/bottom.
 
     Args:
         file_path: The local path to the PDF file.
-        parser_type: The type of parser to use (e.g., "pdfplumber", "pypdfium2").
+        page_range: Optional 0-based [first, last) range of pages to parse (all pages if None).
 
-    Returns:
-        A list of ParsedPage objects.
+    Yields:
+        A ParsedDocument holding one page and its extracted text elements.
+
+    Raises:
+        FileNotFoundError: If the PDF file does not exist at the given path.
+        fitz.FileDataError: If the PDF is malformed.
+        Exception: For other potential errors during PDF processing.
     """
-    logger.info(f"Parsing PDF '{file_path}' using parser: {parser_type}")
-    if parser_type == "pdfplumber":
-        return parse_pdf_with_pdfplumber(file_path)
-    # elif parser_type == "pypdfium2":
-    #     # return parse_pdf_with_pypdfium2(file_path) # To be implemented in Phase 6
-    #     logger.warning("pypdfium2 parser not yet implemented. Falling back to pdfplumber.")
-    #     return parse_pdf_with_pdfplumber(file_path)
-    else:
+    try:
+        with fitz.open(file_path) as pdf:
+            if pdf.needs_pass:
+                raise ValueError(f"PDF '{file_path}' is password-protected.")
+            first_page, last_page = page_range or (0, pdf.page_count)
+            last_page = min(last_page, pdf.page_count)
+            for page_index in range(first_page, last_page):
+                page_obj = pdf[page_index]
+                builder = ParsedDocumentBuilder()
+                builder.add_page(page_obj.number + 1, float(page_obj.rect.width), float(page_obj.rect.height))
+
+                # Each word is (x0, y0, x1, y1, text, block_no, line_no, word_no), in content-stream order
+                # like pdfplumber's use_text_flow=True.
+                for x0, y0, x1, y1, text, *_ in page_obj.get_text("words"):
+                    builder.add_element(text, x0, y0, x1, y1)
+
+                del page_obj # MuPDF frees the page once it is no longer referenced
+                yield builder.build()
+
+            logger.info(f"Successfully parsed {max(0, last_page - first_page)} pages from '{file_path}' using PyMuPDF.")
+
+    except FileNotFoundError:
+        logger.error(f"PDF file not found at path: {file_path}")
+        raise
+    except fitz.FileDataError as e:
+        logger.error(f"FileDataError for file '{file_path}': {e}. The PDF might be malformed.")
+        raise
+    except Exception as e:
+        logger.error(f"An unexpected error occurred while parsing PDF '{file_path}' with PyMuPDF: {e}", exc_info=True)
+        raise
+
+def parse_pdf_with_pdfplumber(file_path: str, page_range: Optional[Tuple[int, int]] = None) -> ParsedDocument:
+    """Parses a whole PDF (or page range) with pdfplumber into one ParsedDocument."""
+    return ParsedDocument.concatenate(list(iter_pages_with_pdfplumber(file_path, page_range)))
+
+def parse_pdf_with_pymupdf(file_path: str, page_range: Optional[Tuple[int, int]] = None) -> ParsedDocument:
+    """Parses a whole PDF (or page range) with PyMuPDF into one ParsedDocument."""
+    return ParsedDocument.concatenate(list(iter_pages_with_pymupdf(file_path, page_range)))
+
+_PAGE_ITERATORS: Dict[str, Callable[..., Iterator[ParsedDocument]]] = {
+    "pdfplumber": iter_pages_with_pdfplumber,
+    "pymupdf": iter_pages_with_pymupdf,
+    # "pypdfium2": iter_pages_with_pypdfium2, # To be implemented in Phase 6
+}
+
+def resolve_parser_type(parser_type: str) -> str:
+    """Returns parser_type if supported, otherwise the pdfplumber default."""
+    if parser_type not in _PAGE_ITERATORS:
         logger.error(f"Unsupported parser type: {parser_type}. Defaulting to pdfplumber.")
         # Or raise an error: raise ValueError(f"Unsupported parser type: {parser_type}")
-        return parse_pdf_with_pdfplumber(file_path)
+        return "pdfplumber"
+    return parser_type
+
+def get_parser_version(parser_type: str) -> str:
+    """Identifies the parser output: backend, library version and PARSE_OUTPUT_VERSION."""
+    library_version = fitz.VersionBind if parser_type == "pymupdf" else pdfplumber.__version__
+    return f"{parser_type}-{library_version}-v{PARSE_OUTPUT_VERSION}"
+
+def get_parse_process_count() -> int:
+    """
+    Number of processes to parse one PDF with (settings.PDF_PARSE_PROCESSES).
+    0 means auto: the CPU cores available to this container shared between the
+    WORKER_CONCURRENCY Celery worker processes, so concurrent tasks do not oversubscribe cores.
+    """
+    if settings.PDF_PARSE_PROCESSES > 0:
+        return settings.PDF_PARSE_PROCESSES
+    available_cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    return max(1, available_cores // max(1, settings.WORKER_CONCURRENCY))
+
+def _get_process_context() -> Any:
+    """
+    Multiprocessing context for parsing processes. Celery prefork pool workers are daemonic, and
+    the standard library refuses to start children from daemonic processes; billiard (Celery's
+    fork of multiprocessing, installed with Celery) does not. Processes are always spawned:
+    worker processes run threads (tokenizer pool, OpenAI client loop), and forking a process with
+    live threads can deadlock on locks held by those threads.
+    """
+    try:
+        import billiard
+        return billiard.get_context("spawn")
+    except ImportError:
+        return multiprocessing.get_context("spawn")
+
+def _parse_page_range(parser_type: str, file_path: str, page_range: Tuple[int, int]) -> ParsedDocument:
+    """Opens the file and parses one page range into a single ParsedDocument."""
+    return ParsedDocument.concatenate(list(_PAGE_ITERATORS[parser_type](file_path, page_range=page_range)))
+
+def _parse_ranges_in_process(connection: Any, parser_type: str, file_path: str, page_ranges: List[Tuple[int, int]]) -> None:
+    """Runs in a parsing process: sends the ParsedDocument of each page range in order, or the error that stopped it."""
+    try:
+        for page_range in page_ranges:
+            connection.send(_parse_page_range(parser_type, file_path, page_range))
+    except Exception as e:
+        try:
+            connection.send(e)
+        except Exception: # The error itself cannot be pickled
+            connection.send(RuntimeError(f"Parsing '{file_path}' failed: {e!r}"))
+    finally:
+        connection.close()
+
+def _iter_pdf_parallel(parser_type: str, file_path: str, processes: int) -> Iterator[ParsedDocument]:
+    """
+    Splits the page range across a bounded number of spawned processes and yields one
+    ParsedDocument per page range, in page order. Falls back to serial parsing for short
+    documents or when the processes cannot be started.
+    """
+    with fitz.open(file_path) as pdf:
+        page_count = pdf.page_count
+    processes = min(processes, page_count // max(1, settings.PDF_PARSE_MIN_PAGES_PER_PROCESS))
+    if processes <= 1:
+        yield from _PAGE_ITERATORS[parser_type](file_path)
+        return
+
+    # A few ranges per process so one dense range does not leave the other processes idle.
+    # Ranges are dealt out round robin, so range i always comes from process i % processes and
+    # results arrive in page order without buffering. A process blocks on its pipe until its
+    # result is read, so at most one finished range per process waits in memory.
+    num_ranges = min(page_count, processes * 4)
+    bounds = [page_count * i // num_ranges for i in range(num_ranges + 1)]
+    page_ranges = [(bounds[i], bounds[i + 1]) for i in range(num_ranges)]
+    logger.info(f"Parsing {page_count} pages of '{file_path}' in {num_ranges} ranges across {processes} processes.")
+
+    context = _get_process_context()
+    workers = []
+    try:
+        try:
+            for index in range(processes):
+                receiver, sender = context.Pipe(duplex=False)
+                process = context.Process(
+                    target=_parse_ranges_in_process,
+                    args=(sender, parser_type, file_path, page_ranges[index::processes]),
+                    daemon=True,
+                )
+                workers.append((process, receiver))
+                process.start()
+                sender.close()
+        except (OSError, ValueError, AssertionError) as e:
+            # Nothing has been yielded yet, so the document can still be parsed serially
+            logger.warning(f"Could not start parsing processes ({e}). Parsing '{file_path}' serially.")
+            yield from _PAGE_ITERATORS[parser_type](file_path)
+            return
+
+        for range_index in range(num_ranges):
+            process, receiver = workers[range_index % processes]
+            try:
+                result = receiver.recv()
+            except EOFError:
+                process.join()
+                raise RuntimeError(f"Parsing process for '{file_path}' exited unexpectedly (exit code {process.exitcode}).")
+            if isinstance(result, BaseException):
+                raise result
+            yield result
+    finally:
+        # Processes that are still running (the consumer stopped early or another range failed) are stopped
+        for process, receiver in workers:
+            receiver.close()
+            if process.pid is not None:
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+
+def parse_pdf_iter(file_path: str, parser_type: str = "pdfplumber", processes: int = 1) -> Iterator[ParsedDocument]:
+    """
+    Streaming PDF parsing: yields ParsedDocument parts covering consecutive whole pages, in
+    page order, so consumers (e.g. chunk_parsed_document_stream) can process the document
+    incrementally. Serial parsing yields one page at a time and keeps only that page's parser
+    state alive; with processes > 1 each part is one page range parsed in a pool process.
+
+    Args:
+        file_path: The local path to the PDF file.
+        parser_type: The type of parser to use ("pdfplumber" or "pymupdf").
+        processes: Number of processes to split the pages across (see get_parse_process_count).
+                   1 parses serially in the calling process.
+
+    Raises:
+        ValueError: If the PDF has no pages.
+    """
+    logger.info(f"Parsing PDF '{file_path}' using parser: {parser_type}")
+    parser_type = resolve_parser_type(parser_type)
+
+    if processes > 1:
+        parts = _iter_pdf_parallel(parser_type, file_path, processes)
+    else:
+        parts = _PAGE_ITERATORS[parser_type](file_path)
+
+    page_count = 0
+    for part in parts:
+        page_count += part.num_pages
+        yield part
+    if page_count == 0:
+        raise ValueError(f"PDF parsing returned no pages for '{file_path}'.")
+
+# Main service function that switches between parsers
+def parse_pdf_document(file_path: str, parser_type: str = "pdfplumber", processes: int = 1) -> ParsedDocument:
+    """
+    Main PDF parsing function. Defaults to pdfplumber; "pymupdf" selects the
+    MuPDF backend (settings.PDF_PARSER_TYPE in the indexing task).
+    Collects everything parse_pdf_iter yields into one ParsedDocument.
+
+    Args:
+        file_path: The local path to the PDF file.
+        parser_type: The type of parser to use ("pdfplumber" or "pymupdf").
+        processes: Number of processes to split the pages across (see get_parse_process_count).
+
+    Returns:
+        A ParsedDocument (columnar texts, coordinates and page indices).
+    """
+    return ParsedDocument.concatenate(list(parse_pdf_iter(file_path, parser_type, processes)))
+
+def parse_pdf(file_path: str, parser_type: str = "pdfplumber") -> List[ParsedPage]:
+    """
+    Same as parse_pdf_document, returned as a list of ParsedPage views for callers
+    that still work on the Pydantic schemas.
+    """
+    return parse_pdf_document(file_path, parser_type).to_parsed_pages()
 
 # Example usage (for testing this module directly):
 # if __name__ == '__main__':
@@ -0,0 +1,153 @@
+# HEDGED REQUESTS
+#
+# Embedding requests usually complete in a second or two but occasionally take 20+ seconds, and one
+# slow request holds up the whole indexing task. When OPENAI_EMBEDDING_HEDGING_ENABLED is set, a
+# request still running after the model's rolling latency percentile gets a duplicate ("hedge"):
+#
+# - Deadline: OPENAI_EMBEDDING_HEDGE_PERCENTILE (p95 by default) of the last LATENCY_WINDOW
+#   latencies seen by this process for the model, but at least OPENAI_EMBEDDING_HEDGE_MIN_DELAY_SECONDS.
+#   No hedging until OPENAI_EMBEDDING_HEDGE_MIN_SAMPLES latencies have been seen.
+# - Whichever request finishes first wins; the other is cancelled. If the first to finish fails,
+#   the other one is still awaited.
+# - Spend cap: hedges may add at most OPENAI_EMBEDDING_HEDGE_MAX_EXTRA_FRACTION of the tokens sent
+#   by this process; beyond that, slow requests are simply awaited.
+#
+# Counters for this process are exposed through get_hedge_stats()/reset_hedge_stats(), so tasks can
+# report the hedge rate (and how often the hedge won) in their result_payload.
+
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, TypeVar
+
+import numpy as np
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+LATENCY_WINDOW = 200 # Latest latencies kept per model
+
+T = TypeVar("T")
+
+_lock = threading.Lock()
+_latencies: Dict[str, Deque[float]] = {}
+_tokens_sent = 0
+_extra_tokens = 0
+_stats: Dict[str, int] = {
+    "requests": 0,
+    "hedged": 0,
+    "hedge_wins": 0,
+    "skipped_over_budget": 0,
+}
+
+
+def get_hedge_stats() -> Dict[str, Any]:
+    """Returns a snapshot of the hedging counters for this process."""
+    with _lock:
+        stats: Dict[str, Any] = dict(_stats)
+        stats["extra_tokens"] = _extra_tokens
+        stats["extra_token_fraction"] = round(_extra_tokens / _tokens_sent, 4) if _tokens_sent else 0.0
+    stats["hedge_rate"] = round(stats["hedged"] / stats["requests"], 4) if stats["requests"] else 0.0
+    return stats
+
+
+def reset_hedge_stats() -> None:
+    """Resets the counters (not the latency windows), e.g. at the start of a task."""
+    global _tokens_sent, _extra_tokens
+    with _lock:
+        for key in _stats:
+            _stats[key] = 0
+        _tokens_sent = _extra_tokens = 0
+
+
+def _record_latency(key: str, seconds: float) -> None:
+    with _lock:
+        _latencies.setdefault(key, deque(maxlen=LATENCY_WINDOW)).append(seconds)
+
+
+def get_hedge_deadline(key: str) -> Optional[float]:
+    """Seconds after which a request for `key` is hedged, or None while there are too few samples."""
+    with _lock:
+        latencies = list(_latencies.get(key, ()))
+    if len(latencies) < settings.OPENAI_EMBEDDING_HEDGE_MIN_SAMPLES:
+        return None
+    percentile = float(np.percentile(latencies, settings.OPENAI_EMBEDDING_HEDGE_PERCENTILE))
+    return max(percentile, settings.OPENAI_EMBEDDING_HEDGE_MIN_DELAY_SECONDS)
+
+
+def _take_hedge_budget(tokens: int) -> bool:
+    global _extra_tokens
+    with _lock:
+        if _extra_tokens + tokens > settings.OPENAI_EMBEDDING_HEDGE_MAX_EXTRA_FRACTION * _tokens_sent:
+            _stats["skipped_over_budget"] += 1
+            return False
+        _extra_tokens += tokens
+        _stats["hedged"] += 1
+        return True
+
+
+async def run_hedged(
+    key: str,
+    make_request: Callable[[], Awaitable[T]],
+    tokens: int = 0,
+    make_hedge: Optional[Callable[[], Awaitable[T]]] = None
+) -> T:
+    """
+    Awaits make_request(), hedging it with make_hedge() (default: make_request()) if it runs past
+    the deadline for `key` and the spend cap allows. Returns the first successful result; raises
+    the primary request's error if both fail. Latencies of completed requests feed the deadline.
+
+    Args:
+        key: Latency class of the request (e.g. the model name).
+        make_request: Creates the request coroutine.
+        tokens: Tokens the request costs (for the spend cap).
+        make_hedge: Creates the duplicate request (e.g. taking its own rate-limit permit first).
+    """
+    global _tokens_sent
+    with _lock:
+        _stats["requests"] += 1
+        _tokens_sent += tokens
+
+    started = time.monotonic()
+    primary = asyncio.ensure_future(make_request())
+    deadline = get_hedge_deadline(key) if settings.OPENAI_EMBEDDING_HEDGING_ENABLED else None
+    if deadline is not None:
+        try:
+            # shield(): the timeout must not cancel the primary request
+            result = await asyncio.wait_for(asyncio.shield(primary), timeout=deadline)
+            _record_latency(key, time.monotonic() - started)
+            return result
+        except asyncio.TimeoutError:
+            pass
+        if _take_hedge_budget(tokens):
+            logger.info(f"Request for {key} still running after {deadline:.1f}s (rolling p{settings.OPENAI_EMBEDDING_HEDGE_PERCENTILE:g}). Sending a hedge.")
+            return await _race(key, primary, started, make_hedge or make_request)
+
+    result = await primary
+    _record_latency(key, time.monotonic() - started)
+    return result
+
+
+async def _race(key: str, primary: "asyncio.Future[T]", primary_started: float, make_hedge: Callable[[], Awaitable[T]]) -> T:
+    hedge_started = time.monotonic()
+    hedge = asyncio.ensure_future(make_hedge())
+    started = {primary: primary_started, hedge: hedge_started}
+    pending = {primary, hedge}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in (primary, hedge): # Prefer the primary on a tie
+                if future in done and not future.cancelled() and future.exception() is None:
+                    _record_latency(key, time.monotonic() - started[future])
+                    if future is hedge:
+                        with _lock:
+                            _stats["hedge_wins"] += 1
+                    return future.result()
+        return primary.result() # Both failed: raise the primary's error
+    finally:
+        for future in (primary, hedge):
+            if not future.done():
+                future.cancel()
@@ -0,0 +1,224 @@
+# TASK CHECKPOINTS
+#
+# A task that is requeued (e.g. while the OpenAI circuit breaker is open) may resume on any
+# worker, so its intermediate results are kept in Redis, which all workers share:
+#
+# - Entries are zlib-compressed JSON under syllabi:task_checkpoint:<task id>:<name>, expiring after
+#   TASK_CHECKPOINT_TTL_SECONDS so abandoned tasks do not accumulate.
+# - Chunks are checkpointed in a compact form: text, page, token count and where their elements
+#   start on the page. The elements themselves (with per-word boxes, often tens of MB) are not
+#   copied into Redis; they are rebuilt from the parse cache entry of the file, and a checkpoint
+#   whose entry is gone is treated as missing.
+# - Embeddings are checkpointed batch by batch into one Redis hash per task, keyed by the chunk's
+#   content hash (model + text), so a retried task only requests the batches that were missing.
+# - Checkpoint failures are logged and never fail the task; a missing checkpoint just means the
+#   work is redone. Callers whose state cannot be redone (e.g. submitted Batch API jobs) check
+#   save()'s result and load with strict=True.
+
+import json
+import logging
+import zlib
+from typing import Any, Dict, List, Optional, Sequence
+from uuid import UUID
+
+import numpy as np
+import redis
+
+from app.core.config import settings
+from app.core.redis_client import get_redis_client
+from app.schemas.chunk import ChunkCreate
+from app.schemas.parsed_document import COORDINATE_DECIMALS
+from app.services import element_coalescing_service
+from app.services import parse_cache_service
+from app.services import pdf_parsing_service
+from app.services.chunking_service import CHUNK_TEXT_SEPARATOR
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "syllabi:task_checkpoint"
+CHUNKS_CHECKPOINT = "chunks"
+EMBEDDINGS_CHECKPOINT = "embeddings"
+HMGET_BATCH_SIZE = 1000
+CHUNKS_CHECKPOINT_VERSION = 2 # Version 1 stored every ChunkCreate with its constituent elements
+
+
+def _key(task_id: UUID, name: str) -> str:
+    return f"{KEY_PREFIX}:{task_id}:{name}"
+
+
+def save(task_id: UUID, name: str, data: Any, ttl_seconds: Optional[int] = None) -> bool:
+    """
+    Stores a JSON-serialisable checkpoint, expiring after ttl_seconds (default
+    TASK_CHECKPOINT_TTL_SECONDS). Returns False if it could not be stored.
+    """
+    try:
+        payload = zlib.compress(json.dumps(data, separators=(",", ":")).encode("utf-8"))
+        get_redis_client().set(_key(task_id, name), payload, ex=ttl_seconds or settings.TASK_CHECKPOINT_TTL_SECONDS)
+        logger.info(f"[Task ID: {task_id}] Saved '{name}' checkpoint ({len(payload)} bytes).")
+        return True
+    except (redis.RedisError, TypeError, ValueError) as e:
+        logger.warning(f"[Task ID: {task_id}] Could not save '{name}' checkpoint: {e}")
+        return False
+
+
+def load(task_id: UUID, name: str, strict: bool = False) -> Optional[Any]:
+    """
+    Returns a checkpoint saved by save(), or None. With strict=True, Redis errors are raised
+    instead, so a checkpoint that could not be read is not mistaken for a missing one.
+    """
+    try:
+        payload = get_redis_client().get(_key(task_id, name))
+        if payload is None:
+            return None
+        return json.loads(zlib.decompress(payload))
+    except redis.RedisError as e:
+        if strict:
+            raise
+        logger.warning(f"[Task ID: {task_id}] Could not load '{name}' checkpoint: {e}")
+        return None
+    except (zlib.error, ValueError) as e:
+        logger.warning(f"[Task ID: {task_id}] Could not load '{name}' checkpoint: {e}")
+        return None
+
+
+def delete_all(task_id: UUID) -> None:
+    """Deletes every checkpoint of a task (once it has completed)."""
+    try:
+        client = get_redis_client()
+        keys = list(client.scan_iter(match=f"{KEY_PREFIX}:{task_id}:*"))
+        if keys:
+            client.delete(*keys)
+    except redis.RedisError as e:
+        logger.warning(f"[Task ID: {task_id}] Could not delete checkpoints: {e}")
+
+
+def save_chunks(task_id: UUID, chunks: List[ChunkCreate], file_hash: str, parser_type: str) -> bool:
+    """
+    Checkpoints the chunks of a document, so a requeued task skips download, parsing and chunking.
+    Each chunk is stored as [page number, token count, element count, x0 and y0 of its first
+    element, text]; load_chunks() finds its elements again in the cached parse of the file.
+    Returns False (and stores nothing) if the checkpoint could not be saved or the parse cache is
+    disabled.
+    """
+    if not settings.PARSE_CACHE_ENABLED:
+        logger.info(f"[Task ID: {task_id}] Not checkpointing chunks: the parse cache is disabled.")
+        return False
+    if not chunks:
+        return False
+    first_chunk = chunks[0]
+    return save(task_id, CHUNKS_CHECKPOINT, {
+        "version": CHUNKS_CHECKPOINT_VERSION,
+        "file_hash": file_hash,
+        "parser_type": pdf_parsing_service.resolve_parser_type(parser_type),
+        "granularity": settings.PDF_ELEMENT_GRANULARITY,
+        "reference_id": str(first_chunk.reference_id),
+        "user_id": str(first_chunk.user_id),
+        "chatbot_id": str(first_chunk.chatbot_id),
+        "chunks": [
+            [chunk.page_number, chunk.token_count, len(chunk.constituent_elements),
+             chunk.constituent_elements[0].x0, chunk.constituent_elements[0].y0, chunk.chunk_text]
+            for chunk in chunks
+        ],
+    })
+
+
+def _find_chunk_start(texts: List[str], x0: List[float], y0: List[float], start: int, row: List[Any]) -> Optional[int]:
+    """
+    Returns the index (within a page) of the first element of a checkpointed chunk, searching from
+    start. x0 / y0 are rounded like ParsedTextElement views, so they compare exactly.
+    """
+    _, _, element_count, chunk_x0, chunk_y0, chunk_text = row
+    for index in range(start, len(texts) - element_count + 1):
+        if x0[index] == chunk_x0 and y0[index] == chunk_y0 \
+                and chunk_text.startswith(texts[index]) \
+                and CHUNK_TEXT_SEPARATOR.join(texts[index:index + element_count]) == chunk_text:
+            return index
+    return None
+
+
+def load_chunks(task_id: UUID) -> Optional[List[ChunkCreate]]:
+    """
+    Rebuilds the chunks saved by save_chunks() from the cached parse of the file. Returns None if
+    there is no usable checkpoint (missing, from an older version, made with other element
+    settings, or its parse cache entry is gone).
+    """
+    data = load(task_id, CHUNKS_CHECKPOINT)
+    if data is None:
+        return None
+    if not isinstance(data, dict) or data.get("version") != CHUNKS_CHECKPOINT_VERSION \
+            or data["granularity"] != settings.PDF_ELEMENT_GRANULARITY:
+        logger.info(f"[Task ID: {task_id}] Ignoring a chunks checkpoint made with other settings.")
+        return None
+    parts = parse_cache_service.open_cached_parse(data["file_hash"], data["parser_type"])
+    if parts is None:
+        logger.info(f"[Task ID: {task_id}] Ignoring the chunks checkpoint: the parsed document is no longer cached.")
+        return None
+
+    ids = dict(reference_id=UUID(data["reference_id"]), user_id=UUID(data["user_id"]), chatbot_id=UUID(data["chatbot_id"]))
+    rows = data["chunks"]
+    chunks: List[ChunkCreate] = []
+    row_index = 0
+    for part in parts:
+        if row_index == len(rows):
+            break
+        document = element_coalescing_service.coalesce_document(part, granularity=data["granularity"])
+        x0, y0 = (np.round(coords.astype(np.float64), COORDINATE_DECIMALS).tolist() for coords in (document.x0, document.y0))
+        for page_index, page_number in enumerate(document.page_numbers.tolist()):
+            page_start, page_end = int(document.page_offsets[page_index]), int(document.page_offsets[page_index + 1])
+            texts = document.texts[page_start:page_end]
+            page_x0, page_y0 = x0[page_start:page_end], y0[page_start:page_end]
+            search_from = 0
+            while row_index < len(rows) and rows[row_index][0] == page_number:
+                _, token_count, element_count, _, _, chunk_text = rows[row_index]
+                start = _find_chunk_start(texts, page_x0, page_y0, search_from, rows[row_index])
+                if start is None:
+                    logger.warning(f"[Task ID: {task_id}] Ignoring the chunks checkpoint: chunk {row_index} was not found on page {page_number} of the cached parse.")
+                    return None
+                chunks.append(ChunkCreate(
+                    **ids,
+                    page_number=page_number,
+                    chunk_text=chunk_text,
+                    token_count=token_count,
+                    constituent_elements=document.elements(page_start + start, page_start + start + element_count),
+                    parser_metadata=None
+                ))
+                search_from = start + 1 # Chunks on a page start at increasing elements
+                row_index += 1
+    if row_index != len(rows):
+        logger.warning(f"[Task ID: {task_id}] Ignoring the chunks checkpoint: {len(rows) - row_index} chunks were not found in the cached parse.")
+        return None
+    return chunks
+
+
+def save_embeddings(task_id: UUID, embeddings: Dict[str, np.ndarray]) -> None:
+    """Adds embeddings (by chunk content key) to the task's embedding checkpoint."""
+    if not embeddings:
+        return
+    try:
+        key = _key(task_id, EMBEDDINGS_CHECKPOINT)
+        pipeline = get_redis_client().pipeline(transaction=False)
+        pipeline.hset(key, mapping={
+            content_key: np.asarray(vector, dtype=np.float32).tobytes() for content_key, vector in embeddings.items()
+        })
+        pipeline.expire(key, settings.TASK_CHECKPOINT_TTL_SECONDS)
+        pipeline.execute()
+    except redis.RedisError as e:
+        logger.warning(f"[Task ID: {task_id}] Could not checkpoint {len(embeddings)} embeddings: {e}")
+
+
+def load_embeddings(task_id: UUID, content_keys: Sequence[str]) -> Dict[str, np.ndarray]:
+    """Returns the checkpointed embeddings (float32 arrays) found for the given chunk content keys."""
+    found: Dict[str, np.ndarray] = {}
+    try:
+        client = get_redis_client()
+        key = _key(task_id, EMBEDDINGS_CHECKPOINT)
+        if not client.exists(key):
+            return found
+        for start in range(0, len(content_keys), HMGET_BATCH_SIZE):
+            key_slice = list(content_keys[start:start + HMGET_BATCH_SIZE])
+            for content_key, vector in zip(key_slice, client.hmget(key, key_slice)):
+                if vector is not None:
+                    found[content_key] = np.frombuffer(vector, dtype=np.float32)
+    except redis.RedisError as e:
+        logger.warning(f"[Task ID: {task_id}] Could not load checkpointed embeddings: {e}")
+    return found
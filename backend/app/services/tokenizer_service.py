@@ -0,0 +1,146 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Any, Optional
+
+import tiktoken
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Encoding used when a model/encoding name is unknown to tiktoken
+DEFAULT_ENCODING_NAME = "cl100k_base"  # Used by text-embedding-ada-002 and text-embedding-3-*
+
+# Below this many texts per thread, a batch is encoded on the calling thread
+MIN_TEXTS_PER_THREAD = 256
+
+_encodings: Dict[str, tiktoken.Encoding] = {}
+_encodings_lock = threading.Lock()
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+_stats_lock = threading.Lock()
+_stats: Dict[str, float] = {
+    "encoder_cache_hits": 0,
+    "encoder_cache_misses": 0,
+    "encode_calls": 0,
+    "texts_encoded": 0,
+    "tokens_encoded": 0,
+    "encode_seconds": 0.0,
+}
+
+
+def _load_encoding(model_name: str) -> tiktoken.Encoding:
+    """Resolves either an encoding name (e.g. 'cl100k_base') or a model name (e.g. 'gpt-4o')."""
+    if model_name in tiktoken.list_encoding_names():
+        return tiktoken.get_encoding(model_name)
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        logger.warning(f"No tiktoken encoding known for '{model_name}'. Falling back to {DEFAULT_ENCODING_NAME}.")
+        return tiktoken.get_encoding(DEFAULT_ENCODING_NAME)
+
+
+def get_encoding(model_name: str = DEFAULT_ENCODING_NAME) -> tiktoken.Encoding:
+    """
+    Returns the tiktoken encoding for a model or encoding name.
+    Encoders are loaded once per process and shared by every service.
+    """
+    encoding = _encodings.get(model_name)
+    if encoding is not None:
+        _record(encoder_cache_hits=1)
+        return encoding
+
+    with _encodings_lock:
+        encoding = _encodings.get(model_name)
+        if encoding is None:
+            encoding = _load_encoding(model_name)
+            _encodings[model_name] = encoding
+            _record(encoder_cache_misses=1)
+        else:
+            _record(encoder_cache_hits=1)
+    return encoding
+
+
+def _record(**increments: float) -> None:
+    with _stats_lock:
+        for key, value in increments.items():
+            _stats[key] += value
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.TOKENIZER_NUM_THREADS, thread_name_prefix="tokenizer"
+                )
+    return _executor
+
+
+def encode_batch(texts: List[str], model_name: str = DEFAULT_ENCODING_NAME) -> List[List[int]]:
+    """
+    Encodes many texts at once, spread over a shared thread pool (tiktoken releases the GIL
+    while encoding). Texts are split into one contiguous slice per thread rather than one task
+    per text as tiktoken's own encode_batch does, because per-task overhead dominates when the
+    texts are single words. Special-token markers are treated as ordinary text, which is how
+    the OpenAI API sees them.
+    """
+    if not texts:
+        return []
+    encoding = get_encoding(model_name)
+    start_time = time.perf_counter()
+    num_threads = min(settings.TOKENIZER_NUM_THREADS, len(texts) // MIN_TEXTS_PER_THREAD)
+    if num_threads <= 1:
+        token_lists = [encoding.encode_ordinary(text) for text in texts]
+    else:
+        def encode_slice(text_slice: List[str]) -> List[List[int]]:
+            return [encoding.encode_ordinary(text) for text in text_slice]
+
+        bounds = [len(texts) * i // num_threads for i in range(num_threads + 1)]
+        slices = [texts[bounds[i]:bounds[i + 1]] for i in range(num_threads)]
+        token_lists = [tokens for part in _get_executor().map(encode_slice, slices) for tokens in part]
+    _record(
+        encode_calls=1,
+        texts_encoded=len(texts),
+        tokens_encoded=sum(len(tokens) for tokens in token_lists),
+        encode_seconds=time.perf_counter() - start_time,
+    )
+    return token_lists
+
+
+def count_tokens_batch(texts: List[str], model_name: str = DEFAULT_ENCODING_NAME) -> List[int]:
+    """Counts tokens for many texts in one batch call."""
+    return [len(tokens) for tokens in encode_batch(texts, model_name)]
+
+
+def count_tokens(text: str, model_name: str = DEFAULT_ENCODING_NAME) -> int:
+    """Counts tokens in a single string."""
+    return count_tokens_batch([text], model_name)[0]
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model_name: str = DEFAULT_ENCODING_NAME) -> str:
+    """Returns text cut down to at most max_tokens tokens (unchanged if it already fits)."""
+    tokens = encode_batch([text], model_name)[0]
+    if len(tokens) <= max_tokens:
+        return text
+    return get_encoding(model_name).decode(tokens[:max_tokens])
+
+
+def get_tokenizer_stats() -> Dict[str, Any]:
+    """Returns a snapshot of the tokenizer counters for this process."""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["average_encode_ms"] = (stats["encode_seconds"] * 1000 / stats["encode_calls"]) if stats["encode_calls"] else 0.0
+    stats["loaded_encoders"] = sorted(_encodings.keys())
+    return stats
+
+
+def reset_tokenizer_stats() -> None:
+    """Resets the counters (loaded encoders are kept)."""
+    with _stats_lock:
+        for key in _stats:
+            _stats[key] = 0.0 if key == "encode_seconds" else 0
@@ -11,6 +11,7 @@ from pydub.exceptions import CouldntDecodeError
 import time
 
 from app.core.config import settings
+from app.services import openai_rate_limit_service
 
 logger = logging.getLogger(__name__)
 
@@ -131,6 +132,7 @@ class TranscriptionService:
                 logger.info(f"[Task ID: {task_uuid}] Sending transcription request to OpenAI")
                 logger.info(f"[Task ID: {task_uuid}] Request params: model={model}, format={response_format}, prompt={'set' if prompt else 'none'}")
                 
+                openai_rate_limit_service.acquire(model)
                 api_start_time = time.time()
                 transcription = self.client.audio.transcriptions.create(**transcription_params)
                 api_duration = time.time() - api_start_time
@@ -150,6 +152,8 @@ class TranscriptionService:
                 
         except openai.APIError as e:
             logger.error(f"[Task ID: {task_uuid}] OpenAI API error: {e}")
+            if isinstance(e, openai.RateLimitError):
+                openai_rate_limit_service.report_rate_limited(model)
             # Try fallback model if primary fails
             if model == self.DEFAULT_MODEL:
                 logger.info(f"[Task ID: {task_uuid}] Retrying with fallback model: {self.FALLBACK_MODEL}")
@@ -182,6 +186,7 @@ class TranscriptionService:
                 if language:
                     transcription_params["language"] = language
                 
+                openai_rate_limit_service.acquire(self.FALLBACK_MODEL)
                 transcription = self.client.audio.transcriptions.create(**transcription_params)
                 return self._process_simple_response(task_uuid, transcription, audio_file_path)
                 
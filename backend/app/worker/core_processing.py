@@ -1,7 +1,7 @@
 import logging
 import asyncio
 from uuid import UUID
-from typing import Optional, Tuple, List
+from typing import Optional, Tuple, List, Dict
 
 import fitz
 
@@ -18,11 +18,80 @@ from app.services.citation_extraction_service import CitationExtractionService
 
 logger = logging.getLogger(__name__)
 
+class PdfDocumentSession:
+    """
+    Keeps one PDF open for the lifetime of a task and caches the text of every page it extracts.
+    Opening large (especially scanned) PDFs is expensive, so the LLM attempts of
+    execute_shared_pdf_processing_pipeline all read from the same open document, and pages read by
+    an earlier attempt are not decoded again.
+    """
+
+    def __init__(self, pdf_path: str, task_id_for_logging: str = ""):
+        self.pdf_path = pdf_path
+        self.task_id_for_logging = task_id_for_logging
+        self._doc: Optional[fitz.Document] = None
+        self._page_texts: Dict[int, str] = {}
+
+    def __enter__(self) -> "PdfDocumentSession":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    @property
+    def doc(self) -> fitz.Document:
+        if self._doc is None:
+            self._doc = fitz.open(self.pdf_path)
+        return self._doc
+
+    @property
+    def page_count(self) -> int:
+        return self.doc.page_count
+
+    def get_page_text(self, page_index: int) -> str:
+        """Returns the plain text of a page (0-based index), decoding it only once."""
+        text = self._page_texts.get(page_index)
+        if text is None:
+            text = self.doc.load_page(page_index).get_text("text")
+            self._page_texts[page_index] = text
+        return text
+
+    def extract_pages(self, start_page_index: int, num_pages_to_extract: int) -> Tuple[str, int]:
+        """
+        Returns (text, pages_processed) for up to num_pages_to_extract pages starting at
+        start_page_index, with pages separated by blank lines.
+        """
+        total_doc_pages = self.page_count
+        if total_doc_pages == 0:
+            logger.warning(f"[Task ID: {self.task_id_for_logging}] PDF '{self.pdf_path}' has 0 pages.")
+            return "", 0
+
+        if start_page_index >= total_doc_pages:
+            logger.info(f"[Task ID: {self.task_id_for_logging}] Start page index ({start_page_index}) is beyond or at total pages ({total_doc_pages}). No new pages to process.")
+            return "", 0
+
+        pages_to_process_this_call = min(num_pages_to_extract, total_doc_pages - start_page_index)
+        if pages_to_process_this_call <= 0:
+            logger.info(f"[Task ID: {self.task_id_for_logging}] Calculated 0 pages to process this call (start: {start_page_index}, req: {num_pages_to_extract}, avail: {total_doc_pages - start_page_index}).")
+            return "", 0
+
+        page_texts = [
+            self.get_page_text(page_index)
+            for page_index in range(start_page_index, start_page_index + pages_to_process_this_call)
+        ]
+        return "\n\n".join(page_texts).strip(), pages_to_process_this_call
+
+    def close(self) -> None:
+        if self._doc is not None:
+            self._doc.close()
+            self._doc = None
+
 def extract_text_from_pdf_pages(
     input_pdf_path: str, 
     start_page_index: int, 
     num_pages_to_extract: int, 
-    task_id_for_logging: str = ""
+    task_id_for_logging: str = "",
+    session: Optional[PdfDocumentSession] = None
 ) -> Tuple[str, int]:
     """
     Extracts text from a specified range of pages in the input PDF.
@@ -31,51 +100,30 @@ def extract_text_from_pdf_pages(
         start_page_index: 0-based index of the first page to start extraction from.
         num_pages_to_extract: The number of pages to attempt to extract from the start_page_index.
         task_id_for_logging: Optional task ID for logging context.
+        session: Optional open PdfDocumentSession for input_pdf_path. Without one, the file is
+                 opened (and closed) just for this call.
     Returns:
         A tuple containing: (extracted_text: str, pages_actually_processed_count: int)
     """
-    extracted_text = ""
-    pages_actually_processed_count = 0
+    owns_session = session is None
+    if owns_session:
+        session = PdfDocumentSession(input_pdf_path, task_id_for_logging)
     try:
-        doc = fitz.open(input_pdf_path)
-        total_doc_pages = doc.page_count
-
-        if total_doc_pages == 0:
-            logger.warning(f"[Task ID: {task_id_for_logging}] PDF '{input_pdf_path}' has 0 pages.")
-            doc.close()
-            return "", 0
-
-        if start_page_index >= total_doc_pages:
-            logger.info(f"[Task ID: {task_id_for_logging}] Start page index ({start_page_index}) is beyond or at total pages ({total_doc_pages}). No new pages to process.")
-            doc.close()
-            return "", 0
-
-        pages_remaining_in_doc = total_doc_pages - start_page_index 
-        pages_to_process_this_call = min(num_pages_to_extract, pages_remaining_in_doc)
-
-        if pages_to_process_this_call <= 0:
-            logger.info(f"[Task ID: {task_id_for_logging}] Calculated 0 pages to process this call (start: {start_page_index}, req: {num_pages_to_extract}, avail: {pages_remaining_in_doc}).")
-            doc.close()
-            return "", 0
-            
-        for i in range(pages_to_process_this_call):
-            page_to_load_index = start_page_index + i
-            page = doc.load_page(page_to_load_index)
-            extracted_text += page.get_text("text") + "\n\n"
-            pages_actually_processed_count += 1
-        
-        doc.close()
+        extracted_text, pages_actually_processed_count = session.extract_pages(start_page_index, num_pages_to_extract)
 
-        if pages_actually_processed_count > 0 and extracted_text.strip():
-            logger.info(f"[Task ID: {task_id_for_logging}] Successfully extracted text from {pages_actually_processed_count} pages (starting PDF index {start_page_index}) of '{input_pdf_path}'. New text length: {len(extracted_text.strip())}")
-        elif pages_actually_processed_count > 0 and not extracted_text.strip():
+        if pages_actually_processed_count > 0 and extracted_text:
+            logger.info(f"[Task ID: {task_id_for_logging}] Successfully extracted text from {pages_actually_processed_count} pages (starting PDF index {start_page_index}) of '{input_pdf_path}'. New text length: {len(extracted_text)}")
+        elif pages_actually_processed_count > 0 and not extracted_text:
             logger.info(f"[Task ID: {task_id_for_logging}] Processed {pages_actually_processed_count} pages (starting PDF index {start_page_index}) but extracted no new text (e.g. image-based pages).")
         
-        return extracted_text.strip(), pages_actually_processed_count
+        return extracted_text, pages_actually_processed_count
     
     except Exception as e:
         logger.error(f"[Task ID: {task_id_for_logging}] Error extracting text from '{input_pdf_path}' (start_idx: {start_page_index}, num_to_extract: {num_pages_to_extract}): {e}", exc_info=True)
         return "", 0
+    finally:
+        if owns_session:
+            session.close()
 
 async def execute_shared_pdf_processing_pipeline(
     db: Client,
@@ -99,15 +147,15 @@ async def execute_shared_pdf_processing_pipeline(
     total_text_for_llm = ""
     current_processing_start_page_index = 0
     created_reference_id: Optional[UUID] = None
+    # The PDF is opened once for the page count and every extraction attempt
+    pdf_session = PdfDocumentSession(local_pdf_path_for_analysis, str(task_uuid))
 
     try:
         logger.info(f"[Task ID: {task_uuid}] Starting shared PDF processing for: {local_pdf_path_for_analysis}, original: {original_input_name}")
 
         pdf_doc_total_pages = 0
         try:
-            doc_for_count = fitz.open(local_pdf_path_for_analysis)
-            pdf_doc_total_pages = doc_for_count.page_count
-            doc_for_count.close()
+            pdf_doc_total_pages = pdf_session.page_count
             if pdf_doc_total_pages == 0:
                  logger.warning(f"[Task ID: {task_uuid}] PDF {local_pdf_path_for_analysis} has 0 pages. Cannot extract text for LLM.")
         except Exception as e:
@@ -143,7 +191,8 @@ async def execute_shared_pdf_processing_pipeline(
                     local_pdf_path_for_analysis,
                     start_page_index=current_processing_start_page_index,
                     num_pages_to_extract=pages_to_request_this_attempt,
-                    task_id_for_logging=str(task_uuid)
+                    task_id_for_logging=str(task_uuid),
+                    session=pdf_session
                 )
 
                 if pages_processed_this_call > 0 and newly_extracted_text_chunk.strip():
@@ -271,4 +320,6 @@ async def execute_shared_pdf_processing_pipeline(
              update_task(db=db, task_identifier=task_uuid, task_in=TaskUpdate(
                 status=TaskStatusEnum.FAILED, current_step_description=f"Error in shared pipeline: {str(e)[:100]}",
                 error_details=str(e), progress_percentage=90))
-        raise 
\ No newline at end of file
+        raise
+    finally:
+        pdf_session.close() 
\ No newline at end of file
@@ -0,0 +1,252 @@
+import logging
+import shutil
+import tempfile
+from typing import Any, Dict, List
+from uuid import UUID
+
+import redis
+from celery.exceptions import Retry
+
+from app.worker.celery_app import celery_app
+from app.core.supabase_client import get_supabase_client
+from app.crud.crud_task import update_task
+from app.schemas.task import TaskUpdate, TaskStatusEnum
+from app.services import embedding_backend_service
+from app.services import embedding_bulk_service
+from app.services import task_checkpoint_service
+from app.crud import crud_chunk
+
+from app.core.config import settings
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+BACKFILL_CHECKPOINT = "embedding_backfill"
+
+
+class BackfillStateError(RuntimeError):
+    """The backfill state (the manifest of submitted batches) could not be stored or was lost."""
+
+
+def _save_state(task_uuid: UUID, state: Dict[str, Any], ttl_seconds: int) -> None:
+    if not task_checkpoint_service.save(task_uuid, BACKFILL_CHECKPOINT, state, ttl_seconds=ttl_seconds):
+        raise BackfillStateError("Could not store the backfill state in Redis.")
+
+
+def _cancel_batches(task_uuid: UUID, state: Dict[str, Any]) -> None:
+    """Cancels the submitted batches of a backfill that cannot track them (best effort)."""
+    for batch_state in state["batches"]:
+        if batch_state["batch_id"] and not batch_state["done"]:
+            try:
+                embedding_bulk_service.cancel_batch(batch_state["batch_id"])
+            except Exception as e:
+                logger.error(f"[Task ID: {task_uuid}] Could not cancel batch {batch_state['batch_id']}: {e}")
+
+
+def _submit_backfill(task_uuid: UUID, db, chatbot_uuid: UUID, ref_uuid: UUID | None, state_ttl_seconds: int) -> Dict[str, Any]:
+    """
+    Writes the chunks into batch input files and submits them. Returns the backfill state.
+    The state is stored before the first submission and after each one, so a later poll never
+    finds batches that were submitted but not recorded; if it cannot be stored, the batches
+    submitted so far are cancelled and BackfillStateError is raised.
+    """
+    model = settings.OPENAI_EMBEDDING_MODEL
+    temp_dir_path = tempfile.mkdtemp()
+    try:
+        writer = embedding_bulk_service.BatchFileWriter(temp_dir_path, model)
+        total_chunks = 0
+        try:
+            for rows in crud_chunk.iter_chunk_texts(db=db, chatbot_id=chatbot_uuid, reference_id=ref_uuid):
+                writer.add_chunks(
+                    [row["chunk_id"] for row in rows],
+                    [row["chunk_text"] for row in rows],
+                    [row["token_count"] for row in rows]
+                )
+                total_chunks += len(rows)
+        finally:
+            writer.close()
+
+        state = {
+            "model": model, "total_chunks": total_chunks, "chunks_updated": 0, "failed_chunks": 0, "prompt_tokens": 0,
+            "batches": [{"batch_id": None, "requests": batch_file["requests"], "done": False} for batch_file in writer.files],
+        }
+        if not state["batches"]:
+            return state
+        _save_state(task_uuid, state, state_ttl_seconds)
+        try:
+            for batch_file, batch_state in zip(writer.files, state["batches"]):
+                batch_state["batch_id"] = embedding_bulk_service.submit_batch(batch_file["path"], metadata={"task_identifier": str(task_uuid)})
+                _save_state(task_uuid, state, state_ttl_seconds)
+        except Exception:
+            _cancel_batches(task_uuid, state)
+            raise
+        logger.info(f"[Task ID: {task_uuid}] Submitted {total_chunks} chunks for re-embedding with {model} in {len(state['batches'])} batch(es).")
+        return state
+    finally:
+        shutil.rmtree(temp_dir_path, ignore_errors=True)
+
+
+def _store_batch_results(task_uuid: UUID, db, batch: Any, requests: Dict[str, Dict[str, Any]], state: Dict[str, Any]) -> None:
+    """Streams a finished batch's embeddings into document_chunks and updates the state's counters."""
+    chunk_ids: List[str] = []
+    embeddings = []
+    seen = set()
+
+    def flush() -> None:
+        updated, error = crud_chunk.update_chunk_embeddings(db=db, chunk_ids=chunk_ids, embeddings=embeddings)
+        state["chunks_updated"] += updated
+        if error:
+            logger.error(f"[Task ID: {task_uuid}] {error}")
+            state["failed_chunks"] += len(chunk_ids) - updated
+        chunk_ids.clear()
+        embeddings.clear()
+
+    for custom_id, request_embeddings, prompt_tokens in embedding_bulk_service.iter_batch_results(batch):
+        request = requests.get(custom_id)
+        if request is None or custom_id in seen:
+            continue
+        seen.add(custom_id)
+        if request_embeddings is None:
+            state["failed_chunks"] += len(request["chunk_ids"])
+            continue
+        state["prompt_tokens"] += prompt_tokens
+        chunk_ids.extend(request["chunk_ids"])
+        embeddings.extend(embedding_bulk_service.embeddings_for_request(request, request_embeddings))
+        if len(chunk_ids) >= settings.DB_INSERT_BATCH_SIZE:
+            flush()
+    if chunk_ids:
+        flush()
+
+    # Requests without a result line (e.g. in an expired or cancelled batch) were never embedded
+    state["failed_chunks"] += sum(len(request["chunk_ids"]) for custom_id, request in requests.items() if custom_id not in seen)
+
+
+@celery_app.task(name="embedding_backfill_task", bind=True)
+def embedding_backfill_task(self, task_identifier: str, chatbot_id: str, reference_id: str | None = None):
+    """
+    Celery task to re-embed a chatbot's existing chunks (or one reference's) through the OpenAI
+    Batch API: submits the chunks as batches, then requeues itself every
+    EMBEDDING_BULK_POLL_INTERVAL_SECONDS until the batches have finished, streaming their results
+    into document_chunks. Live indexing tasks are unaffected, as the Batch API has its own quota.
+    """
+    db = None
+    task_uuid = UUID(task_identifier)
+    chatbot_uuid = UUID(chatbot_id)
+    ref_uuid = UUID(reference_id) if reference_id else None
+    state = None
+
+    logger.info(f"[Task ID: {task_uuid}] Running embedding_backfill_task for Chatbot ID: {chatbot_uuid}, Reference ID: {ref_uuid} (poll {self.request.retries}).")
+
+    try:
+        db = get_supabase_client()
+        if not db:
+            raise ConnectionError("Failed to get Supabase client for Celery task.")
+
+        # The state must outlive the batches' completion window, so it expires with the last poll
+        state_ttl_seconds = settings.EMBEDDING_BULK_POLL_INTERVAL_SECONDS * (settings.EMBEDDING_BULK_MAX_POLLS + 1)
+
+        # 1. Submit the batches, unless a previous poll of this task already did. A poll that cannot
+        # find the state must not resubmit (and pay for) every batch again.
+        try:
+            state = task_checkpoint_service.load(task_uuid, BACKFILL_CHECKPOINT, strict=True)
+        except redis.RedisError as e:
+            if self.request.retries == 0:
+                raise
+            logger.warning(f"[Task ID: {task_uuid}] Could not read the backfill state ({e}). Polling again later.")
+            raise self.retry(countdown=settings.EMBEDDING_BULK_POLL_INTERVAL_SECONDS, max_retries=settings.EMBEDDING_BULK_MAX_POLLS)
+        if state is None and self.request.retries > 0:
+            raise BackfillStateError("The backfill state was lost from Redis; its batches cannot be tracked and were not resubmitted.")
+        if state is not None and any(batch_state["batch_id"] is None for batch_state in state["batches"]):
+            raise BackfillStateError("Batch submission was interrupted; the batches it submitted were cancelled.") # See the failure handler
+        if state is None:
+            if embedding_backend_service.resolve_backend() != embedding_backend_service.OPENAI_BACKEND:
+                raise ValueError("EMBEDDING_BACKEND is not 'openai'; bulk re-embedding requires the OpenAI embedding backend.")
+            if not settings.OPENAI_API_KEY:
+                raise ValueError("OPENAI_API_KEY is not set.")
+            update_task(db=db, task_identifier=task_uuid, task_in=TaskUpdate(
+                status=TaskStatusEnum.PROCESSING,
+                current_step_description="Preparing chunks for bulk re-embedding...",
+                progress_percentage=5
+            ))
+            state = _submit_backfill(task_uuid, db, chatbot_uuid, ref_uuid, state_ttl_seconds)
+
+        # 2. Store the results of every batch that has finished since the last poll
+        pending_batches = 0
+        completed_requests = total_requests = 0
+        for batch_state in state["batches"]:
+            if batch_state["done"]:
+                continue
+            batch = embedding_bulk_service.get_batch(batch_state["batch_id"])
+            if batch.status not in embedding_bulk_service.TERMINAL_STATUSES:
+                pending_batches += 1
+                if batch.request_counts:
+                    completed_requests += batch.request_counts.completed + batch.request_counts.failed
+                    total_requests += batch.request_counts.total
+                continue
+            logger.info(f"[Task ID: {task_uuid}] Batch {batch.id} {batch.status}. Storing its embeddings.")
+            _store_batch_results(task_uuid, db, batch, batch_state["requests"], state)
+            batch_state["done"] = True
+            batch_state["requests"] = {} # No longer needed; keeps the checkpoint small
+            if not task_checkpoint_service.save(task_uuid, BACKFILL_CHECKPOINT, state, ttl_seconds=state_ttl_seconds):
+                # The stored state still lists the batch as pending, so the next poll stores its
+                # results again; updating embeddings is idempotent
+                logger.warning(f"[Task ID: {task_uuid}] Could not record batch {batch.id} as stored.")
+
+        if pending_batches:
+            if self.request.retries >= settings.EMBEDDING_BULK_MAX_POLLS:
+                raise TimeoutError(f"{pending_batches} batches had not finished after {settings.EMBEDDING_BULK_MAX_POLLS} polls; they were cancelled.")
+            finished_batches = len(state["batches"]) - pending_batches
+            countdown = settings.EMBEDDING_BULK_POLL_INTERVAL_SECONDS
+            update_task(db=db, task_identifier=task_uuid, task_in=TaskUpdate(
+                status=TaskStatusEnum.PROCESSING,
+                current_step_description=(
+                    f"Waiting for {pending_batches} of {len(state['batches'])} embedding batches "
+                    f"({completed_requests} of {total_requests} requests done). {state['chunks_updated']} chunks updated so far."
+                ),
+                progress_percentage=10 + int(80 * finished_batches / len(state["batches"]))
+            ))
+            raise self.retry(countdown=countdown, max_retries=settings.EMBEDDING_BULK_MAX_POLLS)
+
+        # 3. Finalize task as COMPLETED
+        final_message = f"Re-embedded {state['chunks_updated']} of {state['total_chunks']} chunks with {state['model']} through the Batch API."
+        if state["failed_chunks"]:
+            final_message += f" {state['failed_chunks']} chunks could not be re-embedded and keep their previous embeddings."
+        logger.info(f"[Task ID: {task_uuid}] {final_message}")
+        update_task(db=db, task_identifier=task_uuid, task_in=TaskUpdate(
+            status=TaskStatusEnum.COMPLETED,
+            current_step_description=final_message,
+            progress_percentage=100,
+            result_payload={
+                "status": "success",
+                "message": final_message,
+                "chunks_updated": state["chunks_updated"],
+                "failed_chunks": state["failed_chunks"],
+                "batches": [batch_state["batch_id"] for batch_state in state["batches"]],
+                "prompt_tokens": state["prompt_tokens"],
+            }
+        ))
+
+        task_checkpoint_service.delete_all(task_uuid)
+        return {"status": "success", "task_id": str(task_uuid), "message": final_message}
+
+    except Retry:
+        raise # Polling again later; not a failure
+
+    except Exception as e:
+        error_message = f"An error occurred during bulk re-embedding for Chatbot ID {chatbot_uuid}: {str(e)}"
+        logger.error(f"[Task ID: {task_uuid}] CRITICAL ERROR in embedding_backfill_task: {error_message}", exc_info=True)
+        if state is not None:
+            # A failed backfill is never polled again, so batches still running would be paid for
+            # but never stored
+            _cancel_batches(task_uuid, state)
+        if db:
+            try:
+                update_task(db=db, task_identifier=task_uuid, task_in=TaskUpdate(
+                    status=TaskStatusEnum.FAILED,
+                    current_step_description="Failed during bulk re-embedding.",
+                    error_details=error_message,
+                    progress_percentage=0
+                ))
+            except Exception as db_error_on_fail:
+                logger.error(f"[Task ID: {task_uuid}] FAILED TO UPDATE TASK TO FAILED state after critical error. DB Error: {db_error_on_fail}", exc_info=True)
+        return {"status": "error", "task_id": str(task_uuid), "message": error_message}
@@ -3,6 +3,10 @@ import logging
 from uuid import UUID
 import os
 import shutil
+import random
+from typing import List, Optional
+
+from celery.exceptions import Retry
 
 from app.worker.celery_app import celery_app
 from app.core.supabase_client import get_supabase_client
@@ -10,11 +14,19 @@ from app.crud.crud_reference import get_reference, update_reference
 from app.crud.crud_task import update_task, get_task
 from app.schemas.task import TaskUpdate, TaskStatusEnum, Task
 from app.schemas.reference import ContentSourceUpdate, IndexingStatusEnum
+from app.schemas.chunk import ChunkCreate
 
 # Import services and CRUD for chunks
 from app.services import pdf_parsing_service
+from app.services import parse_cache_service
+from app.services import element_coalescing_service
 from app.services import chunking_service
 from app.services import embedding_service
+from app.services import embedding_cache_service
+from app.services import tokenizer_service
+from app.services import circuit_breaker_service
+from app.services import request_hedging_service
+from app.services import task_checkpoint_service
 from app.crud import crud_chunk
 
 from app.core.config import settings # Import settings
@@ -22,11 +34,34 @@ from app.core.config import settings # Import settings
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+
+def _checkpoint_chunks(task_uuid: UUID, chunks: List[ChunkCreate], file_hash: Optional[str]) -> None:
+    """Checkpoints the chunks before a requeue. Without a checkpoint the requeued task still works, but starts over from the download."""
+    if file_hash is None or not task_checkpoint_service.save_chunks(task_uuid, chunks, file_hash, settings.PDF_PARSER_TYPE):
+        logger.warning(f"[Task ID: {task_uuid}] Could not checkpoint {len(chunks)} chunks. The requeued task will download, parse and chunk the document again (embeddings already generated are still reused).")
+
+
+def _requeue(task, countdown: int, exc: Optional[Exception] = None, **counters: int) -> Retry:
+    """
+    Requeues the task with updated requeue counters. The counters (not request.retries) enforce
+    the limits of each kind of requeue; Celery's own limit is only their sum.
+    """
+    return task.retry(
+        exc=exc,
+        countdown=countdown,
+        kwargs={**task.request.kwargs, **counters},
+        max_retries=settings.TASK_OUTAGE_MAX_REQUEUES + settings.TASK_EMBEDDING_MAX_RETRIES
+    )
+
 @celery_app.task(name="document_indexing_task", bind=True)
-def document_indexing_task(self, task_identifier: str, reference_id: str, user_id: str, chatbot_id: str):
+def document_indexing_task(self, task_identifier: str, reference_id: str, user_id: str, chatbot_id: str,
+                           outage_requeues: int = 0, embedding_retries: int = 0):
     """
     Celery task to download a processed PDF file (or other format) from Supabase Storage,
     then parse it, chunk it, generate embeddings, and index its content in the database.
+
+    outage_requeues / embedding_retries count the two kinds of requeue (see step 5) separately;
+    they are only set by the task itself when it requeues.
     """
     db = None
     task_uuid = UUID(task_identifier)
@@ -36,6 +71,7 @@ def document_indexing_task(self, task_identifier: str, reference_id: str, user_i
 
     temp_dir_path = tempfile.mkdtemp()
     downloaded_file_path_local = None
+    file_hash = None # Set once the file is downloaded; identifies its parse cache entry
 
     logger.info(f"[Task ID: {task_uuid}] Starting document_indexing_task for Reference ID: {ref_id}, User ID: {user_uuid}, Chatbot ID: {chatbot_uuid}")
 
@@ -62,56 +98,78 @@ def document_indexing_task(self, task_identifier: str, reference_id: str, user_i
         original_file_name = os.path.basename(file_storage_path)
         logger.info(f"[Task ID: {task_uuid}] Reference found. File to download: '{file_storage_path}'")
 
-        # 2. Download the file from Supabase Storage
-        update_task(db=db, task_identifier=task_uuid, task_in=TaskUpdate(
-            current_step_description=f"Downloading '{original_file_name}'...",
-            progress_percentage=10
-        ))
-        downloaded_file_path_local = os.path.join(temp_dir_path, original_file_name)
-        logger.info(f"[Task ID: {task_uuid}] Downloading '{original_file_name}' to '{downloaded_file_path_local}'...")
+        # 2-4. Download, parse and chunk, unless a previous run of this task was requeued (during an
+        # OpenAI outage, or after failed embedding batches) and checkpointed its chunks (see step 5)
+        chunks_to_embed = task_checkpoint_service.load_chunks(task_uuid)
+        chunks_checkpointed = chunks_to_embed is not None
+        if chunks_checkpointed:
+            logger.info(f"[Task ID: {task_uuid}] Resuming from checkpoint with {len(chunks_to_embed)} chunks (attempt {self.request.retries + 1}).")
+            update_task(db=db, task_identifier=task_uuid, task_in=TaskUpdate(
+                status=TaskStatusEnum.PROCESSING,
+                current_step_description=f"Resumed from checkpoint with {len(chunks_to_embed)} chunks.",
+                progress_percentage=40
+            ))
+        else:
+            # 2. Download the file from Supabase Storage
+            update_task(db=db, task_identifier=task_uuid, task_in=TaskUpdate(
+                current_step_description=f"Downloading '{original_file_name}'...",
+                progress_percentage=10
+            ))
+            downloaded_file_path_local = os.path.join(temp_dir_path, original_file_name)
+            logger.info(f"[Task ID: {task_uuid}] Downloading '{original_file_name}' to '{downloaded_file_path_local}'...")
         
-        try:
-            storage_response_bytes = db.storage.from_("documents").download(path=file_storage_path)
-            if storage_response_bytes:
-                with open(downloaded_file_path_local, "wb") as f:
-                    f.write(storage_response_bytes)
-                logger.info(f"[Task ID: {task_uuid}] Successfully downloaded '{original_file_name}'.")
-            else:
-                raise FileNotFoundError(f"Could not download '{file_storage_path}'. Response was empty or invalid.")
-        except Exception as download_exc:
-            logger.error(f"[Task ID: {task_uuid}] Download error for '{file_storage_path}': {download_exc}", exc_info=True)
-            raise # Re-raise to be caught by main try-except
-
-        if not os.path.exists(downloaded_file_path_local) or os.path.getsize(downloaded_file_path_local) == 0:
-            raise FileNotFoundError(f"Downloaded file '{downloaded_file_path_local}' not found or is empty.")
-
-        # 3. Parse PDF content
-        update_task(db=db, task_identifier=task_uuid, task_in=TaskUpdate(
-            current_step_description=f"Parsing content from '{original_file_name}'...",
-            progress_percentage=25
-        ))
-        logger.info(f"[Task ID: {task_uuid}] Parsing PDF: {downloaded_file_path_local}")
-        parsed_pages = pdf_parsing_service.parse_pdf(file_path=downloaded_file_path_local)
-        if not parsed_pages:
-            # parse_pdf should raise an error if it fails, but handle empty list defensively
-            raise ValueError(f"PDF parsing returned no pages for '{original_file_name}'.")
-        logger.info(f"[Task ID: {task_uuid}] Successfully parsed {len(parsed_pages)} pages.")
-
-        # 4. Chunk parsed content
-        update_task(db=db, task_identifier=task_uuid, task_in=TaskUpdate(
-            current_step_description="Chunking parsed content...",
-            progress_percentage=40
-        ))
-        # Max tokens and overlap can be made configurable if needed, e.g., from task payload or global settings
-        chunks_to_embed = chunking_service.chunk_parsed_pages(
-            parsed_pages=parsed_pages,
-            reference_id=ref_id,
-            user_id=user_uuid, # Pass user UUID
-            chatbot_id=chatbot_uuid, # Pass chatbot_id from task args
-            min_tokens_per_chunk =  settings.MIN_TOKENS_PER_CHUNK,
-            max_tokens_per_chunk=settings.MAX_TOKENS_PER_CHUNK, # Use settings
-            token_overlap=settings.TOKEN_OVERLAP         # Use settings
-        )
+            try:
+                storage_response_bytes = db.storage.from_("documents").download(path=file_storage_path)
+                if storage_response_bytes:
+                    with open(downloaded_file_path_local, "wb") as f:
+                        f.write(storage_response_bytes)
+                    logger.info(f"[Task ID: {task_uuid}] Successfully downloaded '{original_file_name}'.")
+                else:
+                    raise FileNotFoundError(f"Could not download '{file_storage_path}'. Response was empty or invalid.")
+            except Exception as download_exc:
+                logger.error(f"[Task ID: {task_uuid}] Download error for '{file_storage_path}': {download_exc}", exc_info=True)
+                raise # Re-raise to be caught by main try-except
+
+            if not os.path.exists(downloaded_file_path_local) or os.path.getsize(downloaded_file_path_local) == 0:
+                raise FileNotFoundError(f"Downloaded file '{downloaded_file_path_local}' not found or is empty.")
+
+            # 3. Parse and chunk PDF content
+            # Pages are parsed, coalesced and chunked as a stream, so only the current page's
+            # parser state is alive at any time instead of the whole document's.
+            # An unchanged file already parsed with the same parser version comes from the parse cache.
+            update_task(db=db, task_identifier=task_uuid, task_in=TaskUpdate(
+                current_step_description=f"Parsing and chunking content from '{original_file_name}'...",
+                progress_percentage=25
+            ))
+            logger.info(f"[Task ID: {task_uuid}] Parsing PDF: {downloaded_file_path_local}")
+            file_hash = parse_cache_service.compute_file_hash(downloaded_file_path_local)
+            parsed_parts = parse_cache_service.parse_pdf_iter_cached(
+                file_path=downloaded_file_path_local,
+                parser_type=settings.PDF_PARSER_TYPE,
+                processes=pdf_parsing_service.get_parse_process_count(),
+                file_hash=file_hash
+            )
+            coalesced_parts = (
+                element_coalescing_service.coalesce_document(part, granularity=settings.PDF_ELEMENT_GRANULARITY)
+                for part in parsed_parts
+            )
+
+            # 4. Chunk parsed content
+            # Max tokens and overlap can be made configurable if needed, e.g., from task payload or global settings
+            chunks_to_embed = chunking_service.chunk_parsed_document_stream(
+                documents=coalesced_parts,
+                reference_id=ref_id,
+                user_id=user_uuid, # Pass user UUID
+                chatbot_id=chatbot_uuid, # Pass chatbot_id from task args
+                min_tokens_per_chunk =  settings.MIN_TOKENS_PER_CHUNK,
+                max_tokens_per_chunk=settings.MAX_TOKENS_PER_CHUNK, # Use settings
+                token_overlap=settings.TOKEN_OVERLAP         # Use settings
+            )
+            update_task(db=db, task_identifier=task_uuid, task_in=TaskUpdate(
+                current_step_description="Parsed content chunked.",
+                progress_percentage=40
+            ))
+
         if not chunks_to_embed:
             logger.warning(f"[Task ID: {task_uuid}] No chunks were generated for '{original_file_name}'. This might be normal for very short documents.")
             # If no chunks, the process can be considered complete for indexing purposes.
@@ -130,6 +188,7 @@ def document_indexing_task(self, task_identifier: str, reference_id: str, user_i
             ))
             return {"status": "success", "task_id": str(task_uuid), "message": "No chunks generated to index."}
         logger.info(f"[Task ID: {task_uuid}] Generated {len(chunks_to_embed)} chunks for embedding.")
+        logger.info(f"[Task ID: {task_uuid}] Tokenizer stats: {tokenizer_service.get_tokenizer_stats()}")
 
         # 5. Generate embeddings for chunks
         update_task(db=db, task_identifier=task_uuid, task_in=TaskUpdate(
@@ -138,8 +197,45 @@ def document_indexing_task(self, task_identifier: str, reference_id: str, user_i
         ))
         # embedding_service.DEFAULT_EMBEDDING_MODEL will be used if not specified
         # Now embedding_service will use settings.OPENAI_EMBEDDING_MODEL by default
-        chunk_embeddings_data = embedding_service.generate_embeddings_for_chunks(chunks_data=chunks_to_embed)
+        embedding_cache_service.reset_cache_stats()
+        request_hedging_service.reset_hedge_stats()
+        try:
+            chunk_embeddings_data = embedding_service.generate_embeddings_for_chunks(chunks_data=chunks_to_embed, task_id=task_uuid)
+        except circuit_breaker_service.CircuitOpenError as e:
+            if outage_requeues >= settings.TASK_OUTAGE_MAX_REQUEUES:
+                raise # Give up; handled as a failure below
+            # Free this worker slot instead of sleeping through the outage: checkpoint the chunks
+            # and requeue the task to resume once the breaker has closed
+            countdown = int(e.retry_after) + random.randint(1, 10) # Jitter, so requeued tasks do not resume in lockstep
+            if not chunks_checkpointed:
+                _checkpoint_chunks(task_uuid, chunks_to_embed, file_hash)
+            logger.warning(f"[Task ID: {task_uuid}] {e} Requeueing the task in {countdown}s (requeue {outage_requeues + 1} of {settings.TASK_OUTAGE_MAX_REQUEUES}).")
+            update_task(db=db, task_identifier=task_uuid, task_in=TaskUpdate(
+                status=TaskStatusEnum.QUEUED,
+                current_step_description=f"OpenAI is currently unavailable. Indexing will resume in about {countdown} seconds.",
+                progress_percentage=40
+            ))
+            raise _requeue(self, countdown, exc=e, outage_requeues=outage_requeues + 1)
+        embedding_cache_stats = embedding_cache_service.get_cache_stats()
+        logger.info(f"[Task ID: {task_uuid}] Embedding cache stats: {embedding_cache_stats}")
+        embedding_hedge_stats = request_hedging_service.get_hedge_stats()
+        if embedding_hedge_stats["hedged"] or embedding_hedge_stats["skipped_over_budget"]:
+            logger.info(f"[Task ID: {task_uuid}] Embedding hedge stats: {embedding_hedge_stats}")
         if not chunk_embeddings_data or len(chunk_embeddings_data) != len(chunks_to_embed):
+            if embedding_retries < settings.TASK_EMBEDDING_MAX_RETRIES:
+                # Completed batches are checkpointed per chunk (see embedding_service), so the retry
+                # skips download, parsing and chunking and only requests the missing embeddings
+                missing = len(chunks_to_embed) - len(chunk_embeddings_data or [])
+                if not chunks_checkpointed:
+                    _checkpoint_chunks(task_uuid, chunks_to_embed, file_hash)
+                countdown = settings.TASK_EMBEDDING_RETRY_COUNTDOWN_SECONDS
+                logger.warning(f"[Task ID: {task_uuid}] {missing} of {len(chunks_to_embed)} chunks could not be embedded. Retrying them in {countdown}s (retry {embedding_retries + 1} of {settings.TASK_EMBEDDING_MAX_RETRIES}).")
+                update_task(db=db, task_identifier=task_uuid, task_in=TaskUpdate(
+                    status=TaskStatusEnum.QUEUED,
+                    current_step_description=f"Embeddings for {missing} chunks failed. Retrying them in about {countdown} seconds.",
+                    progress_percentage=40
+                ))
+                raise _requeue(self, countdown, embedding_retries=embedding_retries + 1)
             raise Exception(f"Failed to generate embeddings for all chunks. Expected {len(chunks_to_embed)}, got {len(chunk_embeddings_data) if chunk_embeddings_data else 0}.")
         logger.info(f"[Task ID: {task_uuid}] Successfully generated embeddings for {len(chunk_embeddings_data)} chunks.")
 
@@ -162,11 +258,11 @@ def document_indexing_task(self, task_identifier: str, reference_id: str, user_i
             progress_percentage=90
         ))
         logger.info(f"[Task ID: {task_uuid}] Bulk inserting {len(chunk_embeddings_data)} new chunks.")
-        inserted_data, insert_error = crud_chunk.bulk_create_chunks_with_embeddings(db=db, chunk_embeddings_data=chunk_embeddings_data)
-        if insert_error or len(inserted_data) != len(chunk_embeddings_data):
-            error_detail = insert_error if insert_error else f"Inserted count mismatch: expected {len(chunk_embeddings_data)}, got {len(inserted_data)}."
+        inserted_count, insert_error = crud_chunk.bulk_create_chunks_with_embeddings(db=db, chunk_embeddings_data=chunk_embeddings_data)
+        if insert_error or inserted_count != len(chunk_embeddings_data):
+            error_detail = insert_error if insert_error else f"Inserted count mismatch: expected {len(chunk_embeddings_data)}, got {inserted_count}."
             raise Exception(f"Failed to bulk insert all chunks: {error_detail}")
-        logger.info(f"[Task ID: {task_uuid}] Successfully inserted {len(inserted_data)} new chunks.")
+        logger.info(f"[Task ID: {task_uuid}] Successfully inserted {inserted_count} new chunks.")
 
         # 8. Update content source status to completed
         logger.info(f"[Task ID: {task_uuid}] Updating content source status to completed.")
@@ -176,17 +272,21 @@ def document_indexing_task(self, task_identifier: str, reference_id: str, user_i
         ))
 
         # 9. Finalize task as COMPLETED
-        final_message = f"Document '{original_file_name}' successfully parsed, chunked, embedded, and indexed. {len(inserted_data)} chunks stored."
+        final_message = f"Document '{original_file_name}' successfully parsed, chunked, embedded, and indexed. {inserted_count} chunks stored."
         logger.info(f"[Task ID: {task_uuid}] {final_message}")
         update_task(db=db, task_identifier=task_uuid, task_in=TaskUpdate(
             status=TaskStatusEnum.COMPLETED,
             current_step_description=final_message,
             progress_percentage=100,
-            result_payload={"status": "success", "message": final_message, "chunks_indexed": len(inserted_data)}
+            result_payload={"status": "success", "message": final_message, "chunks_indexed": inserted_count, "embedding_cache": embedding_cache_stats, "embedding_hedging": embedding_hedge_stats}
         ))
         
+        task_checkpoint_service.delete_all(task_uuid)
         return {"status": "success", "task_id": str(task_uuid), "message": final_message}
 
+    except Retry:
+        raise # Requeued with a countdown (see step 5); not a failure
+
     except Exception as e:
         error_message = f"An error occurred during document indexing for Reference ID {ref_id}: {str(e)}"
         logger.error(f"[Task ID: {task_uuid}] CRITICAL ERROR in document_indexing_task: {error_message}", exc_info=True)
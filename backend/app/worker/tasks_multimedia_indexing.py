@@ -15,6 +15,7 @@ from app.services.audio_extraction_service import audio_extraction_service
 from app.services.transcription_service import transcription_service
 from app.services.multimedia_chunking_service import multimedia_chunking_service
 from app.services.multimedia_embedding_service import multimedia_embedding_service
+from app.services import embedding_cache_service
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -143,6 +144,7 @@ def index_multimedia_task(
             progress_percentage=80
         ))
         
+        embedding_cache_service.reset_cache_stats()
         chunks_with_embeddings = multimedia_embedding_service.generate_embeddings_for_multimedia_chunks(
             task_uuid=task_uuid,
             chunks=chunks
@@ -150,6 +152,7 @@ def index_multimedia_task(
         
         # Get embedding statistics
         embedding_stats = multimedia_embedding_service.get_embedding_stats(chunks_with_embeddings)
+        embedding_stats["cache"] = embedding_cache_service.get_cache_stats()
         logger.info(f"[Task ID: {task_uuid}] Embedding stats: {embedding_stats}")
         
         stored_chunks_count = store_multimedia_chunks(
@@ -335,7 +338,7 @@ def store_multimedia_chunks(
         logger.info(f"[Task ID: {task_uuid}] Prepared {len(chunk_embedding_pairs)} chunks for database storage")
         
         # Use the multimedia CRUD function to store chunks
-        inserted_records, error_message = bulk_create_multimedia_chunks_with_embeddings(
+        stored_count, error_message = bulk_create_multimedia_chunks_with_embeddings(
             db=db,
             multimedia_chunk_embeddings_data=chunk_embedding_pairs,
             user_id=user_id,
@@ -345,11 +348,9 @@ def store_multimedia_chunks(
         if error_message:
             logger.error(f"[Task ID: {task_uuid}] Database storage error: {error_message}")
             # Don't raise exception, return partial success count
-            stored_count = len(inserted_records)
             logger.warning(f"[Task ID: {task_uuid}] Partial storage success: {stored_count}/{len(chunk_embedding_pairs)} chunks stored")
             return stored_count
         
-        stored_count = len(inserted_records)
         logger.info(f"[Task ID: {task_uuid}] Successfully stored {stored_count} multimedia chunks in database")
         
         # Log storage statistics
@@ -144,6 +144,12 @@ EXECUTE FUNCTION update_modified_column();
 -- 3. chatbots table must exist
 -- 4. chatbot_content_sources table must exist
 --
+-- Embedding profile:
+-- - The embedding column must match the backend's embedding profile (OPENAI_EMBEDDING_DIMENSIONS,
+--   EMBEDDING_STORAGE_PRECISION). The defaults match VECTOR(1536) above.
+-- - To store shortened text-embedding-3 embeddings as float16 (HALFVEC), run
+--   migrate_document_chunks_embedding_profile.sql (2-4x less table and index memory).
+--
 -- Common embedding dimensions:
 -- - OpenAI text-embedding-ada-002: 1536 dimensions
 -- - OpenAI text-embedding-3-small: 1536 dimensions  
@@ -0,0 +1,55 @@
+-- ================================================
+-- Embedding Cache Table Creation Script
+-- ================================================
+-- This script creates the embedding_cache table, the optional shared tier of the
+-- content-addressed embedding cache (app/services/embedding_cache_service.py).
+-- Enable it by setting EMBEDDING_CACHE_TABLE=embedding_cache for the workers.
+
+-- ================================================
+-- 1. EMBEDDING_CACHE TABLE
+-- ================================================
+-- Stores embeddings keyed by SHA-256 of (model, dimensions, text), shared by all workers
+
+CREATE TABLE IF NOT EXISTS public.embedding_cache (
+    cache_key TEXT NOT NULL, -- Hex SHA-256 of model + dimensions + embedded text
+    model TEXT NOT NULL,
+    embedding REAL[] NOT NULL, -- float32 values, as returned by the embedding API
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+
+    CONSTRAINT embedding_cache_pkey PRIMARY KEY (cache_key)
+) TABLESPACE pg_default;
+
+-- Add comments for documentation
+COMMENT ON TABLE public.embedding_cache IS 'Content-addressed cache of embedding vectors, shared by all indexing workers';
+COMMENT ON COLUMN public.embedding_cache.cache_key IS 'Hex SHA-256 of the model, output dimensions and exact text sent to the embedding API';
+COMMENT ON COLUMN public.embedding_cache.model IS 'Embedding model that produced the vector';
+COMMENT ON COLUMN public.embedding_cache.embedding IS 'Embedding vector';
+COMMENT ON COLUMN public.embedding_cache.created_at IS 'Timestamp when the embedding was cached';
+
+-- ================================================
+-- 2. INDEXES FOR PERFORMANCE
+-- ================================================
+
+-- Time-based index for pruning old entries
+CREATE INDEX IF NOT EXISTS embedding_cache_created_at_idx
+ON public.embedding_cache
+USING btree (created_at)
+TABLESPACE pg_default;
+
+-- ================================================
+-- 3. ROW LEVEL SECURITY (RLS)
+-- ================================================
+
+-- Enable RLS on the table. No policies are defined: only the backend (service role key)
+-- reads and writes the cache; cached vectors are never exposed to end users.
+ALTER TABLE public.embedding_cache ENABLE ROW LEVEL SECURITY;
+
+-- ================================================
+-- 4. ADDITIONAL NOTES
+-- ================================================
+--
+-- Usage:
+-- - Workers consult their local SQLite tier first and this table on local misses
+-- - Rows are upserted by cache_key, so concurrent workers storing the same text are harmless
+-- - The table is not size-bounded; prune it periodically if needed, e.g.:
+--   DELETE FROM public.embedding_cache WHERE created_at < NOW() - INTERVAL '90 days';
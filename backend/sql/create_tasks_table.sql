@@ -18,7 +18,8 @@ CREATE TABLE public.tasks (
         'URL_PROCESSING',
         'DOI_CITATION_FETCH',
         'PDF_GENERATION_FROM_URL',
-        'DOCUMENT_INDEXING'
+        'DOCUMENT_INDEXING',
+        'EMBEDDING_BACKFILL'
     )),
     status TEXT NOT NULL DEFAULT 'QUEUED' CHECK (status IN (
         'PENDING',
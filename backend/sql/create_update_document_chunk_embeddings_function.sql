@@ -0,0 +1,43 @@
+-- ================================================
+-- Document Chunk Embedding Update Function Script
+-- ================================================
+-- This script creates update_document_chunk_embeddings(), which replaces the embeddings of
+-- existing document chunks in one statement per batch. Bulk re-embedding backfills
+-- (app/worker/tasks_embedding_backfill.py) write their results through it.
+
+-- ================================================
+-- 1. UPDATE FUNCTION
+-- ================================================
+-- chunk_ids[i] gets embeddings[i], a pgvector text literal ('[0.0123,-0.5,...]'). The literal is
+-- read as vector and assigned to the column, which pgvector casts to halfvec if the column was
+-- migrated (migrate_document_chunks_embedding_profile.sql). Returns the number of rows updated;
+-- ids of chunks deleted in the meantime are skipped.
+
+CREATE OR REPLACE FUNCTION public.update_document_chunk_embeddings(chunk_ids uuid[], embeddings text[])
+RETURNS integer
+LANGUAGE sql
+AS $$
+  WITH updated AS (
+    UPDATE public.document_chunks dc
+    SET embedding = u.embedding::vector
+    FROM unnest(chunk_ids, embeddings) AS u(chunk_id, embedding)
+    WHERE dc.chunk_id = u.chunk_id
+    RETURNING 1
+  )
+  SELECT count(*)::integer FROM updated;
+$$;
+
+-- Only the backend (service role key) re-embeds chunks
+REVOKE EXECUTE ON FUNCTION public.update_document_chunk_embeddings(uuid[], text[]) FROM PUBLIC, anon, authenticated;
+
+-- ================================================
+-- 2. ADDITIONAL NOTES
+-- ================================================
+--
+-- Usage:
+-- SELECT public.update_document_chunk_embeddings(
+--     ARRAY['<chunk id>']::uuid[],
+--     ARRAY['[0.01,0.02,...]']
+-- );
+-- - Vectors must have the column's dimensions; a mismatch fails the whole batch
+-- - The update_document_chunks_modtime trigger sets updated_at on every updated row
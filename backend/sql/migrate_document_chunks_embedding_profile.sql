@@ -0,0 +1,173 @@
+-- ================================================
+-- Document Chunks Embedding Profile Migration Script
+-- ================================================
+-- This script converts document_chunks.embedding from VECTOR(1536) (float32) to HALFVEC(768)
+-- (float16, 768 dimensions), cutting vector storage and HNSW index memory 4x.
+--
+-- It matches this backend profile (see app/services/embedding_profile_service.py):
+--   OPENAI_EMBEDDING_MODEL=text-embedding-3-small
+--   OPENAI_EMBEDDING_DIMENSIONS=768
+--   EMBEDDING_STORAGE_PRECISION=float16
+-- For another profile, replace 768 and halfvec/halfvec_cosine_ops throughout
+-- (e.g. VECTOR(512) with vector_cosine_ops for float32 storage at 512 dimensions).
+--
+-- Existing rows are not re-embedded: text-embedding-3 embeddings shortened by the API equal the
+-- leading dimensions of the full embedding, re-normalised, which is what the conversion below
+-- does. (Rows embedded with text-embedding-ada-002 cannot be shortened this way; re-index them.)
+
+-- ================================================
+-- 0. PREREQUISITES
+-- ================================================
+-- - pgvector 0.7.0 or later (halfvec, subvector, l2_normalize): ALTER EXTENSION vector UPDATE;
+-- - Stop the indexing workers (or deploy the new profile settings first): rows written with the
+--   old profile during the migration would fail to insert.
+-- - The ALTER rewrites the table; run it in a maintenance window for large tables.
+
+-- ================================================
+-- 1. CONVERT THE EMBEDDING COLUMN
+-- ================================================
+
+-- The HNSW index is tied to the old column type; it is rebuilt in step 3
+DROP INDEX IF EXISTS public.document_chunks_embedding_idx;
+
+ALTER TABLE public.document_chunks
+ALTER COLUMN embedding TYPE HALFVEC(768)
+USING l2_normalize(subvector(embedding::vector, 1, 768))::halfvec(768);
+
+COMMENT ON COLUMN public.document_chunks.embedding IS 'Vector embedding of the chunk text for similarity search (768 dimensions of OpenAI text-embedding-3-small, stored as float16)';
+
+-- ================================================
+-- 2. QUERY EMBEDDING CONVERSION AND SEARCH FUNCTIONS
+-- ================================================
+
+-- Converts a query embedding (full 1536-dimension text-embedding-3-small output, as sent by the
+-- frontend, or already shortened) to the stored profile, so callers need no changes
+CREATE OR REPLACE FUNCTION public.document_chunks_query_embedding(query_embedding vector)
+RETURNS halfvec(768) AS $$
+    SELECT l2_normalize(subvector(query_embedding, 1, 768))::halfvec(768);
+$$ LANGUAGE sql IMMUTABLE STRICT;
+
+-- Legacy search function (supabase/schema.sql); no longer called by the app, but kept working
+CREATE OR REPLACE FUNCTION public.match_document_chunks(query_embedding vector, chatbot_id_param uuid, match_threshold double precision DEFAULT 0.7, match_count integer DEFAULT 10)
+RETURNS TABLE(chunk_id uuid, reference_id uuid, page_number integer, chunk_text text, token_count integer, similarity double precision, created_at timestamp with time zone)
+LANGUAGE sql STABLE
+AS $$
+  SELECT
+    dc.chunk_id,
+    dc.reference_id,
+    dc.page_number,
+    dc.chunk_text,
+    dc.token_count,
+    1 - (dc.embedding <=> public.document_chunks_query_embedding(query_embedding)) as similarity,
+    dc.created_at
+  FROM document_chunks dc
+  WHERE
+    dc.chatbot_id = chatbot_id_param
+    AND dc.embedding IS NOT NULL
+    AND 1 - (dc.embedding <=> public.document_chunks_query_embedding(query_embedding)) > match_threshold
+  ORDER BY (dc.embedding <=> public.document_chunks_query_embedding(query_embedding)) ASC
+  LIMIT match_count;
+$$;
+
+CREATE OR REPLACE FUNCTION public.match_document_chunks_enhanced(query_embedding vector, chatbot_id_param uuid, match_threshold double precision DEFAULT 0.7, match_count integer DEFAULT 10, content_types text[] DEFAULT ARRAY['document'::text, 'url'::text, 'video'::text, 'audio'::text], max_per_content_type integer DEFAULT NULL::integer)
+RETURNS TABLE(chunk_id uuid, reference_id uuid, page_number integer, chunk_text text, token_count integer, similarity double precision, content_type text, start_time_seconds integer, end_time_seconds integer, speaker text, chunk_type text, confidence_score double precision, created_at timestamp with time zone)
+LANGUAGE sql STABLE
+AS $$
+  WITH ranked_chunks AS (
+    SELECT
+      dc.chunk_id,
+      dc.reference_id,
+      dc.page_number,
+      dc.chunk_text,
+      dc.token_count,
+      1 - (dc.embedding <=> public.document_chunks_query_embedding(query_embedding)) as similarity,
+      dc.content_type,
+      dc.start_time_seconds,
+      dc.end_time_seconds,
+      dc.speaker,
+      dc.chunk_type,
+      dc.confidence_score,
+      dc.created_at,
+      ROW_NUMBER() OVER (
+        PARTITION BY dc.content_type
+        ORDER BY (dc.embedding <=> public.document_chunks_query_embedding(query_embedding)) ASC
+      ) as rn
+    FROM document_chunks dc
+    WHERE
+      dc.chatbot_id = chatbot_id_param
+      AND dc.embedding IS NOT NULL
+      AND dc.content_type = ANY(content_types)
+      AND 1 - (dc.embedding <=> public.document_chunks_query_embedding(query_embedding)) > match_threshold
+  )
+  SELECT
+    rc.chunk_id,
+    rc.reference_id,
+    rc.page_number,
+    rc.chunk_text,
+    rc.token_count,
+    rc.similarity,
+    rc.content_type,
+    rc.start_time_seconds,
+    rc.end_time_seconds,
+    rc.speaker,
+    rc.chunk_type,
+    rc.confidence_score,
+    rc.created_at
+  FROM ranked_chunks rc
+  WHERE
+    (max_per_content_type IS NULL OR rc.rn <= max_per_content_type)
+  ORDER BY rc.similarity DESC
+  LIMIT match_count;
+$$;
+
+CREATE OR REPLACE FUNCTION public.match_multimedia_chunks_with_time(query_embedding vector, chatbot_id_param uuid, reference_id_param uuid DEFAULT NULL::uuid, match_threshold double precision DEFAULT 0.7, match_count integer DEFAULT 10, time_range_start integer DEFAULT NULL::integer, time_range_end integer DEFAULT NULL::integer)
+RETURNS TABLE(chunk_id uuid, reference_id uuid, chunk_text text, similarity double precision, start_time_seconds integer, end_time_seconds integer, speaker text, chunk_type text, confidence_score double precision)
+LANGUAGE sql STABLE
+AS $$
+  SELECT
+    dc.chunk_id,
+    dc.reference_id,
+    dc.chunk_text,
+    1 - (dc.embedding <=> public.document_chunks_query_embedding(query_embedding)) as similarity,
+    dc.start_time_seconds,
+    dc.end_time_seconds,
+    dc.speaker,
+    dc.chunk_type,
+    dc.confidence_score
+  FROM document_chunks dc
+  WHERE
+    dc.chatbot_id = chatbot_id_param
+    AND dc.content_type IN ('video', 'audio')
+    AND dc.embedding IS NOT NULL
+    AND (reference_id_param IS NULL OR dc.reference_id = reference_id_param)
+    AND (time_range_start IS NULL OR dc.end_time_seconds >= time_range_start)
+    AND (time_range_end IS NULL OR dc.start_time_seconds <= time_range_end)
+    AND 1 - (dc.embedding <=> public.document_chunks_query_embedding(query_embedding)) > match_threshold
+  ORDER BY (dc.embedding <=> public.document_chunks_query_embedding(query_embedding)) ASC
+  LIMIT match_count;
+$$;
+
+-- ================================================
+-- 3. INDEXES FOR PERFORMANCE
+-- ================================================
+
+-- Vector similarity search index on the converted column. Cosine ops match the <=> operator used
+-- by the search functions (embeddings are unit length, so the ranking equals inner product).
+CREATE INDEX IF NOT EXISTS document_chunks_embedding_idx
+ON public.document_chunks
+USING hnsw (embedding halfvec_cosine_ops)
+TABLESPACE pg_default;
+
+-- ================================================
+-- 4. ADDITIONAL NOTES
+-- ================================================
+--
+-- Verification:
+-- SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+-- WHERE attrelid = 'public.document_chunks'::regclass AND attname = 'embedding'; -- halfvec(768)
+-- SELECT pg_size_pretty(pg_relation_size('public.document_chunks_embedding_idx'));
+--
+-- Rollback (precision and dropped dimensions are not recovered; re-index documents for full quality):
+-- DROP INDEX IF EXISTS public.document_chunks_embedding_idx;
+-- ALTER TABLE public.document_chunks ALTER COLUMN embedding TYPE VECTOR(768) USING embedding::vector(768);
+-- Then restore the search functions from supabase/schema.sql and recreate the index with vector_ip_ops.
@@ -0,0 +1,216 @@
+import json
+import os
+import types
+import uuid
+
+import numpy as np
+import pytest
+
+pytest.importorskip("supabase")
+
+from app.core import postgres_client
+from app.core.config import settings
+from app.crud import crud_chunk
+from app.schemas.chunk import ChunkCreate, ParsedTextElement
+
+
+@pytest.fixture
+def copy_database(monkeypatch):
+    """
+    A UTF-8 Postgres database with pgvector from TEST_DATABASE_URL (e.g.
+    postgresql://postgres@127.0.0.1:5432/syllabi_test). document_chunks is created there if missing,
+    and the embedding profile follows its column; rows written by a test are deleted afterwards.
+    """
+    psycopg = pytest.importorskip("psycopg")
+    pytest.importorskip("psycopg_pool")
+    url = os.environ.get("TEST_DATABASE_URL")
+    if not url:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    monkeypatch.setattr(settings, "CHUNK_WRITER", crud_chunk.COPY_WRITER)
+    monkeypatch.setattr(settings, "DATABASE_URL", url)
+    with psycopg.connect(url, autocommit=True) as connection:
+        connection.execute("CREATE EXTENSION IF NOT EXISTS vector")
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS public.document_chunks (
+                chunk_id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+                reference_id UUID NOT NULL,
+                user_id UUID,
+                chatbot_id UUID,
+                page_number INTEGER NOT NULL,
+                chunk_text TEXT NOT NULL,
+                token_count INTEGER NOT NULL,
+                embedding VECTOR(16),
+                constituent_elements_data JSONB,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            )""")
+        type_name, dimensions = connection.execute(
+            "SELECT atttypid::regtype::text, atttypmod FROM pg_attribute "
+            "WHERE attrelid = 'public.document_chunks'::regclass AND attname = 'embedding'"
+        ).fetchone()
+    precision = {"vector": "float32", "halfvec": "float16"}[type_name]
+    monkeypatch.setattr(settings, "EMBEDDING_STORAGE_PRECISION", precision)
+    monkeypatch.setattr(settings, "EMBEDDING_COLUMN_DIMENSIONS", dimensions)
+    reference_id = uuid.uuid4()
+    connection = psycopg.connect(url, autocommit=True)
+    yield connection, reference_id, dimensions, np.dtype(precision)
+    connection.execute("DELETE FROM public.document_chunks WHERE reference_id = %s", (reference_id,))
+    connection.close()
+    for pool in postgres_client._pools.values():
+        pool.close()
+    postgres_client._pools.clear()
+
+
+def _chunk(reference_id, index, elements):
+    return ChunkCreate(
+        reference_id=reference_id, user_id=uuid.uuid4(), chatbot_id=uuid.uuid4(),
+        page_number=index + 1, chunk_text=f"chunk ünïcode {index}", token_count=index * 10,
+        constituent_elements=elements,
+    )
+
+
+def test_copy_round_trips_rows_and_vectors(copy_database, monkeypatch):
+    connection, reference_id, dimensions, stored_dtype = copy_database
+    monkeypatch.setattr(crud_chunk, "COPY_WRITE_BYTES", 256) # Several writes per copy
+    elements = [
+        ParsedTextElement(text="héllo", x0=1, y0=2, x1=3, y1=4, page_number=1, page_width=612, page_height=792),
+        ParsedTextElement(text="wörld again", x0=5, y0=6, x1=7, y1=8, page_number=1, page_width=612, page_height=792,
+                          word_offsets=[0, 6], word_boxes=[5, 6, 6, 8, 6.5, 6, 7, 8]),
+    ]
+    embeddings = np.random.default_rng(0).standard_normal((20, dimensions)).astype(np.float32)
+    data = [(_chunk(reference_id, i, elements), embeddings[i]) for i in range(20)]
+
+    count, error = crud_chunk.bulk_create_chunks_with_embeddings(None, data)
+    assert (count, error) == (20, None)
+
+    rows = connection.execute(
+        "SELECT page_number, chunk_text, token_count, embedding::text, constituent_elements_data "
+        "FROM public.document_chunks WHERE reference_id = %s ORDER BY page_number", (reference_id,)
+    ).fetchall()
+    assert len(rows) == 20
+    for index, (page_number, chunk_text, token_count, embedding, constituent_elements) in enumerate(rows):
+        assert (page_number, chunk_text, token_count) == (index + 1, f"chunk ünïcode {index}", index * 10)
+        # Vectors arrive bit-exact at the storage precision (the text form prints round-tripping digits)
+        expected = embeddings[index].astype(stored_dtype)
+        assert np.array_equal(np.array(json.loads(embedding), dtype=stored_dtype), expected)
+        assert constituent_elements == [element.model_dump(exclude_none=True) for element in elements]
+
+
+def test_copy_is_all_or_nothing(copy_database):
+    connection, reference_id, dimensions, _ = copy_database
+    embeddings = np.ones((4, dimensions), dtype=np.float32)
+    data = [(_chunk(reference_id, i, []), embeddings[i]) for i in range(4)]
+    data.append((_chunk(reference_id, 4, []), np.ones(dimensions - 1, dtype=np.float32))) # Wrong dimensions
+
+    count, error = crud_chunk.bulk_create_chunks_with_embeddings(None, data)
+    assert count == 0
+    assert error.startswith("Failed to copy chunks")
+    assert connection.execute(
+        "SELECT count(*) FROM public.document_chunks WHERE reference_id = %s", (reference_id,)
+    ).fetchone()[0] == 0
+
+
+class InsertError(Exception):
+    def __init__(self, code, message="insert failed"):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class FakeTable:
+    """Records insert batches; `reject(batch)` returns an error code to fail a batch with, or None."""
+
+    def __init__(self, reject=lambda batch: None):
+        self.reject = reject
+        self.batches = []
+        self._pending = None
+
+    def table(self, name):
+        assert name == crud_chunk.DOCUMENT_CHUNKS_TABLE_NAME
+        return self
+
+    def insert(self, records, count=None, returning=None):
+        self._pending = list(records)
+        return self
+
+    def execute(self):
+        batch, self._pending = self._pending, None
+        code = self.reject(batch)
+        if code is not None:
+            raise InsertError(code)
+        self.batches.append([record["index"] for record in batch])
+        return types.SimpleNamespace(count=len(batch))
+
+
+@pytest.fixture
+def insert_budget(monkeypatch):
+    monkeypatch.setattr(crud_chunk, "_insert_budget_bytes", None)
+    monkeypatch.setattr(settings, "DB_INSERT_CONCURRENCY", 1)
+    monkeypatch.setattr(settings, "DB_INSERT_BATCH_SIZE", 1000)
+    monkeypatch.setattr(settings, "DB_INSERT_TARGET_SECONDS", 60.0)
+    monkeypatch.setattr(settings, "DB_INSERT_MIN_BATCH_BYTES", 1)
+    monkeypatch.setattr(settings, "DB_INSERT_MAX_BATCH_BYTES", 10 ** 9)
+
+
+def _records(count):
+    # Every record serialises to the same size
+    return [{"index": index, "chunk_text": "x" * 100} for index in range(count)]
+
+
+def test_batches_are_cut_by_bytes(monkeypatch, insert_budget):
+    records = _records(10)
+    record_size = crud_chunk._record_size(records[0])
+    monkeypatch.setattr(settings, "DB_INSERT_BATCH_BYTES", record_size * 3)
+    monkeypatch.setattr(settings, "DB_INSERT_MAX_BATCH_BYTES", record_size * 3) # No growth after full batches
+    db = FakeTable()
+
+    assert crud_chunk._insert_records(db, records, "") == (10, [])
+    assert db.batches == [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]]
+
+
+def test_rejected_batches_are_split_and_the_budget_lowered(monkeypatch, insert_budget):
+    records = _records(8)
+    record_size = crud_chunk._record_size(records[0])
+    monkeypatch.setattr(settings, "DB_INSERT_BATCH_BYTES", record_size * 8)
+    db = FakeTable(reject=lambda batch: "413" if len(batch) > 2 else None)
+
+    assert crud_chunk._insert_records(db, records, "") == (8, [])
+    assert db.batches == [[0, 1], [2, 3], [4, 5], [6, 7]]
+    # Each rejection halves the budget below the rejected batch
+    assert crud_chunk._insert_budget_bytes < record_size * 3
+
+
+def test_statement_timeouts_split_down_to_single_rows(monkeypatch, insert_budget):
+    records = _records(4)
+    monkeypatch.setattr(settings, "DB_INSERT_BATCH_BYTES", crud_chunk._record_size(records[0]) * 4)
+    db = FakeTable(reject=lambda batch: "57014" if any(record["index"] == 2 for record in batch) else None)
+
+    count, errors = crud_chunk._insert_records(db, records, "")
+    assert count == 3
+    assert db.batches == [[0, 1], [3]]
+    assert len(errors) == 1 and "batch 1.2.1 (1 chunks)" in errors[0]
+
+
+def test_other_errors_are_not_split(monkeypatch, insert_budget):
+    records = _records(4)
+    monkeypatch.setattr(settings, "DB_INSERT_BATCH_BYTES", crud_chunk._record_size(records[0]) * 4)
+    db = FakeTable(reject=lambda batch: "23505") # Unique violation: splitting would not help
+
+    count, errors = crud_chunk._insert_records(db, records, "")
+    assert count == 0
+    assert errors == ["Failed to insert batch 1 (4 chunks): insert failed"]
+
+
+def test_budget_adapts_to_batch_latency(monkeypatch, insert_budget):
+    monkeypatch.setattr(settings, "DB_INSERT_BATCH_BYTES", 1000)
+    monkeypatch.setattr(settings, "DB_INSERT_TARGET_SECONDS", 2.0)
+    crud_chunk._adapt_insert_budget(1000, 0.5, failed=False)
+    assert crud_chunk._get_insert_budget() == 1250 # A fast full batch grows the budget by a quarter
+    crud_chunk._adapt_insert_budget(100, 0.5, failed=False)
+    assert crud_chunk._get_insert_budget() == 1250 # A small batch says nothing
+    crud_chunk._adapt_insert_budget(1250, 5.0, failed=False)
+    assert crud_chunk._get_insert_budget() == 500 # Shrunk in proportion to the target latency
+    crud_chunk._adapt_insert_budget(400, 0.1, failed=True)
+    assert crud_chunk._get_insert_budget() == 200 # Half of the failed batch
+    monkeypatch.setattr(settings, "DB_INSERT_MIN_BATCH_BYTES", 150)
+    crud_chunk._adapt_insert_budget(200, 0.1, failed=True)
+    assert crud_chunk._get_insert_budget() == 150
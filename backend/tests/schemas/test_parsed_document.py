@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from app.schemas.chunk import ParsedPage, ParsedTextElement
+from app.schemas.parsed_document import ParsedDocument
+
+
+def _pages():
+    return [
+        ParsedPage(page_number=1, width=612.0, height=792.0, elements=[
+            ParsedTextElement(text="alpha", x0=72.0, y0=70.5, x1=101.25, y1=82.0, page_number=1, page_width=612.0, page_height=792.0),
+            ParsedTextElement(text="beta", x0=105.0, y0=70.5, x1=125.125, y1=82.0, page_number=1, page_width=612.0, page_height=792.0),
+        ]),
+        ParsedPage(page_number=2, width=612.0, height=792.0, elements=[]),
+        ParsedPage(page_number=3, width=595.5, height=842.25, elements=[
+            ParsedTextElement(text="gamma", x0=10.0, y0=20.0, x1=30.0, y1=40.0, page_number=3, page_width=595.5, page_height=842.25),
+        ]),
+    ]
+
+
+def _coalesced_document():
+    return ParsedDocument(
+        texts=["alpha beta", "gamma"],
+        x0=[72.0, 10.0], y0=[70.5, 20.0], x1=[125.125, 30.0], y1=[82.0, 40.0],
+        page_indices=[0, 1], page_numbers=[1, 2], page_widths=[612.0, 612.0], page_heights=[792.0, 792.0],
+        word_starts=[0, 2, 3],
+        word_char_offsets=[0, 6, 0],
+        word_boxes=[[72.0, 70.5, 101.25, 82.0], [105.0, 70.5, 125.125, 82.0], [10.0, 20.0, 30.0, 40.0]],
+    )
+
+
+def test_views_equal_validated_models():
+    pages = _pages()
+    document = ParsedDocument.from_parsed_pages(pages)
+    assert document.num_pages == 3
+    assert len(document) == 3
+    views = document.to_parsed_pages()
+    assert views == pages
+    # Views are built without validation, but serialize exactly like validated models
+    assert [view.model_dump_json() for view in views] == [page.model_dump_json() for page in pages]
+    assert ParsedPage.model_validate(views[0].model_dump()) == views[0]
+
+
+def test_element_range_views():
+    document = ParsedDocument.from_parsed_pages(_pages())
+    assert [element.text for element in document.elements(1, 3)] == ["beta", "gamma"]
+    assert document.elements(2, 2) == []
+    assert document.elements(1, 3)[1].page_number == 3
+    assert document.page(1).elements == []
+    assert document.element_page_numbers().tolist() == [1, 1, 3]
+
+
+def test_coalesced_views_carry_word_arrays():
+    element = _coalesced_document().elements(0, 1)[0]
+    assert element.word_offsets == [0, 6]
+    assert element.word_boxes == [72.0, 70.5, 101.25, 82.0, 105.0, 70.5, 125.12, 82.0]
+    assert isinstance(element.word_offsets[0], int)
+    assert isinstance(element.x0, float)
+
+
+def test_bytes_round_trip():
+    for document in (ParsedDocument.from_parsed_pages(_pages()), _coalesced_document()):
+        restored = ParsedDocument.from_bytes(document.to_bytes())
+        assert restored.to_parsed_pages() == document.to_parsed_pages()
+
+    with pytest.raises(Exception):
+        ParsedDocument.from_bytes(b"not an archive")
+
+
+def test_concatenate_shifts_page_and_word_indices():
+    document = _coalesced_document()
+    joined = ParsedDocument.concatenate([document, document])
+    assert joined.num_pages == 4
+    assert joined.page_indices.tolist() == [0, 1, 2, 3]
+    assert joined.word_starts.tolist() == [0, 2, 3, 5, 6]
+    assert [page.elements[0].text for page in joined.to_parsed_pages()] == ["alpha beta", "gamma"] * 2
+    assert joined.elements(2, 3)[0].word_offsets == [0, 6]
+
+    with pytest.raises(ValueError):
+        ParsedDocument.concatenate([document, ParsedDocument.from_parsed_pages(_pages())])
+    assert np.array_equal(ParsedDocument.concatenate([]).page_numbers, [])
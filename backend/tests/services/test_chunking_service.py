@@ -0,0 +1,97 @@
+import random
+import uuid
+
+import numpy as np
+import pytest
+
+from app.schemas.chunk import ParsedPage, ParsedTextElement
+from app.services import chunking_service
+from app.services import tokenizer_service
+
+
+def _reference_plan(page_numbers, own, joined, min_tokens, max_tokens, overlap, is_final=True):
+    """Element-by-element planner with the semantics plan_chunk_boundaries vectorises."""
+    total = len(own)
+    planned = []
+    start = 0
+    while start < total:
+        end, token_count = start + 1, own[start]
+        while end < total and page_numbers[end] == page_numbers[start] and token_count + joined[end] <= max_tokens:
+            token_count += joined[end]
+            end += 1
+        next_start = end
+        if overlap > 0 and end - start > 1:
+            overlap_count, first = 0, start
+            for i in range(end - 1, start - 1, -1):
+                overlap_count += own[i]
+                if overlap_count > overlap:
+                    first = i + 1
+                    break
+            next_start = end - max(1, end - first)
+        if token_count < min_tokens and (end < total or not is_final):
+            start = end
+            continue
+        planned.append((start, end, token_count))
+        start = max(next_start, start + 1)
+    return planned
+
+
+def _plan(page_numbers, own, joined, *args, **kwargs):
+    texts = ["word"] * len(own) # No trailing whitespace: every window is token-additive
+    return chunking_service.plan_chunk_boundaries(
+        texts, np.asarray(page_numbers), np.asarray(own), np.asarray(joined), *args, **kwargs
+    )
+
+
+def test_plan_matches_reference_planner():
+    rng = random.Random(3)
+    for _ in range(300):
+        total = rng.randint(1, 80)
+        page_numbers = sorted(rng.randint(1, 4) for _ in range(total))
+        own = [rng.randint(1, 12) for _ in range(total)]
+        joined = [count + rng.randint(0, 1) for count in own]
+        settings = (rng.randint(0, 15), rng.randint(1, 40), rng.choice([0, 1, 3, 10, 50]))
+        is_final = rng.random() < 0.8
+        assert _plan(page_numbers, own, joined, *settings, is_final=is_final) == \
+            _reference_plan(page_numbers, own, joined, *settings, is_final=is_final)
+
+
+def test_chunks_stay_on_their_page_and_under_the_limit():
+    page_numbers = [1] * 5 + [2] * 5
+    plan = _plan(page_numbers, [3] * 10, [4] * 10, 0, 10, 0)
+    assert plan == [(0, 2, 7), (2, 4, 7), (4, 5, 3), (5, 7, 7), (7, 9, 7), (9, 10, 3)]
+
+
+def test_overlap_and_oversized_elements():
+    # Trailing elements of up to 4 own tokens are repeated at the start of the next chunk
+    assert _plan([1] * 6, [2] * 6, [2] * 6, 0, 6, 4) == [(0, 3, 6), (1, 4, 6), (2, 5, 6), (3, 6, 6), (4, 6, 4), (5, 6, 2)]
+    # An element larger than the limit becomes a chunk of its own
+    assert _plan([1] * 3, [2, 50, 2], [3, 51, 3], 0, 10, 0) == [(0, 1, 2), (1, 2, 50), (2, 3, 2)]
+
+
+def test_short_chunks_are_skipped_except_at_the_end():
+    page_numbers = [1, 1, 2]
+    assert _plan(page_numbers, [5, 5, 1], [5, 5, 1], 3, 100, 0) == [(0, 2, 10), (2, 3, 1)]
+    # A streaming part that does not end the document drops its short trailing chunk
+    assert _plan(page_numbers, [5, 5, 1], [5, 5, 1], 3, 100, 0, is_final=False) == [(0, 2, 10)]
+    assert _plan([], [], [], 0, 10, 0) == []
+
+
+def test_chunk_token_counts_match_the_tokenizer(tiktoken_encoding):
+    words = ["The", "quick", "brown fox ", "jumps", " over", "the\n", "lazy", "dog.", "", "naïve", "it's"]
+    pages = [
+        ParsedPage(page_number=page_number, width=100, height=200, elements=[
+            ParsedTextElement(text=text, x0=0, y0=0, x1=1, y1=1, page_number=page_number, page_width=100, page_height=200)
+            for text in words
+        ])
+        for page_number in (1, 2)
+    ]
+    chunks = chunking_service.chunk_parsed_pages(
+        pages, uuid.uuid4(), uuid.uuid4(), uuid.uuid4(),
+        min_tokens_per_chunk=0, max_tokens_per_chunk=6, token_overlap=2
+    )
+    assert chunks
+    for chunk in chunks:
+        assert chunk.token_count == tokenizer_service.count_tokens(chunk.chunk_text)
+        assert chunk.token_count <= 6 or len(chunk.constituent_elements) == 1 # Oversized elements stand alone
+        assert {element.page_number for element in chunk.constituent_elements} == {chunk.page_number}
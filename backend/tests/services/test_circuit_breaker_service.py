@@ -0,0 +1,96 @@
+import types
+
+import openai
+import pytest
+import redis
+
+from app.core.config import settings
+from app.services import circuit_breaker_service
+
+NAME = circuit_breaker_service.OPENAI_CIRCUIT
+
+
+@pytest.fixture
+def breaker(monkeypatch, fake_redis):
+    monkeypatch.setattr(settings, "CIRCUIT_BREAKER_FAILURE_THRESHOLD", 3)
+    monkeypatch.setattr(settings, "CIRCUIT_BREAKER_WINDOW_SECONDS", 60)
+    monkeypatch.setattr(settings, "CIRCUIT_BREAKER_OPEN_SECONDS", 30)
+    return fake_redis
+
+
+def _status_error(status_code):
+    response = types.SimpleNamespace(status_code=status_code, request=None, headers={})
+    return openai.APIStatusError("error", response=response, body=None)
+
+
+def test_threshold_failures_open_the_breaker(breaker):
+    assert not circuit_breaker_service.record_failure()
+    assert not circuit_breaker_service.record_failure()
+    circuit_breaker_service.check()
+    assert circuit_breaker_service.record_failure()
+
+    with pytest.raises(circuit_breaker_service.CircuitOpenError) as error:
+        circuit_breaker_service.check()
+    assert error.value.name == NAME
+    assert 29 < error.value.retry_after <= 30
+
+
+def test_failure_counter_always_expires(breaker):
+    failures_key = circuit_breaker_service._key(NAME, "failures")
+    circuit_breaker_service.record_failure()
+    assert 0 < breaker.ttl(failures_key) <= 60
+
+    breaker.set(failures_key, 1) # Left without a TTL, e.g. by a worker that died after INCR
+    assert not circuit_breaker_service.record_failure()
+    assert 0 < breaker.ttl(failures_key) <= 60
+
+
+def test_half_open_breaker_reopens_on_one_failure(breaker):
+    for _ in range(3):
+        circuit_breaker_service.record_failure()
+    breaker.delete(circuit_breaker_service._key(NAME, "open")) # The open period has ended
+    circuit_breaker_service.check()
+
+    assert circuit_breaker_service.record_failure()
+    with pytest.raises(circuit_breaker_service.CircuitOpenError):
+        circuit_breaker_service.check()
+
+
+def test_success_closes_the_breaker_fully(breaker):
+    for _ in range(3):
+        circuit_breaker_service.record_failure()
+    breaker.delete(circuit_breaker_service._key(NAME, "open"))
+    circuit_breaker_service.record_success()
+
+    assert not circuit_breaker_service.record_failure()
+    assert not circuit_breaker_service.record_failure()
+    circuit_breaker_service.check()
+
+
+def test_breakers_are_independent(breaker):
+    for _ in range(3):
+        circuit_breaker_service.record_failure("other")
+    circuit_breaker_service.check()
+    with pytest.raises(circuit_breaker_service.CircuitOpenError):
+        circuit_breaker_service.check("other")
+
+
+def test_only_outages_count_as_failures():
+    assert circuit_breaker_service.is_breaker_failure(openai.APIConnectionError(request=None))
+    assert circuit_breaker_service.is_breaker_failure(openai.APITimeoutError(request=None))
+    assert circuit_breaker_service.is_breaker_failure(_status_error(503))
+    assert not circuit_breaker_service.is_breaker_failure(_status_error(400))
+    assert not circuit_breaker_service.is_breaker_failure(_status_error(429))
+    assert not circuit_breaker_service.is_breaker_failure(ValueError("bad input"))
+
+
+def test_breaker_stays_closed_when_redis_is_down(monkeypatch):
+    class UnavailableRedis:
+        def __getattr__(self, name):
+            def fail(*args, **kwargs):
+                raise redis.ConnectionError("connection refused")
+            return fail
+    monkeypatch.setattr(circuit_breaker_service, "get_redis_client", lambda: UnavailableRedis())
+    circuit_breaker_service.check()
+    assert not circuit_breaker_service.record_failure()
+    circuit_breaker_service.record_success()
@@ -0,0 +1,60 @@
+import sys
+import types
+
+import numpy as np
+import pytest
+
+from app.core.config import settings
+from app.services import embedding_backend_service
+
+
+class FakeSentenceTransformer:
+    dimensions = 384
+
+    def __init__(self, model_name, **kwargs):
+        self.model_name = model_name
+
+    def get_sentence_embedding_dimension(self):
+        return self.dimensions
+
+    def encode(self, texts, **kwargs):
+        return np.ones((len(texts), self.dimensions), dtype=np.float64)
+
+
+@pytest.fixture(autouse=True)
+def fake_sentence_transformers(monkeypatch):
+    monkeypatch.setitem(sys.modules, "sentence_transformers", types.SimpleNamespace(SentenceTransformer=FakeSentenceTransformer))
+    monkeypatch.setitem(sys.modules, "torch", types.SimpleNamespace(set_num_threads=lambda threads: None))
+    monkeypatch.setattr(settings, "EMBEDDING_COLUMN_DIMENSIONS", None)
+    monkeypatch.setattr(settings, "OPENAI_EMBEDDING_DIMENSIONS", None)
+
+
+def test_local_model_must_match_column_dimensions():
+    # Default profile: text-embedding-3-small, vector(1536)
+    with pytest.raises(ValueError, match="outputs 384 dimensions, but the embedding column is vector\\(1536\\)"):
+        embedding_backend_service.LocalEmbeddingBackend("all-MiniLM-L6-v2", "torch")
+
+
+def test_local_model_matching_column_dimensions_loads(monkeypatch):
+    monkeypatch.setattr(settings, "EMBEDDING_COLUMN_DIMENSIONS", 384)
+    backend = embedding_backend_service.LocalEmbeddingBackend("all-MiniLM-L6-v2", "torch")
+    embeddings = backend.embed(["a", "b"], [1, 1])
+    assert len(embeddings) == 2
+    assert embeddings[0].dtype == np.float32 and embeddings[0].shape == (384,)
+    assert backend.cache_model == "local:all-MiniLM-L6-v2"
+
+
+def test_backend_interface_is_abstract():
+    class Incomplete(embedding_backend_service.EmbeddingBackend):
+        @property
+        def cache_model(self):
+            return "model"
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_resolve_backend_rejects_unknown(monkeypatch):
+    monkeypatch.setattr(settings, "EMBEDDING_BACKEND", "gpu")
+    with pytest.raises(ValueError):
+        embedding_backend_service.resolve_backend()
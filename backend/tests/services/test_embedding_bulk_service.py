@@ -0,0 +1,55 @@
+import numpy as np
+
+from app.core.config import settings
+from app.services import embedding_batching_service
+from app.services import embedding_bulk_service
+
+
+def _run_batches(server, writer):
+    results = {}
+    for batch_file in writer.files:
+        batch_id = embedding_bulk_service.submit_batch(batch_file["path"], metadata={"task_identifier": "t"})
+        while (batch := embedding_bulk_service.get_batch(batch_id)).status not in embedding_bulk_service.TERMINAL_STATUSES:
+            pass
+        for custom_id, embeddings, _ in embedding_bulk_service.iter_batch_results(batch):
+            request = batch_file["requests"][custom_id]
+            vectors = None if embeddings is None else embedding_bulk_service.embeddings_for_request(request, embeddings)
+            for index, chunk_id in enumerate(request["chunk_ids"]):
+                results[chunk_id] = None if vectors is None else vectors[index]
+    return results
+
+
+def test_batch_round_trip_through_stand_in_server(tmp_path, monkeypatch, openai_batch_server):
+    monkeypatch.setattr(settings, "EMBEDDING_BULK_MAX_INPUTS_PER_BATCH", 5)
+    monkeypatch.setattr(settings, "OPENAI_EMBEDDING_BATCH_SIZE", 3)
+    texts = {f"chunk-{i}": "x" * i for i in range(1, 13)}
+    texts["chunk-7"] = "bad"
+
+    writer = embedding_bulk_service.BatchFileWriter(str(tmp_path), "text-embedding-3-small")
+    writer.add_chunks(list(texts), list(texts.values()), [1] * len(texts))
+    writer.close()
+    assert len(writer.files) == 4 # Requests of 3 inputs, rolled over at 5 inputs per file
+    assert all(batch_file["inputs"] <= 5 for batch_file in writer.files)
+
+    results = _run_batches(openai_batch_server, writer)
+    assert set(results) == set(texts)
+    # The failed request's chunks get no embeddings; the others are back in input order
+    failed = [chunk_id for chunk_id, vector in results.items() if vector is None]
+    assert "chunk-7" in failed and len(failed) == 3
+    assert results["chunk-5"].dtype == np.float32
+    assert results["chunk-5"].tolist() == [5.0, 1.0, 0.0]
+
+
+def test_oversized_chunk_is_split_and_recombined(tmp_path, openai_batch_server, tiktoken_encoding):
+    limit = embedding_batching_service.OPENAI_EMBEDDING_MAX_INPUT_TOKENS
+    text = "word " * (limit + 500)
+    writer = embedding_bulk_service.BatchFileWriter(str(tmp_path), "text-embedding-3-small")
+    writer.add_chunks(["long"], [text], [limit + 500])
+    writer.close()
+    (request,) = writer.files[0]["requests"].values()
+    assert len(request["piece_tokens"]) > 1
+
+    results = _run_batches(openai_batch_server, writer)
+    vector = results["long"]
+    assert vector.shape == (3,)
+    assert np.isclose(np.linalg.norm(vector), 1.0) # Pieces are combined by token-weighted average, re-normalised
@@ -0,0 +1,47 @@
+import time
+
+import numpy as np
+import pytest
+
+from app.core.config import settings
+from app.services import embedding_microbatch_service
+
+MODEL = "text-embedding-3-small"
+LOCK_KEY = embedding_microbatch_service._key("lock", MODEL)
+
+
+@pytest.fixture(autouse=True)
+def microbatching(monkeypatch, fake_redis):
+    monkeypatch.setattr(settings, "EMBEDDING_MICROBATCH_ENABLED", True)
+    monkeypatch.setattr(settings, "EMBEDDING_MICROBATCH_HIGH_PRIORITY_MAX_WAIT_MS", 1)
+    monkeypatch.setattr(embedding_microbatch_service, "_scripts", {})
+    return fake_redis
+
+
+def _vectors(texts):
+    return [np.ones(2, dtype=np.float32) for _ in texts]
+
+
+def test_lock_is_renewed_during_a_long_flush(monkeypatch, microbatching):
+    monkeypatch.setattr(embedding_microbatch_service, "FLUSH_LOCK_TTL_MS", 200)
+    monkeypatch.setattr(embedding_microbatch_service, "FLUSH_LOCK_RENEW_SECONDS", 0.05)
+    owners = []
+
+    def slow_embed(texts, token_counts):
+        time.sleep(0.5) # Longer than the lock TTL
+        owners.append(microbatching.get(LOCK_KEY))
+        return _vectors(texts)
+
+    embeddings = embedding_microbatch_service.embed(["a"], [1], MODEL, slow_embed)
+    assert len(embeddings) == 1
+    assert owners[0] is not None # Still held when the flush finished
+    assert microbatching.get(LOCK_KEY) is None # Released afterwards
+
+
+def test_flush_does_not_release_a_lock_it_no_longer_owns(microbatching):
+    def embed_after_lock_expired(texts, token_counts):
+        microbatching.set(LOCK_KEY, "other-flusher") # Our lock expired and someone else took it
+        return _vectors(texts)
+
+    embedding_microbatch_service.embed(["a"], [1], MODEL, embed_after_lock_expired)
+    assert microbatching.get(LOCK_KEY) == b"other-flusher"
@@ -0,0 +1,140 @@
+import base64
+import types
+import uuid
+
+import numpy as np
+import openai
+import pytest
+
+pytest.importorskip("supabase") # Via embedding_cache_service's shared tier
+
+from app.core.config import settings
+from app.schemas.chunk import ChunkCreate
+from app.services import circuit_breaker_service
+from app.services import embedding_cache_service
+from app.services import embedding_microbatch_service
+from app.services import embedding_service
+from app.services import openai_client_service
+from app.services import openai_rate_limit_service
+from app.services import request_hedging_service
+from app.services import task_checkpoint_service
+
+MODEL = "text-embedding-3-small"
+
+
+def _chunks(texts):
+    ids = dict(reference_id=uuid.uuid4(), user_id=uuid.uuid4(), chatbot_id=uuid.uuid4())
+    return [ChunkCreate(**ids, page_number=1, chunk_text=text, token_count=len(text), constituent_elements=[]) for text in texts]
+
+
+def _vector(text):
+    return np.array([len(text), 1.0], dtype=np.float32)
+
+
+@pytest.fixture
+def checkpoints(monkeypatch):
+    saved = {}
+    monkeypatch.setattr(openai, "api_key", "test-key")
+    monkeypatch.setattr(settings, "EMBEDDING_BACKEND", "openai")
+    monkeypatch.setattr(settings, "EMBEDDING_CACHE_ENABLED", False)
+    monkeypatch.setattr(task_checkpoint_service, "save_embeddings", lambda task_id, embeddings: saved.setdefault(task_id, {}).update(embeddings))
+    monkeypatch.setattr(task_checkpoint_service, "load_embeddings", lambda task_id, keys: {key: saved[task_id][key] for key in keys if key in saved.get(task_id, {})})
+    return saved
+
+
+def _key(text):
+    return embedding_cache_service.make_cache_key(MODEL, text, None)
+
+
+def test_coalesced_flush_checkpoints_only_the_callers_own_texts(monkeypatch, checkpoints):
+    sent = []
+
+    def fake_embed_texts(texts, token_counts, model):
+        sent.append(list(texts))
+        return [_vector(text) for text in texts]
+
+    def coalescing_embed(texts, token_counts, model, embed_function, priority=None):
+        # This caller flushes the queue, which also holds another task's call
+        other = ["other task text"]
+        embeddings = embed_function(list(texts) + other, list(token_counts) + [3])
+        return embeddings[:len(texts)]
+
+    monkeypatch.setattr(embedding_service, "_embed_texts", fake_embed_texts)
+    monkeypatch.setattr(embedding_microbatch_service, "embed", coalescing_embed)
+
+    task_id = uuid.uuid4()
+    results = embedding_service.generate_embeddings_for_chunks(_chunks(["alpha", "beta"]), task_id=task_id)
+    assert [row.tolist() for _, row in results] == [[5.0, 1.0], [4.0, 1.0]]
+    assert sent == [["alpha", "beta", "other task text"]]
+    assert set(checkpoints) == {task_id}
+    assert set(checkpoints[task_id]) == {_key("alpha"), _key("beta")}
+
+
+def test_retry_only_embeds_chunks_missing_from_checkpoint(monkeypatch, checkpoints):
+    calls = []
+
+    def fake_embed_texts(texts, token_counts, model):
+        calls.append(list(texts))
+        if "fails" in texts:
+            return [None if text == "fails" else _vector(text) for text in texts]
+        return [_vector(text) for text in texts]
+
+    monkeypatch.setattr(embedding_service, "_embed_texts", fake_embed_texts)
+    # One slice per chunk, so each is checkpointed before the next is sent
+    monkeypatch.setattr(settings, "OPENAI_EMBEDDING_MAX_TOKENS_PER_REQUEST", 3)
+    monkeypatch.setattr(settings, "OPENAI_EMBEDDING_CONCURRENCY", 1)
+
+    task_id = uuid.uuid4()
+    chunks = _chunks(["one", "two", "fails"])
+    assert len(embedding_service.generate_embeddings_for_chunks(chunks, task_id=task_id)) == 2
+    assert calls == [["one"], ["two"], ["fails"]]
+    assert set(checkpoints[task_id]) == {_key("one"), _key("two")}
+
+    calls.clear()
+    results = embedding_service.generate_embeddings_for_chunks(chunks, task_id=task_id)
+    assert calls == [["fails"]]
+    assert len(results) == 2
+
+
+def test_token_slices():
+    assert embedding_service._token_slices([2, 2, 2, 5, 1], 4) == [(0, 2), (2, 3), (3, 4), (4, 5)]
+    assert embedding_service._token_slices([], 4) == []
+
+
+def test_embed_batch_is_the_only_retry_layer(monkeypatch):
+    attempts = []
+    failures = []
+
+    class FakeEmbeddings:
+        async def create(self, input, model, encoding_format, **options):
+            attempts.append(list(input))
+            if len(attempts) < 3:
+                raise openai.APIConnectionError(request=None)
+            encoded = base64.b64encode(np.array([1.0, 2.0], dtype=np.float32).tobytes()).decode()
+            return types.SimpleNamespace(data=[types.SimpleNamespace(embedding=encoded) for _ in input])
+
+    async def no_wait(model, tokens=0):
+        return 0.0
+
+    async def unhedged(key, request, tokens, make_hedge=None):
+        return await request()
+
+    monkeypatch.setattr(openai_client_service, "get_async_client", lambda: types.SimpleNamespace(embeddings=FakeEmbeddings()))
+    monkeypatch.setattr(openai_rate_limit_service, "acquire_async", no_wait)
+    monkeypatch.setattr(request_hedging_service, "run_hedged", unhedged)
+    monkeypatch.setattr(circuit_breaker_service, "check", lambda name=None: None)
+    monkeypatch.setattr(circuit_breaker_service, "record_success", lambda name=None: None)
+    monkeypatch.setattr(circuit_breaker_service, "record_failure", lambda name=None: failures.append(name) or False)
+    monkeypatch.setattr(embedding_service, "OPENAI_RETRY_DELAY_SECONDS", 0)
+
+    embeddings = openai_client_service.run_async(embedding_service._embed_batch(0, ["a", "b"], MODEL, 2))
+    assert embeddings.tolist() == [[1.0, 2.0], [1.0, 2.0]]
+    # Every attempt is visible to the circuit breaker; none is retried inside the SDK
+    assert len(attempts) == embedding_service.OPENAI_MAX_RETRIES
+    assert len(failures) == 2
+
+
+def test_shared_client_does_not_retry(monkeypatch):
+    monkeypatch.setattr(settings, "OPENAI_API_KEY", "test-key")
+    monkeypatch.setattr(openai_client_service, "_client", None)
+    assert openai_client_service.get_async_client().max_retries == 0
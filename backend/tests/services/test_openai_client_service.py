@@ -0,0 +1,37 @@
+import asyncio
+
+import pytest
+
+from app.services import openai_client_service
+
+
+def test_map_bounded_cancels_siblings_when_one_fails():
+    cancelled, finished = [], []
+
+    async def embed(index, item):
+        if index == 0:
+            await asyncio.sleep(0)
+            raise RuntimeError("circuit open")
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.append(index)
+            raise
+        finished.append(index)
+
+    async def run():
+        with pytest.raises(RuntimeError, match="circuit open"):
+            await openai_client_service.map_bounded(embed, range(4), 2)
+        # Nothing from the failed batch is left running on the loop
+        assert [task for task in asyncio.all_tasks() if task is not asyncio.current_task()] == []
+
+    asyncio.run(run())
+    assert cancelled and finished == []
+
+
+def test_map_bounded_keeps_input_order():
+    async def double(index, item):
+        await asyncio.sleep(0.01 * (3 - index))
+        return item * 2
+
+    assert asyncio.run(openai_client_service.map_bounded(double, [1, 2, 3], 3)) == [2, 4, 6]
@@ -0,0 +1,64 @@
+import pytest
+import redis
+
+from app.core.config import settings
+from app.services import openai_rate_limit_service
+
+MODEL = "text-embedding-3-small"
+
+
+@pytest.fixture
+def governed(monkeypatch, fake_redis):
+    # 60 requests and 600 tokens per minute at full utilization: 1 request and 10 tokens per second,
+    # with buckets of 2 requests and 20 tokens
+    monkeypatch.setattr(settings, "OPENAI_RATE_LIMITS", {MODEL: {"rpm": 60, "tpm": 600}})
+    monkeypatch.setattr(settings, "OPENAI_RATE_LIMIT_UTILIZATION", 1.0)
+    monkeypatch.setattr(settings, "OPENAI_RATE_LIMIT_BURST_SECONDS", 2.0)
+    return fake_redis
+
+
+def test_ungoverned_models_are_not_limited(monkeypatch):
+    monkeypatch.setattr(settings, "OPENAI_RATE_LIMITS", {})
+    assert not openai_rate_limit_service.is_governed(MODEL)
+    assert openai_rate_limit_service.try_acquire(MODEL, 10 ** 9) == 0.0
+
+
+def test_request_bucket_holds_a_burst(governed):
+    assert openai_rate_limit_service.try_acquire(MODEL, 1) == 0.0
+    assert openai_rate_limit_service.try_acquire(MODEL, 1) == 0.0
+    assert openai_rate_limit_service.try_acquire(MODEL, 1) == pytest.approx(1.0, abs=0.1)
+
+
+def test_token_bucket_waits_for_the_missing_tokens(governed):
+    assert openai_rate_limit_service.try_acquire(MODEL, 15) == 0.0
+    assert openai_rate_limit_service.try_acquire(MODEL, 10) == pytest.approx(0.5, abs=0.1)
+
+
+def test_oversized_request_passes_a_full_bucket_and_leaves_debt(governed):
+    assert openai_rate_limit_service.try_acquire(MODEL, 100) == 0.0
+    # 80 tokens in debt: the next 1-token request waits for 81 tokens at 10 per second
+    assert openai_rate_limit_service.try_acquire(MODEL, 1) == pytest.approx(8.1, abs=0.1)
+
+
+def test_rate_limit_response_drains_the_buckets(governed):
+    openai_rate_limit_service.report_rate_limited(MODEL)
+    assert openai_rate_limit_service.try_acquire(MODEL, 0) == pytest.approx(1.0, abs=0.1)
+
+
+def test_permits_are_granted_when_redis_is_down(monkeypatch):
+    monkeypatch.setattr(settings, "OPENAI_RATE_LIMITS", {MODEL: {"rpm": 60, "tpm": 600}})
+
+    def unavailable(*args, **kwargs):
+        raise redis.ConnectionError("connection refused")
+    monkeypatch.setattr(openai_rate_limit_service, "_run_script", unavailable)
+    assert openai_rate_limit_service.try_acquire(MODEL, 10) == 0.0
+    openai_rate_limit_service.report_rate_limited(MODEL) # Logged, not raised
+
+
+def test_acquire_sleeps_until_granted(monkeypatch):
+    waits = [0.25, 0.5, 0.0]
+    slept = []
+    monkeypatch.setattr(openai_rate_limit_service, "try_acquire", lambda model, tokens=0: waits.pop(0))
+    monkeypatch.setattr(openai_rate_limit_service.time, "sleep", slept.append)
+    assert openai_rate_limit_service.acquire(MODEL, 5) == 0.75
+    assert slept == [0.25, 0.5]
@@ -0,0 +1,122 @@
+import os
+
+import fitz
+import pytest
+
+pytest.importorskip("supabase")
+
+from app.core.config import settings
+from app.schemas.parsed_document import ParsedDocument
+from app.services import parse_cache_service, pdf_parsing_service
+
+
+@pytest.fixture
+def pdf_path(tmp_path):
+    path = tmp_path / "sample.pdf"
+    with fitz.open() as pdf:
+        for page_number in range(5):
+            page = pdf.new_page()
+            page.insert_text((72, 72), f"page {page_number} alpha beta")
+        pdf.save(str(path))
+    return str(path)
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    directory = tmp_path / "parse_cache"
+    monkeypatch.setattr(settings, "PARSE_CACHE_ENABLED", True)
+    monkeypatch.setattr(settings, "PARSE_CACHE_DIR", str(directory))
+    monkeypatch.setattr(settings, "PARSE_CACHE_MAX_BYTES", 1024 * 1024 * 1024)
+    monkeypatch.setattr(settings, "PARSE_CACHE_BUCKET", None)
+    monkeypatch.setattr(parse_cache_service, "FRAME_TARGET_BYTES", 1) # One frame per parsed part
+    return directory
+
+
+def _page_texts(parts):
+    document = ParsedDocument.concatenate(list(parts))
+    return [" ".join(element.text for element in page.elements) for page in document.to_parsed_pages()]
+
+
+def _entries(directory, suffix):
+    return sorted(name for name in os.listdir(directory) if name.endswith(suffix)) if directory.exists() else []
+
+
+def _count_parses(monkeypatch):
+    calls = []
+    parse_pdf_iter = pdf_parsing_service.parse_pdf_iter
+
+    def counting_parse(*args, **kwargs):
+        calls.append(args)
+        return parse_pdf_iter(*args, **kwargs)
+    monkeypatch.setattr(pdf_parsing_service, "parse_pdf_iter", counting_parse)
+    return calls
+
+
+def test_miss_writes_entry_while_streaming(pdf_path, cache_dir):
+    parts = parse_cache_service.parse_pdf_iter_cached(pdf_path, "pymupdf")
+    next(parts)
+    next(parts)
+    # Parts already yielded are on disk in the temporary file; the entry is not visible yet
+    temp_files = _entries(cache_dir, ".tmp")
+    assert len(temp_files) == 1
+    assert os.path.getsize(cache_dir / temp_files[0]) > len(parse_cache_service.ENTRY_MAGIC)
+    assert _entries(cache_dir, parse_cache_service.CACHE_FILE_SUFFIX) == []
+
+    list(parts)
+    assert _entries(cache_dir, ".tmp") == []
+    assert len(_entries(cache_dir, parse_cache_service.CACHE_FILE_SUFFIX)) == 1
+
+
+def test_hit_streams_cached_frames(pdf_path, monkeypatch):
+    expected = _page_texts(parse_cache_service.parse_pdf_iter_cached(pdf_path, "pymupdf"))
+    calls = _count_parses(monkeypatch)
+
+    cached_parts = list(parse_cache_service.parse_pdf_iter_cached(pdf_path, "pymupdf"))
+    assert calls == []
+    assert len(cached_parts) == 5
+    assert _page_texts(cached_parts) == expected
+    assert expected[0] == "page 0 alpha beta"
+
+
+def test_failed_bucket_mirror_keeps_local_entry(pdf_path, cache_dir, monkeypatch, caplog):
+    def failing_upload(key, path):
+        raise ConnectionError("storage unavailable")
+    monkeypatch.setattr(settings, "PARSE_CACHE_BUCKET", "parse-cache")
+    monkeypatch.setattr(parse_cache_service, "_download_bucket", lambda key: False)
+    monkeypatch.setattr(parse_cache_service, "_upload_bucket", failing_upload)
+
+    list(parse_cache_service.parse_pdf_iter_cached(pdf_path, "pymupdf"))
+    assert len(_entries(cache_dir, parse_cache_service.CACHE_FILE_SUFFIX)) == 1
+    assert "locally, but could not mirror it to bucket 'parse-cache'" in caplog.text
+
+
+def test_abandoned_parse_leaves_no_entry(pdf_path, cache_dir):
+    parts = parse_cache_service.parse_pdf_iter_cached(pdf_path, "pymupdf")
+    next(parts)
+    parts.close()
+    assert _entries(cache_dir, ".tmp") == []
+    assert _entries(cache_dir, parse_cache_service.CACHE_FILE_SUFFIX) == []
+
+
+def test_corrupt_entry_is_discarded_and_reparsed(pdf_path, cache_dir, monkeypatch):
+    expected = _page_texts(parse_cache_service.parse_pdf_iter_cached(pdf_path, "pymupdf"))
+    entry_path = cache_dir / _entries(cache_dir, parse_cache_service.CACHE_FILE_SUFFIX)[0]
+    data = bytearray(entry_path.read_bytes())
+    data[-10] ^= 0xFF
+    entry_path.write_bytes(bytes(data))
+    calls = _count_parses(monkeypatch)
+
+    assert _page_texts(parse_cache_service.parse_pdf_iter_cached(pdf_path, "pymupdf")) == expected
+    assert len(calls) == 1
+    assert parse_cache_service._read_frame_index(str(entry_path)) # Rewritten by the re-parse
+
+
+def test_eviction_ages_out_legacy_entries(pdf_path, cache_dir, monkeypatch):
+    cache_dir.mkdir()
+    legacy_path = cache_dir / ("0" * 64 + "-pymupdf-1.npz")
+    legacy_path.write_bytes(b"x" * 1000)
+    os.utime(legacy_path, (0, 0))
+    monkeypatch.setattr(settings, "PARSE_CACHE_MAX_BYTES", 1)
+
+    list(parse_cache_service.parse_pdf_iter_cached(pdf_path, "pymupdf"))
+    assert not legacy_path.exists()
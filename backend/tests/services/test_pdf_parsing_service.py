@@ -0,0 +1,82 @@
+import multiprocessing
+
+import fitz
+import pytest
+
+from app.core.config import settings
+from app.services import pdf_parsing_service
+
+
+@pytest.fixture
+def pdf_path(tmp_path):
+    path = tmp_path / "sample.pdf"
+    with fitz.open() as pdf:
+        for page_number in range(12):
+            page = pdf.new_page()
+            page.insert_text((72, 72), f"page {page_number} alpha beta")
+        pdf.save(str(path))
+    return str(path)
+
+
+@pytest.fixture(autouse=True)
+def small_page_ranges(monkeypatch):
+    monkeypatch.setattr(settings, "PDF_PARSE_MIN_PAGES_PER_PROCESS", 1)
+
+
+def _page_texts(parts):
+    document = pdf_parsing_service.ParsedDocument.concatenate(list(parts))
+    return [" ".join(element.text for element in page.elements) for page in document.to_parsed_pages()]
+
+
+def _parse_in_child(path, queue):
+    try:
+        parts = list(pdf_parsing_service.parse_pdf_iter(path, "pymupdf", processes=2))
+        queue.put(("ok", (len(parts), _page_texts(parts))))
+    except BaseException as e:
+        queue.put(("error", repr(e)))
+
+
+def test_parallel_parse_matches_serial(pdf_path):
+    serial = _page_texts(pdf_parsing_service.parse_pdf_iter(pdf_path, "pymupdf", processes=1))
+    parallel = _page_texts(pdf_parsing_service.parse_pdf_iter(pdf_path, "pymupdf", processes=3))
+    assert parallel == serial
+    assert serial[0] == "page 0 alpha beta"
+    assert len(serial) == 12
+
+
+def test_parallel_parse_inside_daemonic_process(pdf_path):
+    # Celery's prefork pool runs tasks in daemonic processes; billiard may still start processes there
+    pytest.importorskip("billiard")
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+    child = context.Process(target=_parse_in_child, args=(pdf_path, queue), daemon=True)
+    child.start()
+    status, result = queue.get(timeout=60)
+    child.join(timeout=60)
+    assert status == "ok", result
+    part_count, texts = result
+    assert part_count == 8 # One part per page range (2 processes x 4 ranges), not one per page
+    assert texts == _page_texts(pdf_parsing_service.parse_pdf_iter(pdf_path, "pymupdf"))
+
+
+def test_parsing_processes_are_spawned():
+    assert pdf_parsing_service._get_process_context().get_start_method() == "spawn"
+
+
+def test_unstartable_processes_fall_back_to_serial(pdf_path, monkeypatch):
+    class NoChildren:
+        Pipe = staticmethod(multiprocessing.Pipe)
+
+        def Process(self, **kwargs):
+            raise AssertionError("daemonic processes are not allowed to have children")
+    monkeypatch.setattr(pdf_parsing_service, "_get_process_context", lambda: NoChildren())
+    parts = list(pdf_parsing_service.parse_pdf_iter(pdf_path, "pymupdf", processes=2))
+    assert len(parts) == 12
+    assert _page_texts(parts)[0] == "page 0 alpha beta"
+
+
+def test_stopping_early_stops_parsing_processes(pdf_path):
+    parts = pdf_parsing_service.parse_pdf_iter(pdf_path, "pymupdf", processes=2)
+    next(parts)
+    parts.close()
+    assert not pdf_parsing_service._get_process_context().active_children()
@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+
+from app.core.config import settings
+from app.services import request_hedging_service
+
+KEY = "text-embedding-3-small"
+
+
+@pytest.fixture(autouse=True)
+def hedging(monkeypatch):
+    monkeypatch.setattr(settings, "OPENAI_EMBEDDING_HEDGING_ENABLED", True)
+    monkeypatch.setattr(settings, "OPENAI_EMBEDDING_HEDGE_PERCENTILE", 95.0)
+    monkeypatch.setattr(settings, "OPENAI_EMBEDDING_HEDGE_MIN_SAMPLES", 3)
+    monkeypatch.setattr(settings, "OPENAI_EMBEDDING_HEDGE_MIN_DELAY_SECONDS", 0.05)
+    monkeypatch.setattr(settings, "OPENAI_EMBEDDING_HEDGE_MAX_EXTRA_FRACTION", 1.0)
+    monkeypatch.setattr(request_hedging_service, "_latencies", {})
+    request_hedging_service.reset_hedge_stats()
+    yield
+    request_hedging_service.reset_hedge_stats()
+
+
+def _warm_up():
+    for _ in range(3):
+        request_hedging_service._record_latency(KEY, 0.01)
+
+
+class Request:
+    """A request factory that records calls and cancellations."""
+
+    def __init__(self, result, delay, error=None):
+        self.result, self.delay, self.error = result, delay, error
+        self.calls = 0
+        self.cancelled = False
+
+    async def __call__(self):
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def _run(primary, hedge, tokens=100):
+    return asyncio.run(request_hedging_service.run_hedged(KEY, primary, tokens, make_hedge=hedge))
+
+
+def test_deadline_is_the_latency_percentile_with_a_floor():
+    assert request_hedging_service.get_hedge_deadline(KEY) is None
+    for seconds in range(1, 21):
+        request_hedging_service._record_latency(KEY, float(seconds))
+    assert request_hedging_service.get_hedge_deadline(KEY) == pytest.approx(19.05)
+    request_hedging_service._latencies[KEY].clear()
+    _warm_up()
+    assert request_hedging_service.get_hedge_deadline(KEY) == 0.05
+
+
+def test_no_hedge_before_enough_samples():
+    primary, hedge = Request("primary", 0.1), Request("hedge", 0)
+    assert _run(primary, hedge) == "primary"
+    assert hedge.calls == 0
+    assert request_hedging_service.get_hedge_stats()["hedged"] == 0
+
+
+def test_hedge_wins_over_a_slow_primary():
+    _warm_up()
+    primary, hedge = Request("primary", 2.0), Request("hedge", 0.01)
+    assert _run(primary, hedge) == "hedge"
+    assert primary.cancelled
+    stats = request_hedging_service.get_hedge_stats()
+    assert (stats["requests"], stats["hedged"], stats["hedge_wins"]) == (1, 1, 1)
+    assert stats["extra_tokens"] == 100
+
+
+def test_primary_finishing_first_cancels_the_hedge():
+    _warm_up()
+    primary, hedge = Request("primary", 0.1), Request("hedge", 2.0)
+    assert _run(primary, hedge) == "primary"
+    assert hedge.calls == 1 and hedge.cancelled
+    assert request_hedging_service.get_hedge_stats()["hedge_wins"] == 0
+
+
+def test_failed_primary_falls_back_to_the_hedge():
+    _warm_up()
+    primary, hedge = Request(None, 0.1, error=RuntimeError("primary failed")), Request("hedge", 0.2)
+    assert _run(primary, hedge) == "hedge"
+
+
+def test_both_failing_raises_the_primary_error():
+    _warm_up()
+    primary = Request(None, 0.1, error=RuntimeError("primary failed"))
+    hedge = Request(None, 0.05, error=RuntimeError("hedge failed"))
+    with pytest.raises(RuntimeError, match="primary failed"):
+        _run(primary, hedge)
+
+
+def test_spend_cap_skips_hedges(monkeypatch):
+    monkeypatch.setattr(settings, "OPENAI_EMBEDDING_HEDGE_MAX_EXTRA_FRACTION", 0.0)
+    _warm_up()
+    primary, hedge = Request("primary", 0.1), Request("hedge", 0)
+    assert _run(primary, hedge) == "primary"
+    assert hedge.calls == 0
+    assert request_hedging_service.get_hedge_stats()["skipped_over_budget"] == 1
@@ -0,0 +1,95 @@
+import json
+import uuid
+import zlib
+
+import fitz
+import pytest
+
+pytest.importorskip("supabase") # Via parse_cache_service's bucket mirror
+
+from app.core.config import settings
+from app.schemas.chunk import ChunkCreate
+from app.schemas.parsed_document import ParsedDocument
+from app.services import element_coalescing_service, parse_cache_service, task_checkpoint_service
+
+TASK_ID = uuid.uuid4()
+
+
+@pytest.fixture
+def pdf_path(tmp_path):
+    path = tmp_path / "sample.pdf"
+    with fitz.open() as pdf:
+        for page_number in range(3):
+            page = pdf.new_page()
+            # The same line twice per page, so chunks can only be told apart by position
+            for line in range(4):
+                page.insert_text((72, 72 + 20 * line), "alpha beta" if line % 2 else f"page {page_number} line {line}")
+        pdf.save(str(path))
+    return str(path)
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "PARSE_CACHE_ENABLED", True)
+    monkeypatch.setattr(settings, "PARSE_CACHE_DIR", str(tmp_path / "parse_cache"))
+    monkeypatch.setattr(settings, "PARSE_CACHE_BUCKET", None)
+    monkeypatch.setattr(settings, "PDF_ELEMENT_GRANULARITY", "line")
+
+
+def _chunks(pdf_path):
+    """Parses the file through the parse cache and makes overlapping chunks of two lines, in order like chunking_service."""
+    parts = parse_cache_service.parse_pdf_iter_cached(pdf_path, "pymupdf")
+    document = element_coalescing_service.coalesce_document(ParsedDocument.concatenate(list(parts)), granularity="line")
+    ids = dict(reference_id=uuid.uuid4(), user_id=uuid.uuid4(), chatbot_id=uuid.uuid4())
+    chunks = []
+    for page_index in range(document.num_pages):
+        start, end = int(document.page_offsets[page_index]), int(document.page_offsets[page_index + 1])
+        for first in range(start, end):
+            last = min(first + 2, end)
+            elements = document.elements(first, last)
+            chunks.append(ChunkCreate(
+                **ids, page_number=elements[0].page_number, chunk_text=" ".join(e.text for e in elements),
+                token_count=last - first, constituent_elements=elements
+            ))
+    return chunks
+
+
+def test_chunks_are_rebuilt_from_the_parse_cache(pdf_path, fake_redis):
+    chunks = _chunks(pdf_path)
+    file_hash = parse_cache_service.compute_file_hash(pdf_path)
+    assert task_checkpoint_service.save_chunks(TASK_ID, chunks, file_hash, "pymupdf")
+
+    restored = task_checkpoint_service.load_chunks(TASK_ID)
+    assert [chunk.model_dump() for chunk in restored] == [chunk.model_dump() for chunk in chunks]
+    # Chunks starting with the repeated line resolve to their own positions
+    repeated = [chunk for chunk in restored if chunk.chunk_text.startswith("alpha beta") and chunk.page_number == 1]
+    assert len({chunk.constituent_elements[0].y0 for chunk in repeated}) == 2
+
+
+def test_checkpoint_does_not_copy_elements(pdf_path, fake_redis):
+    chunks = _chunks(pdf_path)
+    task_checkpoint_service.save_chunks(TASK_ID, chunks, parse_cache_service.compute_file_hash(pdf_path), "pymupdf")
+    payload = json.loads(zlib.decompress(fake_redis.get(task_checkpoint_service._key(TASK_ID, "chunks"))))
+    assert len(payload["chunks"]) == len(chunks)
+    assert "word_boxes" not in json.dumps(payload)
+
+
+def test_checkpoint_without_cached_parse_is_ignored(pdf_path, fake_redis, monkeypatch):
+    chunks = _chunks(pdf_path)
+    task_checkpoint_service.save_chunks(TASK_ID, chunks, parse_cache_service.compute_file_hash(pdf_path), "pymupdf")
+    monkeypatch.setattr(settings, "PARSE_CACHE_DIR", settings.PARSE_CACHE_DIR + "-evicted")
+    assert task_checkpoint_service.load_chunks(TASK_ID) is None
+
+
+def test_checkpoint_from_other_granularity_is_ignored(pdf_path, fake_redis, monkeypatch):
+    chunks = _chunks(pdf_path)
+    task_checkpoint_service.save_chunks(TASK_ID, chunks, parse_cache_service.compute_file_hash(pdf_path), "pymupdf")
+    monkeypatch.setattr(settings, "PDF_ELEMENT_GRANULARITY", "block")
+    assert task_checkpoint_service.load_chunks(TASK_ID) is None
+
+
+def test_chunks_are_not_checkpointed_without_parse_cache(pdf_path, fake_redis, monkeypatch):
+    chunks = _chunks(pdf_path)
+    monkeypatch.setattr(settings, "PARSE_CACHE_ENABLED", False)
+    assert not task_checkpoint_service.save_chunks(TASK_ID, chunks, "hash", "pymupdf")
+    assert fake_redis.get(task_checkpoint_service._key(TASK_ID, "chunks")) is None
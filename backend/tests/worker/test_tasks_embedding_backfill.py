@@ -0,0 +1,144 @@
+import uuid
+
+import pytest
+
+pytest.importorskip("celery")
+pytest.importorskip("supabase")
+redis = pytest.importorskip("redis")
+
+from app.core.config import settings
+from app.services import task_checkpoint_service
+from app.worker import tasks_embedding_backfill
+
+TASK_ID = str(uuid.uuid4())
+CHATBOT_ID = str(uuid.uuid4())
+
+
+class FakeRedis:
+    """The few Redis commands task checkpoints use; the fail_* attributes simulate outages."""
+
+    def __init__(self):
+        self.data = {}
+        self.fail_get = False
+        self.fail_set = False
+        self.fail_after_sets = None
+        self.sets = 0
+
+    def get(self, key):
+        if self.fail_get:
+            raise redis.ConnectionError("connection reset")
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        if self.fail_set or (self.fail_after_sets is not None and self.sets >= self.fail_after_sets):
+            raise redis.ConnectionError("connection reset")
+        self.sets += 1
+        self.data[key] = value
+
+    def scan_iter(self, match):
+        prefix = match.rstrip("*")
+        return [key for key in self.data if key.startswith(prefix)]
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+
+@pytest.fixture
+def backfill(monkeypatch, openai_batch_server):
+    fake_redis = FakeRedis()
+    updated = {}
+    rows = [{"chunk_id": str(uuid.UUID(int=i)), "chunk_text": "x" * i, "token_count": 1} for i in range(1, 11)]
+
+    def update_chunk_embeddings(db, chunk_ids, embeddings):
+        updated.update(zip(chunk_ids, embeddings))
+        return len(chunk_ids), None
+
+    monkeypatch.setattr(settings, "EMBEDDING_BACKEND", "openai")
+    monkeypatch.setattr(settings, "EMBEDDING_BULK_MAX_INPUTS_PER_BATCH", 4)
+    monkeypatch.setattr(settings, "OPENAI_EMBEDDING_BATCH_SIZE", 2)
+    monkeypatch.setattr(task_checkpoint_service, "get_redis_client", lambda: fake_redis)
+    monkeypatch.setattr(tasks_embedding_backfill, "get_supabase_client", lambda: object())
+    monkeypatch.setattr(tasks_embedding_backfill, "update_task", lambda db, task_identifier, task_in: None)
+    monkeypatch.setattr(tasks_embedding_backfill.crud_chunk, "iter_chunk_texts", lambda db, chatbot_id, reference_id=None: iter([rows]))
+    monkeypatch.setattr(tasks_embedding_backfill.crud_chunk, "update_chunk_embeddings", update_chunk_embeddings)
+    return openai_batch_server, fake_redis, updated
+
+
+def run_poll(retries):
+    task = tasks_embedding_backfill.embedding_backfill_task
+    task.push_request(retries=retries)
+    try:
+        return task.run(TASK_ID, CHATBOT_ID)
+    finally:
+        task.pop_request()
+
+
+def run_until_done(start_poll=0, max_polls=10):
+    for poll in range(start_poll, max_polls):
+        try:
+            return run_poll(poll)
+        except tasks_embedding_backfill.Retry:
+            continue
+    raise AssertionError("The backfill did not finish")
+
+
+def test_backfill_stores_embeddings_of_all_batches(backfill):
+    server, fake_redis, updated = backfill
+    result = run_until_done()
+    assert result["status"] == "success"
+    assert len(server.batches) == 3 # 5 requests of 2 inputs, at most 4 inputs per batch
+    assert len(updated) == 10
+    assert updated[str(uuid.UUID(int=3))].tolist() == [3.0, 1.0, 0.0]
+    assert fake_redis.data == {} # Checkpoints are deleted once the task completes
+
+
+def test_state_is_stored_before_any_batch_is_submitted(backfill):
+    server, fake_redis, _ = backfill
+    fake_redis.fail_set = True
+    result = run_poll(0)
+    assert result["status"] == "error"
+    assert server.batches == {}
+
+
+def test_batches_are_cancelled_when_state_cannot_be_stored_after_a_submission(backfill):
+    server, fake_redis, _ = backfill
+    fake_redis.fail_after_sets = 2 # The initial state and the first batch id are stored; then Redis fails
+    result = run_poll(0)
+    assert result["status"] == "error"
+    assert len(server.batches) == 2
+    assert sorted(server.cancelled) == ["batch-0", "batch-1"]
+
+
+def test_batches_are_cancelled_when_the_poll_budget_runs_out(backfill, monkeypatch):
+    server, _, updated = backfill
+    monkeypatch.setattr(settings, "EMBEDDING_BULK_MAX_POLLS", 0)
+    result = run_poll(0)
+    assert result["status"] == "error"
+    assert sorted(server.cancelled) == sorted(server.batches)
+    assert updated == {}
+
+
+def test_lost_state_is_not_resubmitted(backfill):
+    server, fake_redis, _ = backfill
+    with pytest.raises(tasks_embedding_backfill.Retry):
+        run_poll(0)
+    submitted = len(server.batches)
+    fake_redis.data.clear() # e.g. evicted
+    result = run_poll(1)
+    assert result["status"] == "error"
+    assert len(server.batches) == submitted
+
+
+def test_unreadable_state_polls_again_without_resubmitting(backfill):
+    server, fake_redis, updated = backfill
+    with pytest.raises(tasks_embedding_backfill.Retry):
+        run_poll(0)
+    submitted = len(server.batches)
+    fake_redis.fail_get = True
+    with pytest.raises(tasks_embedding_backfill.Retry):
+        run_poll(1)
+    fake_redis.fail_get = False
+    assert run_until_done(start_poll=2)["status"] == "success"
+    assert len(server.batches) == submitted
+    assert len(updated) == 10